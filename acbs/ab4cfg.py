@@ -1,7 +1,5 @@
 import os
 
-from pyparsing import ParseException  # type: ignore
-
 from acbs import bashvar
 from acbs.const import AUTOBUILD_CONF_DIR
 
@@ -29,7 +27,7 @@ def is_in_stage2() -> bool:
         return is_in_stage2_env() or is_in_stage2_file(abcfg_path)
     except OSError as e:
         raise RuntimeError(f'Unable to read Autobuild config file {abcfg_path}.') from e
-    except ParseException as e:
+    except bashvar.ParseError as e:
         raise RuntimeError(f'Error occurred while parsing Autobuild config file {abcfg_path}.') from e
     except Exception as e:
         raise RuntimeError('Error occurred while checking whether stage 2 mode is enabled.') from e
@@ -1,5 +1,5 @@
 import re
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from acbs import __version__
 
@@ -19,6 +19,8 @@ class ACBSSourceInfo(object):
         self.enabled: bool = True
         # copy the repository to the build directory
         self.copy_repo: bool = False
+        # export the sources without the VCS metadata (Subversion, Mercurial and Bazaar)
+        self.export: bool = False
         # this is a tristate: 0 - off; 1 - on (non-recursive); 2 - recursive
         self.submodule: int = 2
 
@@ -68,3 +70,34 @@ class ACBSShrinkWrap(object):
         self.dpkg_state: str = ''
         self.no_deps = no_deps
         self.version = __version__
+        # number of packages at the front of the queue whose spec states were recorded when they were built
+        self.journaled = 0
+
+
+def source_to_dict(source: ACBSSourceInfo) -> Dict[str, Any]:
+    return dict(source.__dict__)
+
+
+def source_from_dict(data: Dict[str, Any]) -> ACBSSourceInfo:
+    source = ACBSSourceInfo(data['type'], data['url'])
+    source.__dict__.update(data)
+    source.chksum = (data['chksum'][0], data['chksum'][1])
+    return source
+
+
+def package_to_dict(package: ACBSPackageInfo) -> Dict[str, Any]:
+    data = dict(package.__dict__)
+    data['fail_arch'] = package.fail_arch.pattern if package.fail_arch else None
+    data['source_uri'] = [source_to_dict(s) for s in package.source_uri]
+    return data
+
+
+def package_from_dict(data: Dict[str, Any]) -> ACBSPackageInfo:
+    package = ACBSPackageInfo(data['name'], [], data['script_location'], [])
+    package.__dict__.update(data)
+    package.deps = list(data['deps'])
+    package.installables = list(data['installables'])
+    package.exported = dict(data['exported'])
+    package.fail_arch = re.compile(data['fail_arch']) if data['fail_arch'] else None
+    package.source_uri = [source_from_dict(s) for s in data['source_uri']]
+    return package
@@ -1,92 +1,117 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
 import collections
 import logging
+import os
 import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import uuid
 import warnings
+from typing import List
 
-import pyparsing as pp  # type: ignore
+re_variable = re.compile('^\\s*([a-zA-Z_][a-zA-Z0-9_]*)=')
 
-pp.ParserElement.enablePackrat()
+# regular expressions used by the fast path, mirroring the pyparsing grammar below
+re_blank = re.compile('[ \t]*')
+re_assign = re.compile('([A-Za-z_][A-Za-z0-9_]*)(=|\\+=)')
+re_varname = re.compile('[A-Za-z_][A-Za-z0-9_]*')
+re_plain = re.compile('[^~{}()$\'"`\\\\*?\\[\\] \t\n]+')
+re_dq_plain = re.compile('[^$`\\\\*"]+')
+re_substsafe = re.compile('[^/#%*?\\[}\'"`\\\\]+')
+re_offset = re.compile('([0-9]+)|[ \t]+(-[0-9]+)')
+re_integer = re.compile('[0-9]+|-[0-9]+')
+re_subst_type = re.compile('//|/#|/%|/')
+re_trim_type = re.compile('##|#|%%|%')
 
-re_variable = re.compile('^\\s*([a-zA-Z_][a-zA-Z0-9_]*)=')
+# the pyparsing grammar is only built when the fast path gives up
+bashvarfile = None
+
+
+def get_bashvarfile():
+    global bashvarfile
+    if bashvarfile is not None:
+        return bashvarfile
+    import pyparsing as pp  # type: ignore
+
+    pp.ParserElement.enablePackrat()
+
+    whitespace = pp.White(ws=' \t').suppress().setName("whitespace")
+    optwhitespace = pp.Optional(whitespace).setName("optwhitespace")
+    comment = ('#' + pp.CharsNotIn('\n')).setName("comment")
+    integer = (pp.Word(pp.nums) | pp.Combine('-' + pp.Word(pp.nums)))
 
-whitespace = pp.White(ws=' \t').suppress().setName("whitespace")
-optwhitespace = pp.Optional(whitespace).setName("optwhitespace")
-comment = ('#' + pp.CharsNotIn('\n')).setName("comment")
-integer = (pp.Word(pp.nums) | pp.Combine('-' + pp.Word(pp.nums)))
-
-varname = pp.Word(pp.alphas + '_', pp.alphanums +
-                  '_').setResultsName("varname")
-# ${parameter/pattern/string}
-substsafe = pp.CharsNotIn('/#%*?[}\'"`\\')
-
-expansion_param = pp.Group(
-    pp.Literal('$').setResultsName("expansion") +
-    # we don't want to parse all the expansions
-    ((
-        pp.Literal('{').suppress() +
+    varname = pp.Word(pp.alphas + '_', pp.alphanums +
+                      '_').setResultsName("varname")
+    # ${parameter/pattern/string}
+    substsafe = pp.CharsNotIn('/#%*?[}\'"`\\')
+
+    expansion_param = pp.Group(
+        pp.Literal('$').setResultsName("expansion") +
+        # we don't want to parse all the expansions
+        ((
+            pp.Literal('{').suppress() +
+            varname +
+            pp.Optional(
+                (pp.Literal(':').setResultsName("exptype") + pp.Group(
+                    pp.Word(pp.nums) |
+                    (whitespace + pp.Combine('-' + pp.Word(pp.nums)))
+                ).setResultsName("offset") +
+                    pp.Optional(pp.Literal(':') + integer.setResultsName("length")))
+                ^ (pp.oneOf('/ // /# /%').setResultsName("exptype") +
+                    pp.Optional(substsafe.setResultsName("pattern") +
+                                pp.Optional(pp.Literal('/') +
+                                            pp.Optional(substsafe, '').setResultsName("string")))
+                   )
+                ^ (pp.oneOf("# ## % %%").setResultsName("exptype") +
+                    pp.Optional(substsafe.setResultsName("pattern"))
+                   )
+            ) +
+            pp.Literal('}').suppress()
+        ) | varname)
+    )
+
+    singlequote = pp.Group(
+        pp.Literal("'").setResultsName("quote") +
+        pp.Optional(pp.CharsNotIn("'"), '').setResultsName("value") +
+        pp.Literal("'").suppress()
+    ).setName("singlequote")
+    doublequote_escape = (
+        (pp.Literal('\\').suppress() + pp.Word('$`"\\', exact=1)) |
+        pp.Literal('\\\n').suppress()
+    )
+    doublequote = pp.Group(
+        pp.Literal('"').setResultsName("quote") +
+        pp.Group(pp.ZeroOrMore(
+            doublequote_escape | expansion_param | pp.CharsNotIn('$`\\*"')
+        )).setResultsName("value") +
+        pp.Literal('"').suppress()
+    ).setName("doublequote")
+
+    texttoken = (
+        singlequote | doublequote | expansion_param |
+        pp.CharsNotIn('~{}()$\'"`\\*?[] \t\n')
+    )
+    varvalue = pp.Group(pp.ZeroOrMore(texttoken)).setResultsName('varvalue')
+    varassign = (
         varname +
-        pp.Optional(
-            (pp.Literal(':').setResultsName("exptype") + pp.Group(
-                pp.Word(pp.nums) |
-                (whitespace + pp.Combine('-' + pp.Word(pp.nums)))
-            ).setResultsName("offset") +
-                pp.Optional(pp.Literal(':') + integer.setResultsName("length")))
-            ^ (pp.oneOf('/ // /# /%').setResultsName("exptype") +
-                pp.Optional(substsafe.setResultsName("pattern") +
-                            pp.Optional(pp.Literal('/') +
-                                        pp.Optional(substsafe, '').setResultsName("string")))
-               )
-            ^ (pp.oneOf("# ## % %%").setResultsName("exptype") +
-                pp.Optional(substsafe.setResultsName("pattern"))
-               )
-        ) +
-        pp.Literal('}').suppress()
-    ) | varname)
-)
-
-singlequote = pp.Group(
-    pp.Literal("'").setResultsName("quote") +
-    pp.Optional(pp.CharsNotIn("'"), '').setResultsName("value") +
-    pp.Literal("'").suppress()
-).setName("singlequote")
-doublequote_escape = (
-    (pp.Literal('\\').suppress() + pp.Word('$`"\\', exact=1)) |
-    pp.Literal('\\\n').suppress()
-)
-doublequote = pp.Group(
-    pp.Literal('"').setResultsName("quote") +
-    pp.Group(pp.ZeroOrMore(
-        doublequote_escape | expansion_param | pp.CharsNotIn('$`\\*"')
-    )).setResultsName("value") +
-    pp.Literal('"').suppress()
-).setName("doublequote")
-
-texttoken = (
-    singlequote | doublequote | expansion_param |
-    pp.CharsNotIn('~{}()$\'"`\\*?[] \t\n')
-)
-varvalue = pp.Group(pp.ZeroOrMore(texttoken)).setResultsName('varvalue')
-varassign = (
-    varname +
-    (pp.Literal('=') | pp.Literal('+=')).setResultsName('operator') +
-    varvalue
-).setName('varassign').leaveWhitespace()
-
-line = pp.Group(
-    pp.lineStart + optwhitespace +
-    pp.Optional(varassign) + optwhitespace +
-    pp.Optional(comment).suppress() +
-    pp.lineEnd.suppress()
-).setName('line').leaveWhitespace()
-
-bashvarfile = pp.ZeroOrMore(line)
-
-ParseException = pp.ParseException
+        (pp.Literal('=') | pp.Literal('+=')).setResultsName('operator') +
+        varvalue
+    ).setName('varassign').leaveWhitespace()
+
+    line = pp.Group(
+        pp.lineStart + optwhitespace +
+        pp.Optional(varassign) + optwhitespace +
+        pp.Optional(comment).suppress() +
+        pp.lineEnd.suppress()
+    ).setName('line').leaveWhitespace()
+
+    bashvarfile = pp.ZeroOrMore(line)
+    return bashvarfile
 
 
 class VariableWarning(UserWarning):
@@ -101,6 +126,37 @@ class ParseError(Exception):
     pass
 
 
+def apply_expansion(var, exptype, offset=None, length=None, pattern='', newstring=''):
+    if exptype is None:
+        pass
+    elif exptype == ':':
+        if offset is not None:
+            if length is not None:
+                if length >= 0:
+                    var = var[offset:offset+length]
+                else:
+                    var = var[offset:length]
+            else:
+                var = var[offset:]
+    elif exptype[0] == '/':
+        if exptype == '/':
+            var = var.replace(pattern, newstring, 1)
+        elif exptype == '//':
+            var = var.replace(pattern, newstring)
+        elif exptype == '/#':
+            if var.startswith(pattern):
+                var = newstring + var[len(pattern):]
+        elif var.endswith(pattern):  # /%
+            var = var[:-len(pattern)] + newstring
+    elif exptype[0] == '#':
+        if var.startswith(pattern):
+            var = var[len(pattern):]
+    elif exptype[0] == '%':
+        if var.endswith(pattern):
+            var = var[:-len(pattern)]
+    return var
+
+
 def combine_value(tokens, variables):
     val = ''
     if tokens.get('quote') == '"':
@@ -110,42 +166,11 @@ def combine_value(tokens, variables):
     elif tokens.get('expansion') == '$':
         varname = tokens['varname']
         if varname in variables:
-            var = variables[varname]
-            exptype = tokens.get('exptype')
-            if exptype is None:
-                pass
-            elif exptype == ':':
-                if 'offset' in tokens:
-                    offset = int(tokens['offset'][0].strip())
-                    if 'length' in tokens:
-                        length = int(tokens['length'])
-                        if length >= 0:
-                            var = var[offset:offset+length]
-                        else:
-                            var = var[offset:length]
-                    else:
-                        var = var[offset:]
-            elif exptype[0] == '/':
-                pattern = tokens.get('pattern', '')
-                newstring = tokens.get('string', '')
-                if exptype == '/':
-                    var = var.replace(pattern, newstring, 1)
-                elif exptype == '//':
-                    var = var.replace(pattern, newstring)
-                elif exptype == '/#':
-                    if var.startswith(pattern):
-                        var = newstring + var[len(pattern):]
-                elif var.endswith(pattern):  # /%
-                    var = var[:-len(pattern)] + newstring
-            elif exptype[0] == '#':
-                pattern = tokens.get('pattern', '')
-                if var.startswith(pattern):
-                    var = var[len(pattern):]
-            elif exptype[0] == '%':
-                pattern = tokens.get('pattern', '')
-                if var.endswith(pattern):
-                    var = var[:-len(pattern)]
-            val += var
+            val += apply_expansion(
+                variables[varname], tokens.get('exptype'),
+                int(tokens['offset'][0].strip()) if 'offset' in tokens else None,
+                int(tokens['length']) if 'length' in tokens else None,
+                tokens.get('pattern', ''), tokens.get('string', ''))
         else:
             warnings.warn('variable "%s" is undefined' %
                           varname, VariableWarning)
@@ -158,8 +183,13 @@ def combine_value(tokens, variables):
     return ''.join(val)
 
 
-def eval_bashvar_literal(source):
-    parsed = bashvarfile.parseString(source, parseAll=True)
+def eval_bashvar_pyparsing(source):
+    import pyparsing as pp  # type: ignore
+
+    try:
+        parsed = get_bashvarfile().parseString(source, parseAll=True)
+    except pp.ParseException as ex:
+        raise ParseError(str(ex)) from ex
     variables = collections.OrderedDict()
     for line in parsed:
         if not line:
@@ -177,31 +207,285 @@ def eval_bashvar_literal(source):
     return variables
 
 
+class FastEvaluator(object):
+    """
+    Single-pass evaluator for the subset of bash understood by the pyparsing grammar.
+    It either yields exactly the same result as the grammar would, or raises ParseError
+    whenever it sees something it is not sure about.
+    """
+
+    def __init__(self, source):
+        # pyparsing expands the tabs before parsing, so should we
+        self.s = source.expandtabs()
+        self.pos = 0
+        self.variables = collections.OrderedDict()
+        self.undefined = []
+
+    def evaluate(self):
+        s = self.s
+        n = len(s)
+        while True:
+            self.pos = re_blank.match(s, self.pos).end()
+            m = re_assign.match(s, self.pos)
+            if m:
+                self.pos = m.end()
+                self.assign(m.group(1), m.group(2), self.value())
+                self.pos = re_blank.match(s, self.pos).end()
+            if self.pos < n and s[self.pos] == '#':
+                end = s.find('\n', self.pos)
+                if end < 0:
+                    end = n
+                # a comment needs at least one character after `#`
+                if end == self.pos + 1:
+                    raise ParseError('empty comment')
+                self.pos = end
+            if self.pos >= n:
+                break
+            if s[self.pos] != '\n':
+                raise ParseError('unexpected character at %d' % self.pos)
+            self.pos += 1
+        for name in self.undefined:
+            warnings.warn('variable "%s" is undefined' % name, VariableWarning)
+        return self.variables
+
+    def assign(self, name, operator, val):
+        if operator == '=':
+            self.variables[name] = val
+        elif name in self.variables:
+            self.variables[name] += val
+        else:
+            self.undefined.append(name)
+            self.variables[name] = val
+
+    def value(self):
+        s = self.s
+        val = []
+        while self.pos < len(s):
+            c = s[self.pos]
+            if c == "'":
+                end = s.find("'", self.pos + 1)
+                if end < 0:
+                    raise ParseError('unterminated single quote')
+                val.append(s[self.pos + 1:end])
+                self.pos = end + 1
+            elif c == '"':
+                val.append(self.doublequote())
+            elif c == '$':
+                val.append(self.expansion())
+            else:
+                m = re_plain.match(s, self.pos)
+                if not m:
+                    break
+                val.append(m.group(0))
+                self.pos = m.end()
+        return ''.join(val)
+
+    def doublequote(self):
+        s = self.s
+        val = []
+        self.pos += 1
+        while True:
+            if self.pos >= len(s):
+                raise ParseError('unterminated double quote')
+            c = s[self.pos]
+            if c == '"':
+                self.pos += 1
+                return ''.join(val)
+            if c == '\\':
+                escaped = s[self.pos + 1:self.pos + 2]
+                if escaped == '\n':
+                    pass
+                elif escaped and escaped in '$`"\\':
+                    val.append(escaped)
+                else:
+                    raise ParseError('unsupported escape sequence')
+                self.pos += 2
+            elif c == '$':
+                val.append(self.expansion())
+            else:
+                m = re_dq_plain.match(s, self.pos)
+                if not m:
+                    raise ParseError('unsupported character in double quotes')
+                val.append(m.group(0))
+                self.pos = m.end()
+
+    def expansion(self):
+        s = self.s
+        self.pos += 1
+        if not s.startswith('{', self.pos):
+            m = re_varname.match(s, self.pos)
+            if not m:
+                raise ParseError('unsupported expansion')
+            self.pos = m.end()
+            return self.expand(m.group(0), None)
+        m = re_varname.match(s, self.pos + 1)
+        if not m:
+            raise ParseError('unsupported expansion')
+        varname = m.group(0)
+        self.pos = m.end()
+        exptype = None
+        offset = None
+        length = None
+        pattern = ''
+        newstring = ''
+        if s.startswith(':', self.pos):
+            exptype = ':'
+            m = re_offset.match(s, self.pos + 1)
+            if not m:
+                raise ParseError('unsupported substring expansion')
+            offset = int(m.group(1) or m.group(2))
+            self.pos = m.end()
+            if s.startswith(':', self.pos):
+                m = re_integer.match(s, self.pos + 1)
+                if m:
+                    length = int(m.group(0))
+                    self.pos = m.end()
+        elif s.startswith('/', self.pos):
+            m = re_subst_type.match(s, self.pos)
+            exptype = m.group(0)
+            self.pos = m.end()
+            m = re_substsafe.match(s, self.pos)
+            if m:
+                pattern = m.group(0)
+                self.pos = m.end()
+                if s.startswith('/', self.pos):
+                    self.pos += 1
+                    m = re_substsafe.match(s, self.pos)
+                    if m:
+                        newstring = m.group(0)
+                        self.pos = m.end()
+        else:
+            m = re_trim_type.match(s, self.pos)
+            if m:
+                exptype = m.group(0)
+                self.pos = m.end()
+                m = re_substsafe.match(s, self.pos)
+                if m:
+                    pattern = m.group(0)
+                    self.pos = m.end()
+        if not s.startswith('}', self.pos):
+            raise ParseError('unsupported expansion')
+        self.pos += 1
+        return self.expand(varname, exptype, offset, length, pattern, newstring)
+
+    def expand(self, varname, exptype, offset=None, length=None, pattern='', newstring=''):
+        if varname not in self.variables:
+            self.undefined.append(varname)
+            return ''
+        return apply_expansion(self.variables[varname], exptype, offset, length, pattern, newstring)
+
+
+def eval_bashvar_literal(source):
+    try:
+        return FastEvaluator(source).evaluate()
+    except ParseError:
+        pass
+    return eval_bashvar_pyparsing(source)
+
+
 def uniq(seq):  # Dave Kirby
     # Order preserving
     seen = set()
     return [x for x in seq if x not in seen and not seen.add(x)]
 
 
+class BashEvaluator(object):
+    """
+    A long-lived bash co-process for the files the literal parser can't handle.
+    Every file is evaluated in its own restricted subshell (`set -r`) and the values are
+    sent back followed by a frame marker, so that bash is only spawned once per worker.
+    """
+
+    def __init__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='acbs-bashvar-')
+        self.errors = os.path.join(self.tmpdir, '.errors')
+        self.marker = '__ACBS_FRAME_%s__' % uuid.uuid4().hex
+        self.process = subprocess.Popen(
+            ('bash',), cwd=self.tmpdir, env={},
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+
+    def frame(self, source, var):
+        quoted = "'%s'" % source.replace("'", "'\\''")
+        script = ['(\nset -r\n__acbs_source=%s\n' % quoted,
+                  # a syntax error stops a bash script before the values are printed,
+                  # parse the whole file first so that `eval` behaves the same
+                  'eval "__acbs_check() {\n:\n$__acbs_source\n}" || exit\n',
+                  'unset -f __acbs_check\neval "$__acbs_source"\n']
+        for v in var:
+            # workaround variables containing newlines
+            script.append('echo "${%s//$\'\\n\'/\\\\n}"\n' % v)
+        script.append(') </dev/null 2>\'%s\'\necho\necho %s\n' % (self.errors, self.marker))
+        return ''.join(script).encode('utf-8')
+
+    def evaluate(self, source, var):
+        stdin = self.process.stdin
+        stdout = self.process.stdout
+        stdin.write(self.frame(source, var))
+        stdin.flush()
+        marker = (self.marker + '\n').encode('utf-8')
+        lines = []
+        while True:
+            line = stdout.readline()
+            if not line:
+                raise BrokenPipeError('bash co-process exited unexpectedly')
+            if line == marker:
+                break
+            lines.append(line)
+        with open(self.errors, 'rb') as f:
+            errs = f.read()
+        # strip the separator printed before the marker
+        return b''.join(lines)[:-1], errs
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process.stdout.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+evaluators = threading.local()
+evaluators_all: List[BashEvaluator] = []
+evaluators_lock = threading.Lock()
+
+
+def get_bash_evaluator(renew=False):
+    evaluator = getattr(evaluators, 'evaluator', None)
+    if evaluator is not None and not renew:
+        return evaluator
+    if evaluator is not None:
+        evaluator.close()
+    evaluator = BashEvaluator()
+    evaluators.evaluator = evaluator
+    with evaluators_lock:
+        evaluators_all.append(evaluator)
+    return evaluator
+
+
+@atexit.register
+def close_bash_evaluators():
+    with evaluators_lock:
+        for evaluator in evaluators_all:
+            evaluator.close()
+        evaluators_all.clear()
+
+
 def eval_bashvar_ext(source, filename=None):
     # we don't specify encoding here because the env will do.
     var = []
-    stdin = []
     for ln in source.splitlines(True):
         match = re_variable.match(ln)
         if match:
             var.append(match.group(1))
-        stdin.append(ln)
-    stdin.append('\n')
     var = uniq(var)
-    for v in var:
-        # workaround variables containing newlines
-        stdin.append('echo "${%s//$\'\\n\'/\\\\n}"\n' % v)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        outs, errs = subprocess.Popen(
-            ('bash', '-r'), cwd=tmpdir, env={},
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE).communicate(''.join(stdin).encode('utf-8'))
+    try:
+        outs, errs = get_bash_evaluator().evaluate(source, var)
+    except OSError:
+        # the co-process went away (killed?), start a new one and try again
+        outs, errs = get_bash_evaluator(renew=True).evaluate(source, var)
     if errs:
         warnings.warn(errs.decode('utf-8', 'backslashreplace').rstrip(),
                       BashErrorWarning)
@@ -215,7 +499,7 @@ def eval_bashvar(source: str, filename=None, msg=False):
     with warnings.catch_warnings(record=True) as wns:
         try:
             ret = eval_bashvar_literal(source)
-        except pp.ParseException:
+        except ParseError:
             ret = eval_bashvar_ext(source)
         msgs = []
         for w in wns:
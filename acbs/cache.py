@@ -0,0 +1,50 @@
+'''
+Helpers for the persistent metadata caches (tree index, parsed packages, ...)
+'''
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Optional
+
+from acbs.const import META_DIR
+
+cache_dir = META_DIR
+
+
+def cache_path(kind: str, key: str) -> str:
+    return os.path.join(cache_dir, kind, key)
+
+
+def load_json(path: str) -> Optional[Any]:
+    try:
+        with open(path, 'rt') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_json(path: str, data: Any) -> None:
+    # the caches are only an optimization, failing to write them is not fatal
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.acbs-')
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                json.dump(data, f, separators=(',', ':'))
+            # atomically replace the old cache so that concurrent readers never see a partial file
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+    except (OSError, TypeError, ValueError) as ex:
+        logging.debug(f'Unable to write cache {path}: {ex}')
+
+
+def load_cache(kind: str, key: str) -> Optional[Any]:
+    return load_json(cache_path(kind, key))
+
+
+def store_cache(kind: str, key: str, data: Any) -> None:
+    store_json(cache_path(kind, key), data)
@@ -1,31 +1,83 @@
 import hashlib
-import io
+import json
 import os
-import pickle
-import tarfile
+import stat
 import time
-from typing import IO, List, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 
 from acbs.base import ACBSPackageInfo, ACBSShrinkWrap
+from acbs.cache import load_cache, store_cache
 from acbs.const import DPKG_DIR
 
+# version of the check-point (and build journal) format
+CHECKPOINT_SCHEMA = 1
+# maximum number of packages to be hashed at the same time
+checkpoint_workers = min(32, (os.cpu_count() or 1) + 4)
 
-class Hasher(io.IOBase):
-    def __init__(self):
-        self.hash_obj = hashlib.new("sha256")
+# known digests of the files of a package directory: path -> [size, mtime (ns), inode, digest]
+file_digests = Dict[str, List[Any]]
 
-    def write(self, data):
-        self.hash_obj.update(data)
 
-    def hexdigest(self):
-        return self.hash_obj.hexdigest()
+def file_digest(path: str, st: os.stat_result, known: file_digests, visited: file_digests) -> str:
+    signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+    cached = known.get(path)
+    if cached and cached[:3] == signature:
+        visited[path] = cached
+        return cached[3]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    # files modified just now might be modified again within the timestamp granularity
+    if time.time() - st.st_mtime > 2:
+        visited[path] = signature + [digest]
+    return digest
+
+
+def tree_digest(path: str, known: file_digests, visited: file_digests) -> str:
+    """Merkle-style digest of a directory tree (names, contents, symlink targets and executable bits)"""
+    hash_obj = hashlib.new('sha256')
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        st = entry.stat(follow_symlinks=False)
+        if stat.S_ISLNK(st.st_mode):
+            kind, digest = 'l', hashlib.sha256(os.fsencode(os.readlink(entry.path))).hexdigest()
+        elif stat.S_ISDIR(st.st_mode):
+            kind, digest = 'd', tree_digest(entry.path, known, visited)
+        elif stat.S_ISREG(st.st_mode):
+            kind = 'x' if st.st_mode & stat.S_IXUSR else 'f'
+            digest = file_digest(entry.path, st, known, visited)
+        else:
+            continue
+        hash_obj.update(f'{kind} {digest} '.encode('utf-8') + os.fsencode(entry.name) + b'\0')
+    return hash_obj.hexdigest()
+
+
+def directory_digest(location: str) -> str:
+    # one cache per package directory: only the directories being hashed are loaded,
+    # and the entries of the deleted or renamed files are dropped when the directory is hashed again
+    key = hashlib.sha256(location.encode('utf-8')).hexdigest()
+    known = load_cache('spec-digests', key)
+    if not isinstance(known, dict):
+        known = {}
+    visited: file_digests = {}
+    digest = tree_digest(location, known, visited)
+    if visited != known:
+        store_cache('spec-digests', key, visited)
+    return digest
 
 
 def checkpoint_spec(package: ACBSPackageInfo) -> str:
-    f = cast(IO[bytes], Hasher())
-    with tarfile.open(mode='w|', fileobj=f) as tar:
-        tar.add(os.path.join(package.script_location, '..'))
-    return f.hexdigest()  # type: ignore
+    return directory_digest(os.path.realpath(os.path.join(package.script_location, '..')))
+
+
+def checkpoint_specs(packages: List[ACBSPackageInfo]) -> List[str]:
+    """Compute the spec states of the packages in parallel (the sub-packages share the same directory)"""
+    locations = [os.path.realpath(os.path.join(package.script_location, '..')) for package in packages]
+    unique = list(dict.fromkeys(locations))
+    with ThreadPoolExecutor(max_workers=checkpoint_workers) as executor:
+        results = dict(zip(unique, executor.map(directory_digest, unique)))
+    return [results[location] for location in locations]
 
 
 def checkpoint_dpkg() -> str:
@@ -49,12 +101,43 @@ def checkpoint_to_group(packages: List[ACBSPackageInfo], path: str) -> str:
     return filename
 
 
+def package_identity(package: ACBSPackageInfo) -> Dict[str, Any]:
+    # everything else can be parsed again from the tree
+    return {'name': package.name, 'location': package.script_location, 'modifiers': package.modifiers,
+            'base_slug': package.base_slug, 'group_seq': package.group_seq}
+
+
+def package_stub(identity: Dict[str, Any]) -> ACBSPackageInfo:
+    """Placeholder for a check-pointed package, see `acbs.resume.rehydrate_package`"""
+    package = ACBSPackageInfo(identity['name'], [], identity['location'], [])
+    package.modifiers = identity['modifiers']
+    package.base_slug = identity['base_slug']
+    package.group_seq = identity['group_seq']
+    return package
+
+
+def state_to_dict(data: ACBSShrinkWrap) -> Dict[str, Any]:
+    return {'schema': CHECKPOINT_SCHEMA, 'version': data.version, 'cursor': data.cursor,
+            'no_deps': data.no_deps, 'timings': data.timings, 'dpkg_state': data.dpkg_state,
+            'sps': data.sps, 'packages': [package_identity(package) for package in data.packages]}
+
+
+def state_from_dict(data: Dict[str, Any]) -> ACBSShrinkWrap:
+    if data.get('schema') != CHECKPOINT_SCHEMA:
+        raise ValueError(f'Unsupported check-point format: {data.get("schema")}')
+    timings = [(name, seconds) for name, seconds in data['timings']]
+    state = ACBSShrinkWrap(data['cursor'], timings, [package_stub(p) for p in data['packages']], data['no_deps'])
+    state.sps = list(data['sps'])
+    state.dpkg_state = data['dpkg_state']
+    state.version = data['version']
+    return state
+
+
 def do_shrink_wrap(data: ACBSShrinkWrap, path: str) -> str:
     # stamp the spec files
-    for package in data.packages:
-        data.sps.append(checkpoint_spec(package))
+    data.sps = checkpoint_specs(data.packages)
     data.dpkg_state = checkpoint_dpkg()
     filename = os.path.join(path, '{}.acbs-ckpt'.format(int(time.time())))
-    with open(filename, 'wb') as f:
-        pickle.dump(data, f)
+    with open(filename, 'wt') as f:
+        json.dump(state_to_dict(data), f, separators=(',', ':'))
     return filename
@@ -17,5 +17,7 @@ CONF_DIR = '/etc/acbs/'
 AUTOBUILD_CONF_DIR = '/etc/autobuild/'
 DUMP_DIR = '/var/cache/acbs/tarballs/'
 TMP_DIR = '/var/cache/acbs/build/'
+META_DIR = '/var/cache/acbs/meta/'
+TREE_DIR = '/var/cache/acbs/trees/'
 LOG_DIR = '/var/log/acbs/'
 DPKG_DIR = '/var/lib/dpkg/'
@@ -1,5 +1,50 @@
 import hashlib
-from typing import Optional, Tuple
+import os
+from typing import Dict, List, Optional, Tuple
+
+from acbs.cache import load_json, store_json
+
+HASH_BUFFER_SIZE = 1024 * 1024
+# verified digests are kept next to the file, e.g. `foo.tar.xz.acbs-hash`
+HASH_SIDECAR_SUFFIX = '.acbs-hash'
+
+# digests known in this session: (hash type, path) -> (file signature, digest)
+known_hashes: Dict[Tuple[str, str], Tuple[List[int], str]] = {}
+
+
+def file_signature(target_file: str) -> List[int]:
+    st = os.stat(target_file)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def record_hash(chksum_type: str, target_file: str, digest: str) -> None:
+    hash_type = chksum_type.lower()
+    path = os.path.realpath(target_file)
+    signature = file_signature(path)
+    known_hashes[(hash_type, path)] = (signature, digest)
+    sidecar = path + HASH_SIDECAR_SUFFIX
+    data = load_json(sidecar)
+    if not isinstance(data, dict) or data.get('signature') != signature:
+        data = {'signature': signature, 'hashes': {}}
+    data['hashes'][hash_type] = digest
+    store_json(sidecar, data)
+
+
+def lookup_hash(chksum_type: str, target_file: str) -> Optional[str]:
+    hash_type = chksum_type.lower()
+    path = os.path.realpath(target_file)
+    signature = file_signature(path)
+    known = known_hashes.get((hash_type, path))
+    if known and known[0] == signature:
+        return known[1]
+    data = load_json(path + HASH_SIDECAR_SUFFIX)
+    # the file changed (or got replaced) since it was hashed
+    if not isinstance(data, dict) or data.get('signature') != signature:
+        return None
+    digest = data.get('hashes', {}).get(hash_type)
+    if digest:
+        known_hashes[(hash_type, path)] = (signature, digest)
+    return digest
 
 
 def check_hash_hashlib_inner(chksum_type: str, target_file: str) -> Optional[str]:
@@ -10,11 +55,20 @@ def check_hash_hashlib_inner(chksum_type: str, target_file: str) -> Optional[str
         raise NotImplementedError(
             'Unsupported hash type %s! Currently supported: %s' % (
                 hash_type, ' '.join(sorted(hashlib.algorithms_available))))
+    known = lookup_hash(hash_type, target_file)
+    if known:
+        return known
     hash_obj = hashlib.new(hash_type)
-    with open(target_file, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            hash_obj.update(chunk)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(target_file, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hash_obj.update(view[:size])
     target_hash = hash_obj.hexdigest()
+    record_hash(hash_type, target_file, target_hash)
     return target_hash
 
 
@@ -1,35 +1,38 @@
-from collections import OrderedDict, defaultdict, deque
-from typing import Deque, Dict, List
+import time
+from array import array
+from collections import OrderedDict
+from typing import Container, Dict, List
 
 from acbs.find import find_package
 from acbs.parser import ACBSPackageInfo, check_buildability
 
 # package information cache
 pool: Dict[str, ACBSPackageInfo] = {}
+# minimum interval between the progress updates (in seconds)
+PROGRESS_INTERVAL = 0.1
 
 
 def tarjan_search(packages: 'OrderedDict[str, ACBSPackageInfo]', search_path: str, stage2: bool) -> List[List[ACBSPackageInfo]]:
     """This function describes a Tarjan's strongly connected components algorithm.
     The resulting list of ACBSPackageInfo are sorted topologically as a byproduct of the algorithm
     """
-    # Initialize state trackers
-    lowlink: Dict[str, int] = defaultdict(lambda: -1)
-    index: Dict[str, int] = defaultdict(lambda: -1)
-    stackstate: Dict[str, bool] = defaultdict(bool)
-    stack: Deque[str] = deque()
-    results: List[List[ACBSPackageInfo]] = []
-    packages_list: List[str] = [i for i in packages]
     pool.update(packages)
-    for i in packages_list:
-        if index[i] == -1:  # recurse on each package that is not yet visited
-            strongly_connected(search_path, packages_list, results, packages,
-                               i, lowlink, index, stackstate, stack, stage2)
-    return results
+    graph = DependencyGraph(packages, search_path, stage2)
+    # packages found along the way (e.g. the other packages of a group) are appended to the roots
+    roots = graph.roots
+    i = 0
+    while i < len(roots):
+        vert = graph.intern(roots[i])
+        if graph.index[vert] == -1:  # search from each package that is not yet visited
+            graph.strongly_connected(vert)
+        i += 1
+    return graph.results
 
 
-def prepare_for_reorder(package: ACBSPackageInfo, packages_list: List[str]) -> ACBSPackageInfo:
+def prepare_for_reorder(package: ACBSPackageInfo, packages_list: Container[str]) -> ACBSPackageInfo:
     """This function prepares the package for reordering.
     The idea is to move the installable dependencies which are in the build list to the "uninstallable" list.
+    `packages_list` should be a set, this is called for every package in the build list.
     """
     new_installables = []
     for d in package.installables:
@@ -37,67 +40,140 @@ def prepare_for_reorder(package: ACBSPackageInfo, packages_list: List[str]) -> A
         if d == package.name:
             new_installables.append(d)
             continue
-        try:
-            packages_list.index(d)
+        if d in packages_list:
             package.deps.append(d)
-        except ValueError:
+        else:
             new_installables.append(d)
     package.installables = new_installables
     return package
 
 
-def strongly_connected(search_path: str, packages_list: List[str], results: list, packages: 'OrderedDict[str, ACBSPackageInfo]', vert: str, lowlink: Dict[str, int], index: Dict[str, int], stackstate: Dict[str, bool], stack: Deque[str], stage2: bool, depth=0):
-    # update depth indices
-    index[vert] = depth
-    lowlink[vert] = depth
-    depth += 1
-    stackstate[vert] = True
-    stack.append(vert)
+class DependencyGraph(object):
+    """
+    State of the Tarjan's algorithm: the packages are interned as integers when they are first seen,
+    and the dependencies of the visited packages are stored in a flat (CSR-like) array
+    """
+
+    def __init__(self, packages: 'OrderedDict[str, ACBSPackageInfo]', search_path: str, stage2: bool) -> None:
+        self.packages = packages
+        self.search_path = search_path
+        self.stage2 = stage2
+        self.roots: List[str] = [i for i in packages]
+        self.results: List[List[ACBSPackageInfo]] = []
+        # package name <-> package id
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        # per package id: depth of the search (-1 if not visited) and lowlink
+        self.index: List[int] = []
+        self.lowlink: List[int] = []
+        self.stackstate: List[bool] = []
+        # dependencies of package `v` are `edges[edges_start[v]:edges_end[v]]`
+        self.edges = array('l')
+        self.edges_start: List[int] = []
+        self.edges_end: List[int] = []
+        self.stack: List[int] = []
+        self.last_progress = 0.0
+
+    def intern(self, name: str) -> int:
+        vert = self.ids.get(name)
+        if vert is None:
+            vert = len(self.names)
+            self.ids[name] = vert
+            self.names.append(name)
+            self.index.append(-1)
+            self.lowlink.append(-1)
+            self.stackstate.append(False)
+            self.edges_start.append(0)
+            self.edges_end.append(0)
+        return vert
+
+    def print_progress(self, name: str) -> None:
+        # printing on every vertex is slower than the search itself
+        now = time.monotonic()
+        if now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        print(f'[{len(self.results) + 1}/{len(pool)}] {name:30}\r', end='', flush=True)
 
-    # search package begin
-    print(f'[{len(results) + 1}/{len(pool)}] {vert:30}\r', end='', flush=True)
-    current_package = packages.get(vert)
-    if current_package is None:
-        package = pool.get(vert) or find_package(vert, search_path, '+stage2' if stage2 else '')
-        if not package:
-            raise ValueError(
-                f'Package {vert} not found')
-        if isinstance(package, list):
-            for s in package:
-                if vert == s.name:
-                    current_package = s
+    def find(self, vert: str) -> ACBSPackageInfo:
+        current_package = self.packages.get(vert)
+        if current_package is None:
+            package = pool.get(vert) or find_package(vert, self.search_path, '+stage2' if self.stage2 else '')
+            if not package:
+                raise ValueError(
+                    f'Package {vert} not found')
+            if isinstance(package, list):
+                for s in package:
+                    if vert == s.name:
+                        current_package = s
+                        pool[s.name] = s
+                        continue
                     pool[s.name] = s
-                    continue
-                pool[s.name] = s
-                packages_list.append(s.name)
-        else:
-            current_package = package
-            pool[vert] = current_package
-    assert current_package is not None
-    # first check if this dependency is buildable
-    # when `required_by` argument is present, it will raise an exception when the dependency is unbuildable.
-    check_buildability(
-        current_package, stack[-2] if len(stack) > 1 else '<unknown>')
-    # search package end
-    # Look for adjacent packages (dependencies)
-    for p in current_package.deps:
-        if index[p] == -1:
-            # recurse on unvisited packages
-            strongly_connected(search_path, packages_list, results, packages,
-                               p, lowlink, index, stackstate, stack, stage2, depth)
-            lowlink[vert] = min(lowlink[p], lowlink[vert])
-        # adjacent package is in the stack which means it is part of a loop
-        elif stackstate[p] is True:
-            lowlink[vert] = min(lowlink[p], index[vert])
+                    self.roots.append(s.name)
+            else:
+                current_package = package
+                pool[vert] = current_package
+        assert current_package is not None
+        return current_package
+
+    def visit(self, vert: int, depth: int) -> None:
+        # update depth indices
+        self.index[vert] = depth
+        self.lowlink[vert] = depth
+        self.stackstate[vert] = True
+        self.stack.append(vert)
+        name = self.names[vert]
+        # search package begin
+        self.print_progress(name)
+        current_package = self.find(name)
+        # first check if this dependency is buildable
+        # when `required_by` argument is present, it will raise an exception when the dependency is unbuildable.
+        check_buildability(
+            current_package, self.names[self.stack[-2]] if len(self.stack) > 1 else '<unknown>')
+        # search package end
+        edges, ids = self.edges, self.ids
+        self.edges_start[vert] = len(edges)
+        for p in current_package.deps:
+            dep = ids.get(p)
+            edges.append(self.intern(p) if dep is None else dep)
+        self.edges_end[vert] = len(edges)
 
-    w = ''
-    result = []
-    # if this is a root vertex
-    if lowlink[vert] == index[vert]:
-        # the current stack contains the vertices that belong to the same loop
-        # if the stack only contains one vertex, then there is no loop there
-        while w != vert:
-            w = stack.pop()
-            result.append(pool[w])
-            stackstate[w] = False
-        results.append(result)
+    def strongly_connected(self, root: int) -> None:
+        index, lowlink, stackstate, edges = self.index, self.lowlink, self.stackstate, self.edges
+        edges_start, edges_end = self.edges_start, self.edges_end
+        self.visit(root, 0)
+        # the call stack of the recursive algorithm: vertices and the positions of their next dependency to look at
+        frames = [root]
+        positions = [edges_start[root]]
+        while frames:
+            vert = frames[-1]
+            position = positions[-1]
+            # Look for adjacent packages (dependencies)
+            if position < edges_end[vert]:
+                positions[-1] = position + 1
+                p = edges[position]
+                if index[p] == -1:
+                    # descend into unvisited packages
+                    self.visit(p, index[vert] + 1)
+                    frames.append(p)
+                    positions.append(edges_start[p])
+                # adjacent package is in the stack which means it is part of a loop
+                elif stackstate[p]:
+                    lowlink[vert] = min(lowlink[p], index[vert])
+                continue
+            frames.pop()
+            positions.pop()
+            # if this is a root vertex
+            if lowlink[vert] == index[vert]:
+                # the current stack contains the vertices that belong to the same loop
+                # if the stack only contains one vertex, then there is no loop there
+                result = []
+                w = -1
+                while w != vert:
+                    w = self.stack.pop()
+                    result.append(pool[self.names[w]])
+                    stackstate[w] = False
+                self.results.append(result)
+            if frames:
+                parent = frames[-1]
+                lowlink[parent] = min(lowlink[vert], lowlink[parent])
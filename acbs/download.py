@@ -0,0 +1,207 @@
+'''
+In-process HTTP(S) downloader: keep-alive connections, resumable transfers and on-the-fly hashing
+'''
+import hashlib
+import http.client
+import logging
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, Optional, Tuple
+
+from acbs import __version__
+from acbs.crypto import record_hash
+
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 10
+TIMEOUT = 60
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# connections are not thread-safe, every thread keeps its own set of them
+connections = threading.local()
+ssl_context: Optional[ssl.SSLContext] = None
+
+connection_key = Tuple[str, str, Optional[str]]
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    global ssl_context
+    if ssl_context is None:
+        ssl_context = ssl.create_default_context()
+    return ssl_context
+
+
+def get_proxy(scheme: str, host: str) -> Optional[str]:
+    if urllib.request.proxy_bypass(host):
+        return None
+    return urllib.request.getproxies().get(scheme)
+
+
+def get_connection(scheme: str, netloc: str) -> Tuple[http.client.HTTPConnection, bool]:
+    """Return a (possibly reused) connection to the host and whether the request needs an absolute URL"""
+    host = urllib.parse.urlsplit(f'//{netloc}').hostname or netloc
+    proxy = get_proxy(scheme, host)
+    key: connection_key = (scheme, netloc, proxy)
+    pool: Dict[connection_key, http.client.HTTPConnection] = connections.__dict__.setdefault('pool', {})
+    conn = pool.get(key)
+    if conn is not None:
+        return conn, bool(proxy) and scheme == 'http'
+    if proxy:
+        proxy_netloc = urllib.parse.urlsplit(proxy).netloc or proxy
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_netloc, timeout=TIMEOUT, context=get_ssl_context())
+            conn.set_tunnel(netloc)
+        else:
+            conn = http.client.HTTPConnection(proxy_netloc, timeout=TIMEOUT)
+    elif scheme == 'https':
+        conn = http.client.HTTPSConnection(netloc, timeout=TIMEOUT, context=get_ssl_context())
+    else:
+        conn = http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+    pool[key] = conn
+    return conn, bool(proxy) and scheme == 'http'
+
+
+def drop_connection(scheme: str, netloc: str) -> None:
+    pool = connections.__dict__.get('pool', {})
+    for key in [k for k in pool if k[0] == scheme and k[1] == netloc]:
+        pool.pop(key).close()
+
+
+def close_connections() -> None:
+    """Close the connections kept alive by the calling thread"""
+    pool = connections.__dict__.get('pool', {})
+    while pool:
+        pool.popitem()[1].close()
+
+
+def send_request(url: str, headers: Dict[str, str]) -> http.client.HTTPResponse:
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    # a connection kept alive might have been closed by the server in the meantime, try again once
+    for attempt in range(2):
+        conn, absolute = get_connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', url if absolute else path, headers=headers)
+            return conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError,
+                http.client.CannotSendRequest, http.client.ResponseNotReady):
+            drop_connection(parts.scheme, parts.netloc)
+            if attempt:
+                raise
+    raise AssertionError('unreachable')
+
+
+def open_url(url: str, offset: int) -> Tuple[http.client.HTTPResponse, str]:
+    headers = {'User-Agent': f'acbs/{__version__}', 'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+    for _ in range(MAX_REDIRECTS):
+        response = send_request(url, headers)
+        if response.status not in REDIRECT_CODES:
+            return response, url
+        location = response.getheader('Location')
+        # drain the body so the connection can be reused
+        response.read()
+        if not location:
+            raise RuntimeError(f'Redirection without a location from {url}')
+        url = urllib.parse.urljoin(url, location)
+        logging.debug(f'Redirected to {url}')
+    raise RuntimeError(f'Too many redirections while fetching {url}')
+
+
+def hash_file_prefix(hasher, full_path: str, length: int) -> None:
+    with open(full_path, 'rb') as f:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            length -= len(chunk)
+
+
+def new_hasher(hash_type: str):
+    hash_type = (hash_type or 'sha256').lower()
+    if hash_type == 'none' or hash_type not in hashlib.algorithms_available:
+        return None
+    return hashlib.new(hash_type)
+
+
+def http_download(url: str, full_path: str, hash_type: str = 'sha256') -> Optional[str]:
+    """
+    Download a file over HTTP(S), resuming any partial download left behind
+
+    :param url: URL of the file
+    :param full_path: destination
+    :param hash_type: hash algorithm to compute while downloading (sha256 if empty)
+    :returns: hex digest of the file if it was computed
+    """
+    flag_path = full_path + '.dl'
+    if os.path.exists(full_path) and not os.path.exists(flag_path):
+        return None
+    # some servers may not support Range, the flag ensures that a completed download is never overwritten
+    with open(flag_path, 'wb') as f:
+        f.write(b'')
+    offset = os.path.getsize(full_path) if os.path.exists(full_path) else 0
+    logging.info(f'Downloading {url}...')
+    start = time.monotonic()
+    response, final_url = open_url(url, offset)
+    try:
+        received = receive_body(response, final_url, full_path, offset, hash_type)
+    except BaseException:
+        # the connection is in an unknown state
+        parts = urllib.parse.urlsplit(final_url)
+        drop_connection(parts.scheme, parts.netloc)
+        raise
+    if response.will_close:
+        parts = urllib.parse.urlsplit(final_url)
+        drop_connection(parts.scheme, parts.netloc)
+    os.unlink(flag_path)
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logging.info(f'Downloaded {received[0]} bytes in {elapsed:.1f}s ({received[0] / elapsed / 1024:.0f} KiB/s)')
+    return received[1]
+
+
+def receive_body(response: http.client.HTTPResponse, url: str, full_path: str,
+                 offset: int, hash_type: str) -> Tuple[int, Optional[str]]:
+    hasher = new_hasher(hash_type)
+    if response.status == 416 and offset:
+        # the partial file is already complete
+        response.read()
+        mode = None
+    elif response.status == 206 and offset:
+        content_range = response.getheader('Content-Range', '')
+        if not content_range.startswith(f'bytes {offset}-'):
+            response.close()
+            raise RuntimeError(f'Unexpected Content-Range from {url}: {content_range}')
+        mode = 'ab'
+    elif response.status == 200:
+        # the server does not support Range (or there is nothing to resume)
+        offset = 0
+        mode = 'wb'
+    else:
+        response.read()
+        raise RuntimeError(f'Failed to download {url}: HTTP {response.status} {response.reason}')
+    if hasher and offset:
+        hash_file_prefix(hasher, full_path, offset)
+    received = 0
+    if mode:
+        with open(full_path, mode) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                received += len(chunk)
+        expected = response.getheader('Content-Length')
+        if expected is not None and int(expected) != received:
+            raise RuntimeError(f'Download of {url} is truncated ({received}/{expected} bytes)')
+    if not hasher:
+        return received, None
+    digest = hasher.hexdigest()
+    record_hash(hasher.name, full_path, digest)
+    return received, digest
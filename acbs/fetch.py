@@ -4,44 +4,126 @@ import os
 import shutil
 import subprocess
 import json
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 from acbs.base import ACBSPackageInfo, ACBSSourceInfo
-from acbs.crypto import check_hash_hashlib, hash_url
-from acbs.utils import guess_extension_name
+from acbs.crypto import check_hash_hashlib, check_hash_hashlib_inner, hash_url
+from acbs.download import close_connections, http_download
+from acbs.gitpool import guess_pool, register_mirror
+from acbs.store import access_lock, link_object, object_path, store_object, touch_entries
+from acbs.treecache import extract_cached
+from acbs.utils import copy_tree, guess_extension_name
 
 fetcher_signature = Callable[[ACBSSourceInfo,
                               str, str], Optional[ACBSSourceInfo]]
 processor_signature = Callable[[ACBSPackageInfo, int, str], None]
 pair_signature = Tuple[fetcher_signature, processor_signature]
 generate_mode = False
+# maximum number of sources of a package to be fetched at the same time
+fetch_workers = 4
+# download http(s) sources in-process instead of using wget
+use_native_downloader = True
+# VCS repositories already updated in this run
+updated_repos: Set[str] = set()
+updated_repos_lock = threading.Lock()
+# sources with the same URL share the same location on disk, fetch them one at a time (see `url_lock`)
+url_locks: Dict[str, threading.Lock] = {}
+url_locks_lock = threading.Lock()
+# time spent extracting the sources of each package (in seconds)
+extract_timings: Dict[str, float] = {}
+# magic numbers of the compressed formats and the parallel decompressors for them
+compression_magics: List[Tuple[bytes, str]] = [
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\x1f\x8b', 'gzip'),
+]
+parallel_decompressors: Dict[str, List[str]] = {
+    'xz': ['xz', '-d', '-c', '-T0'],
+    'zstd': ['zstd', '-d', '-c', '-q', '-T0'],
+    'gzip': ['pigz', '-d', '-c'],
+}
 
 
 def fetch_source(info: List[ACBSSourceInfo], source_location: str, package_name: str) -> Optional[ACBSSourceInfo]:
     logging.info('Fetching required source files...')
-    count = 0
+    if len(info) < 2 or fetch_workers < 2:
+        count = 0
+        for i in info:
+            count += 1
+            logging.info(f'Fetching source ({count}/{len(info)})...')
+            # in generate mode, we need to fetch all the sources
+            if not i.enabled and not generate_mode:
+                logging.info(f'Source {count} skipped.')
+            url_hash = hash_url(i.url)
+            fetch_source_inner(i, source_location, url_hash)
+        return None
+    # sources sharing the same URL also share the same location on disk, fetch them one by one
+    batches: Dict[str, List[ACBSSourceInfo]] = {}
     for i in info:
-        count += 1
-        logging.info(f'Fetching source ({count}/{len(info)})...')
-        # in generate mode, we need to fetch all the sources
-        if not i.enabled and not generate_mode:
-            logging.info(f'Source {count} skipped.')
-        url_hash = hash_url(i.url)
-        fetch_source_inner(i, source_location, url_hash)
+        batches.setdefault(hash_url(i.url), []).append(i)
+    with ThreadPoolExecutor(max_workers=min(fetch_workers, len(batches))) as executor:
+        futures = {url_hash: executor.submit(fetch_source_batch, batch, source_location, url_hash)
+                   for url_hash, batch in batches.items()}
+        try:
+            # report the progress in the order of the sources
+            count = 0
+            for i in info:
+                count += 1
+                logging.info(f'Fetching source ({count}/{len(info)})...')
+                if not i.enabled and not generate_mode:
+                    logging.info(f'Source {count} skipped.')
+                futures[hash_url(i.url)].result()
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            raise
     return None
 
 
+def fetch_source_batch(info: List[ACBSSourceInfo], source_location: str, url_hash: str) -> None:
+    try:
+        for i in info:
+            # each source has its own retry counter
+            fetch_source_inner(i, source_location, url_hash)
+    finally:
+        # the worker thread is discarded after the fetch, so are the connections it kept alive
+        close_connections()
+
+
+def url_lock(url_hash: str) -> threading.Lock:
+    with url_locks_lock:
+        return url_locks.setdefault(url_hash, threading.Lock())
+
+
 def fetch_source_inner(info: ACBSSourceInfo, source_location: str, package_name: str) -> Optional[ACBSSourceInfo]:
     type_ = info.type
-    retry = 0
     fetcher: Optional[pair_signature] = handlers.get(type_.upper())
     if not fetcher or not callable(fetcher[0]):
         raise NotImplementedError(f'Unsupported source type: {type_}')
+    # different packages (e.g. a prefetch and a build) might use the same tarball or repository
+    with url_lock(hash_url(info.url)):
+        # the garbage collection of the source cache must not evict what is being fetched
+        with access_lock(source_location, False):
+            return fetch_source_retry(fetcher, info, source_location, package_name)
+
+
+def fetch_source_retry(fetcher: pair_signature, info: ACBSSourceInfo, source_location: str,
+                       package_name: str) -> Optional[ACBSSourceInfo]:
+    retry = 0
     while retry < 5:
         retry += 1
         try:
-            return fetcher[0](info, source_location, package_name)
+            result = fetcher[0](info, source_location, package_name)
+            if result and result.source_location:
+                # used by the garbage collection of the source cache
+                touch_entries(source_location, [result.source_location])
+            return result
         except Exception as ex:
             logging.exception(ex)
             logging.warning(f'Retrying ({retry}/5)...')
@@ -50,6 +132,35 @@ def fetch_source_inner(info: ACBSSourceInfo, source_location: str, package_name:
         'Unable to fetch source files, failed 5 times in a row.')
 
 
+class SourcePrefetcher(object):
+    """Fetches the sources of the upcoming packages in the background"""
+
+    def __init__(self, source_location: str, depth: int) -> None:
+        self.source_location = source_location
+        self.executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix='acbs-prefetch')
+        # one future per source name: sub-packages of a group share the sources
+        self.futures: Dict[str, Future] = {}
+
+    def schedule(self, info: List[ACBSSourceInfo], source_name: str) -> None:
+        if source_name in self.futures:
+            return
+        logging.debug(f'Prefetching sources for {source_name}...')
+        self.futures[source_name] = self.executor.submit(
+            fetch_source, info, self.source_location, source_name)
+
+    def fetch(self, info: List[ACBSSourceInfo], source_name: str) -> Optional[ACBSSourceInfo]:
+        future = self.futures.get(source_name)
+        if future is None:
+            return fetch_source(info, self.source_location, source_name)
+        # re-raises the error of the background fetch, if any
+        return future.result()
+
+    def shutdown(self) -> None:
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
 def process_source(info: ACBSPackageInfo, source_name: str) -> None:
     idx = 0
     for source_uri in info.source_uri:
@@ -60,6 +171,8 @@ def process_source(info: ACBSPackageInfo, source_name: str) -> None:
                 f'Unsupported source type: {type_}')
         fetcher[1](info, idx, source_name)
         idx += 1
+    if info.name in extract_timings:
+        logging.info(f'Extracted the sources of {info.name} in {extract_timings[info.name]:.2f}s')
     return
 
 
@@ -70,16 +183,33 @@ def tarball_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Opti
         if not info.chksum[1] and not generate_mode:
             raise ValueError('No checksum found. Please specify the checksum!')
         full_path = os.path.join(source_location, filename)
-        try:
-            wget_download(info.url, full_path)
-            info.source_location = full_path
-            return info
-        except Exception:
-            raise AssertionError('Failed to fetch source with Wget!')
-        return None
+        fetch_file(info.url, full_path, info, source_location)
+        return info
     return None
 
 
+def fetch_file(url: str, full_path: str, info: ACBSSourceInfo, source_location: str):
+    # the same file might have been downloaded from another URL
+    obj = object_path(source_location, info.chksum)
+    if obj and os.path.exists(obj) and link_object(obj, full_path):
+        logging.info(f'Using the stored copy of {url}')
+    else:
+        download_file(url, full_path, info.chksum[0])
+        # only verified files are added to the store
+        if obj and check_hash_hashlib_inner(info.chksum[0], full_path) == info.chksum[1].lower():
+            store_object(full_path, obj)
+    info.source_location = full_path
+
+
+def download_file(url: str, full_path: str, hash_type: str = 'sha256'):
+    if not use_native_downloader or urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+        return wget_download(url, full_path)
+    try:
+        http_download(url, full_path, hash_type)
+    except Exception as ex:
+        raise AssertionError(f'Failed to download {url}: {ex}')
+
+
 def wget_download(url: str, full_path: str):
     flag_path = full_path + ".dl"
     if os.path.exists(full_path) and not os.path.exists(flag_path):
@@ -121,11 +251,47 @@ def tarball_processor_innner(package: ACBSPackageInfo, index: int, source_name:
         return
     # decompress
     logging.info(f'Extracting {facade_name}...')
-    subprocess.check_call(['bsdtar', '-xf', facade_name],
-                          cwd=package.build_location)
+    start = time.monotonic()
+    if not extract_cached(info.chksum, facade_name, package.build_location, extract_archive):
+        extract_archive(facade_name, package.build_location)
+    elapsed = time.monotonic() - start
+    extract_timings[package.name] = extract_timings.get(package.name, 0.0) + elapsed
+    logging.debug(f'Extracted {facade_name} in {elapsed:.2f}s')
     return
 
 
+def detect_compression(path: str) -> Optional[str]:
+    with open(path, 'rb') as f:
+        header = f.read(8)
+    for magic, compression in compression_magics:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def extract_archive(archive: str, cwd: str) -> None:
+    compression = detect_compression(os.path.join(cwd, archive))
+    decompressor = parallel_decompressors.get(compression or '')
+    if not decompressor or not shutil.which(decompressor[0]):
+        # bsdtar decompresses the archive by itself (with a single thread)
+        subprocess.check_call(['bsdtar', '-xf', archive], cwd=cwd)
+        return
+    logging.debug(f'Decompressing {archive} with {decompressor[0]}')
+    with open(os.path.join(cwd, archive), 'rb') as f:
+        source = subprocess.Popen(decompressor, stdin=f, stdout=subprocess.PIPE, cwd=cwd)
+        assert source.stdout
+        try:
+            ret = subprocess.call(['bsdtar', '-xf', '-'], stdin=source.stdout, cwd=cwd)
+        finally:
+            # if bsdtar stopped early, the decompressor gets SIGPIPE
+            source.stdout.close()
+            source.wait()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, ['bsdtar', '-xf', '-'])
+    if source.returncode != 0:
+        raise subprocess.CalledProcessError(source.returncode, decompressor)
+
+
 def tarball_processor(package: ACBSPackageInfo, index: int, source_name: str) -> None:
     return tarball_processor_innner(package, index, source_name)
 
@@ -136,34 +302,117 @@ def pypi_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optiona
 
     ext = guess_extension_name(actual_url)
     full_path = os.path.join(source_location, name + ext)
-    try:
-        wget_download(actual_url, full_path)
-        info.source_location = full_path
-        return info
-    except Exception:
-        raise AssertionError('Failed to fetch source with Wget!')
-    return None
+    fetch_file(actual_url, full_path, info, source_location)
+    return info
 
 
 def blob_processor(package: ACBSPackageInfo, index: int, source_name: str) -> None:
     return tarball_processor_innner(package, index, source_name, False)
 
 
+def repo_key(info: ACBSSourceInfo) -> str:
+    return f'{info.type.lower()}:{info.url}'
+
+
+def should_update_repo(info: ACBSSourceInfo, has_revision: Callable[[], bool], once: bool = True) -> bool:
+    if once:
+        with updated_repos_lock:
+            if repo_key(info) in updated_repos:
+                logging.info('Repository already updated in this session.')
+                return False
+    if info.revision and has_revision():
+        logging.info(f'Revision {info.revision} is available locally, skipping update.')
+        return False
+    return True
+
+
+def mark_repo_updated(info: ACBSSourceInfo) -> None:
+    with updated_repos_lock:
+        updated_repos.add(repo_key(info))
+
+
+def check_command(command: List[str], cwd: Optional[str] = None) -> bool:
+    return subprocess.call(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def git_has_revision(full_path: str, revision: str) -> bool:
+    # branches move, only commits and tags can be trusted
+    if re.fullmatch(r'[0-9a-fA-F]{7,64}', revision):
+        ref = revision
+    elif revision.startswith(('tags/', 'refs/tags/')):
+        ref = 'refs/tags/' + revision.split('tags/', 1)[1]
+    else:
+        return False
+    return check_command(['git', 'cat-file', '-e', f'{ref}^{{commit}}'], cwd=full_path)
+
+
+def git_shallow_refspec(revision: str) -> Optional[str]:
+    if re.fullmatch(r'[0-9a-fA-F]{40}|[0-9a-fA-F]{64}', revision):
+        # keep a reference to the commit, so that it is not garbage-collected
+        return f'+{revision}:refs/acbs/{revision}'
+    if revision.startswith(('tags/', 'refs/tags/')):
+        tag = revision.split('tags/', 1)[1]
+        return f'+refs/tags/{tag}:refs/tags/{tag}'
+    # abbreviated hashes and branch names can not be fetched directly
+    return None
+
+
+def git_fetch_shallow(info: ACBSSourceInfo, full_path: str) -> bool:
+    refspec = git_shallow_refspec(info.revision or '')
+    if not refspec:
+        return False
+    if os.path.exists(full_path) and git_has_revision(full_path, info.revision or ''):
+        logging.info(f'Revision {info.revision} is available locally, skipping update.')
+        return True
+    logging.info(f'Fetching {info.revision} from the repository (depth={info.depth})...')
+    try:
+        if not os.path.exists(full_path):
+            subprocess.check_call(['git', 'init', '-q', '--bare', full_path])
+            subprocess.check_call(['git', 'remote', 'add', 'origin', info.url], cwd=full_path)
+        subprocess.check_call(
+            ['git', 'fetch', '--depth', str(info.depth), '--no-tags', 'origin', refspec], cwd=full_path)
+    except subprocess.CalledProcessError:
+        logging.warning('Unable to do a shallow fetch, falling back to a full mirror...')
+        shutil.rmtree(full_path, ignore_errors=True)
+        return False
+    return True
+
+
 def git_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
+    # an existing full mirror is always preferred, it is cheap to update
+    if info.depth and not os.path.exists(full_path):
+        shallow_path = full_path + '.shallow'
+        if git_fetch_shallow(info, shallow_path):
+            info.source_location = shallow_path
+            return info
     if not os.path.exists(full_path):
-        subprocess.check_call(['git', 'clone', '--bare', '--filter=blob:none', info.url, full_path])
-    else:
+        command = ['git', 'clone', '--bare', '--filter=blob:none']
+        # borrow the objects from other mirrors of the same project, if any
+        pool = guess_pool(source_location, info.url)
+        if pool:
+            command.extend(['--reference-if-able', pool])
+        subprocess.check_call(command + [info.url, full_path])
+        register_mirror(source_location, info.url, full_path)
+        mark_repo_updated(info)
+    elif should_update_repo(info, lambda: git_has_revision(full_path, info.revision or '')):
         logging.info('Updating repository...')
         # --prune: prune remote-tracking branches no longer on remote
         # --tags: fetch all tags and associated objects
         # --force: force overwrite of local reference
         subprocess.check_call(
             ['git', 'fetch', 'origin', '+refs/heads/*:refs/heads/*', '--prune', '--tags', '--force'], cwd=full_path)
+        mark_repo_updated(info)
     info.source_location = full_path
     return info
 
 
+def git_object_file(path: str) -> bool:
+    # git never modifies the object files and packs in place, the copies can share them
+    parts = path.split(os.sep)
+    return len(parts) > 2 and parts[0] == 'objects' and parts[1] != 'info'
+
+
 def git_processor(package: ACBSPackageInfo, index: int, source_name: str) -> None:
     info = package.source_uri[index]
     if not info.revision:
@@ -188,7 +437,7 @@ def git_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
         subprocess.check_call(params, cwd=checkout_location)
     if info.copy_repo:
         logging.info('Copying git folder...')
-        shutil.copytree(info.source_location, os.path.join(checkout_location, '.git'))
+        copy_tree(info.source_location, os.path.join(checkout_location, '.git'), git_object_file)
         with open(os.path.join(checkout_location, '.git', 'config'), 'r+') as f:
             content = f.read()
             content = content.replace('bare = true', 'bare = false')
@@ -198,10 +447,20 @@ def git_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
         return None
     with open(os.path.join(package.build_location, '.acbs-script'), 'wt') as f:
         f.write(
-            'ACBS_SRC=\'%s\';acbs_copy_git(){ abinfo \'Copying git folder...\'; cp -ar "${ACBS_SRC}" .git/; sed -i \'s|bare = true|bare = false|\' \'.git/config\'; }' % (info.source_location))
+            'ACBS_SRC=\'%s\';acbs_copy_git(){ abinfo \'Copying git folder...\'; cp -a --reflink=auto "${ACBS_SRC}" .git/; sed -i \'s|bare = true|bare = false|\' \'.git/config\'; }' % (info.source_location))
     return None
 
 
+def svn_has_revision(full_path: str, revision: str) -> bool:
+    # the working copy is checked out at exactly one revision
+    try:
+        current = subprocess.check_output(
+            ['svn', 'info', '--show-item', 'revision'], cwd=full_path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return current.decode('utf-8').strip() == revision.lstrip('r')
+
+
 def svn_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not info.revision:
@@ -212,7 +471,7 @@ def svn_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional
     if not os.path.exists(full_path):
         subprocess.check_call(
             ['svn', 'co', '--force', '-r', info.revision, info.url, full_path])
-    else:
+    elif should_update_repo(info, lambda: svn_has_revision(full_path, info.revision or ''), once=False):
         subprocess.check_call(
             ['svn', 'up', '--force', '-r', info.revision], cwd=full_path)
     info.source_location = full_path
@@ -224,18 +483,31 @@ def svn_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
     if not info.source_location:
         raise ValueError('Where is the subversion repository?')
     checkout_location = os.path.join(package.build_location, info.source_name or source_name)
+    if info.export:
+        logging.info('Exporting subversion repository...')
+        subprocess.check_call(['svn', 'export', '-q', info.source_location, checkout_location])
+        return
     logging.info('Copying subversion repository...')
-    shutil.copytree(info.source_location, checkout_location)
+    copy_tree(info.source_location, checkout_location)
     return
 
 
+def hg_has_revision(full_path: str, revision: str) -> bool:
+    # local revision numbers, tags and branches are not reliable, only changeset hashes are
+    if not re.fullmatch(r'[0-9a-fA-F]{12,40}', revision):
+        return False
+    return check_command(['hg', 'log', '-q', '-r', revision, '-R', full_path])
+
+
 def hg_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not os.path.exists(full_path):
         subprocess.check_call(['hg', 'clone', '-U', info.url, full_path])
-    else:
+        mark_repo_updated(info)
+    elif should_update_repo(info, lambda: hg_has_revision(full_path, info.revision or '')):
         logging.info('Updating repository...')
         subprocess.check_call(['hg', 'pull'], cwd=full_path)
+        mark_repo_updated(info)
     info.source_location = full_path
     return info
 
@@ -248,14 +520,22 @@ def hg_processor(package: ACBSPackageInfo, index: int, source_name: str) -> None
     if not info.source_location:
         raise ValueError('Where is the hg repository?')
     checkout_location = os.path.join(package.build_location, info.source_name or source_name)
+    if info.export:
+        logging.info(f'Exporting hg repository at {info.revision}')
+        subprocess.check_call(
+            ['hg', 'archive', '--config', 'ui.archivemeta=false', '-r', info.revision,
+             '-R', info.source_location, checkout_location])
+        return None
     logging.info('Copying hg repository...')
-    shutil.copytree(info.source_location, checkout_location)
+    # a local clone hard links the store
+    subprocess.check_call(['hg', 'clone', '-q', '-U', info.source_location, checkout_location])
+    # keep pointing to the upstream repository instead of the local mirror
+    hgrc = os.path.join(info.source_location, '.hg', 'hgrc')
+    if os.path.exists(hgrc):
+        shutil.copy2(hgrc, os.path.join(checkout_location, '.hg', 'hgrc'))
     logging.info(f'Checking out hg repository at {info.revision}')
     subprocess.check_call(
         ['hg', 'update', '-C', '-r', info.revision, '-R', checkout_location])
-    if info.copy_repo:
-        logging.info('Copying hg repository ...')
-        shutil.copytree(info.source_location, os.path.join(checkout_location, '.hg'))
     return None
 
 
@@ -270,13 +550,26 @@ def dummy_processor(package: ACBSPackageInfo, index: int, source_name: str) -> N
     return None
 
 
+def bzr_has_revision(full_path: str, revision: str) -> bool:
+    # revision numbers on the mainline of the branch
+    if not revision.isdigit():
+        return False
+    try:
+        revno = subprocess.check_output(['bzr', 'revno'], cwd=full_path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return revno.strip().isdigit() and int(revno) >= int(revision)
+
+
 def bzr_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not os.path.exists(full_path):
         subprocess.check_call(['bzr', 'branch', '--no-tree', info.url, full_path])
-    else:
+        mark_repo_updated(info)
+    elif should_update_repo(info, lambda: bzr_has_revision(full_path, info.revision or '')):
         logging.info('Updating repository...')
         subprocess.check_call(['bzr', 'pull'], cwd=full_path)
+        mark_repo_updated(info)
     info.source_location = full_path
     return info
 
@@ -289,21 +582,35 @@ def bzr_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
     if not info.source_location:
         raise ValueError('Where is the bzr repository?')
     checkout_location = os.path.join(package.build_location, info.source_name or source_name)
+    if info.export:
+        logging.info(f'Exporting bzr repository at {info.revision}')
+        subprocess.check_call(
+            ['bzr', 'export', '-r', info.revision, checkout_location, info.source_location])
+        return None
     logging.info('Copying bzr repository...')
-    shutil.copytree(info.source_location, checkout_location)
+    copy_tree(info.source_location, checkout_location)
     logging.info(f'Checking out bzr repository at {info.revision}')
     subprocess.check_call(
         ['bzr', 'co', '-r', info.revision], cwd=checkout_location)
     return None
 
 
+def fossil_has_revision(full_path: str, revision: str) -> bool:
+    # check-in hashes only, tags and branches move
+    if not re.fullmatch(r'[0-9a-fA-F]{10,64}', revision):
+        return False
+    return check_command(['fossil', 'info', revision, '-R', full_path])
+
+
 def fossil_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name + '.fossil')
     if not os.path.exists(full_path):
         subprocess.check_call(['fossil', 'clone', info.url, full_path])
-    else:
+        mark_repo_updated(info)
+    elif should_update_repo(info, lambda: fossil_has_revision(full_path, info.revision or '')):
         logging.info('Updating repository...')
         subprocess.check_call(['fossil', 'pull', '-R', full_path])
+        mark_repo_updated(info)
     info.source_location = full_path
     return info
 
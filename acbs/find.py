@@ -3,6 +3,7 @@ import os
 from typing import Dict, List, Optional
 
 from acbs.const import TMP_DIR
+from acbs.index import lookup_package, lookup_subpackage
 from acbs.parser import ACBSPackageInfo, ACBSSourceInfo, parse_package
 from acbs.utils import make_build_dir
 
@@ -22,32 +23,38 @@ def check_package_group(name: str, search_path: str, entry_path: str, modifiers:
             if os.path.basename(full_search_path) == 'autobuild' or not os.path.isfile(
                     os.path.join(full_search_path, 'defines')):
                 continue
-            # because the package inside the group will have a different name than the folder name
-            # we will parse the defines file to decide
-            result = parse_package(full_search_path, modifiers)
-            if result and result.name == name:
-                # name of the package inside the group
-                package_alias = os.path.basename(
-                    full_search_path)
-                try:
-                    group_seq = int(
-                        package_alias.split('-')[0])
-                except (ValueError, IndexError) as ex:
-                    raise ValueError('Invalid package alias: {alias}'.format(
-                        alias=package_alias)) from ex
-                group_root = os.path.realpath(
-                    os.path.join(full_search_path, '..'))
-                group_category = os.path.realpath(
-                    os.path.join(group_root, '..'))
-                result.base_slug = '{cat}/{root}'.format(cat=os.path.basename(
-                    group_category), root=os.path.basename(group_root))
-                result.group_seq = group_seq
-                group_result = expand_package_group(
-                    result, search_path, modifiers, tmp_dir)
+            group_result = check_sub_package(name, full_search_path, search_path, modifiers, tmp_dir)
+            if group_result:
                 return group_result
     return None
 
 
+def check_sub_package(name: str, full_search_path: str, search_path: str, modifiers: str, tmp_dir: str = TMP_DIR) -> Optional[List[ACBSPackageInfo]]:
+    # because the package inside the group will have a different name than the folder name
+    # we will parse the defines file to decide
+    result = parse_package(full_search_path, modifiers)
+    if not result or result.name != name:
+        return None
+    # name of the package inside the group
+    package_alias = os.path.basename(
+        full_search_path)
+    try:
+        group_seq = int(
+            package_alias.split('-')[0])
+    except (ValueError, IndexError) as ex:
+        raise ValueError('Invalid package alias: {alias}'.format(
+            alias=package_alias)) from ex
+    group_root = os.path.realpath(
+        os.path.join(full_search_path, '..'))
+    group_category = os.path.realpath(
+        os.path.join(group_root, '..'))
+    result.base_slug = '{cat}/{root}'.format(cat=os.path.basename(
+        group_category), root=os.path.basename(group_root))
+    result.group_seq = group_seq
+    return expand_package_group(
+        result, search_path, modifiers, tmp_dir)
+
+
 def find_package(name: str, search_path: str, modifiers: str, tmp_dir: str = TMP_DIR) -> List[ACBSPackageInfo]:
     if os.path.isfile(os.path.join(search_path, name)):
         with open(os.path.join(search_path, name), 'rt') as f:
@@ -70,7 +77,7 @@ def find_package(name: str, search_path: str, modifiers: str, tmp_dir: str = TMP
     return find_package_inner(name, search_path, modifiers=modifiers, tmp_dir=tmp_dir)
 
 
-def find_package_inner(name: str, search_path: str, group=False, modifiers: str='', tmp_dir: str = TMP_DIR) -> List[ACBSPackageInfo]:
+def find_package_inner(name: str, search_path: str, modifiers: str = '', tmp_dir: str = TMP_DIR) -> List[ACBSPackageInfo]:
     if os.path.isdir(os.path.join(search_path, name)):
         flat_path = os.path.join(search_path, name, 'autobuild')
         if os.path.isdir(flat_path):
@@ -79,33 +86,23 @@ def find_package_inner(name: str, search_path: str, group=False, modifiers: str=
         group_result = check_package_group(name, search_path, name, modifiers, tmp_dir)
         if group_result:
             return group_result
-    with os.scandir(search_path) as it:
-        # scan categories
-        for entry in it:
-            if not entry.is_dir():
-                continue
-            with os.scandir(os.path.join(search_path, entry.name)) as inner:
-                # scan package directories
-                for entry_inner in inner:
-                    if not entry_inner.is_dir():
-                        continue
-                    full_search_path = os.path.join(
-                        search_path, entry.name, entry_inner.name, 'autobuild')
-                    if entry_inner.name == name and os.path.isdir(full_search_path):
-                        return [parse_package(full_search_path, modifiers)]
-                    if not group:
-                        continue
-                    # is this a package group?
-                    group_result = check_package_group(
-                        name, search_path, os.path.join(entry.name, entry_inner.name), modifiers, tmp_dir)
-                    if group_result:
-                        return group_result
-    if group:
+    # consult the tree index instead of scanning the whole tree
+    found = lookup_package(name, search_path)
+    if not found:
         return []
-    else:
-        # if cannot find a package without considering it as part of a group
-        # then re-search with group enabled
-        return find_package_inner(name, search_path, True, modifiers, tmp_dir)
+    kind, path = found
+    if kind == 'package':
+        return [parse_package(os.path.join(search_path, path, 'autobuild'), modifiers)]
+    if kind == 'group':
+        group_result = check_package_group(name, search_path, path, modifiers, tmp_dir)
+        if group_result:
+            return group_result
+        # the group shadowing the name is empty, a tree walk would have continued with the sub-packages
+        found = lookup_subpackage(name, search_path)
+        if not found:
+            return []
+        kind, path = found
+    return check_sub_package(name, os.path.join(search_path, path), search_path, modifiers, tmp_dir) or []
 
 
 def check_package_groups(packages: List[ACBSPackageInfo]):
@@ -0,0 +1,128 @@
+'''
+Shared git object pools, so that mirrors of the same project (forks, alternative hosts) store their objects once
+
+Layout of the pool directory (inside the source cache):
+    git-pool/<root commit>.git  bare repository holding the shared objects
+    git-pool/index.json         guesses of the pool to use, keyed by the repository name
+    git-pool/.lock              serializes the modifications to the pools
+'''
+import fcntl
+import logging
+import os
+import subprocess
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+from urllib.parse import urlsplit
+
+from acbs.cache import load_json, store_json
+
+POOL_DIR = 'git-pool'
+
+
+def pool_path(dump_dir: str, root: str) -> str:
+    return os.path.join(dump_dir, POOL_DIR, f'{root}.git')
+
+
+def repo_name(url: str) -> str:
+    # https://github.com/torvalds/linux.git -> linux
+    name = os.path.basename(urlsplit(url).path.rstrip('/'))
+    if name.endswith('.git'):
+        name = name[:-4]
+    return name.lower()
+
+
+@contextmanager
+def pool_lock(dump_dir: str) -> Iterator[None]:
+    directory = os.path.join(dump_dir, POOL_DIR)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        # other acbs instances might share the same source cache
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def guess_pool(dump_dir: str, url: str) -> Optional[str]:
+    """Find a pool that probably shares objects with the repository at `url`"""
+    index = load_json(os.path.join(dump_dir, POOL_DIR, 'index.json')) or {}
+    root = index.get(repo_name(url))
+    if not root:
+        return None
+    path = pool_path(dump_dir, root)
+    return path if os.path.isdir(path) else None
+
+
+def get_root_commit(repo: str) -> Optional[str]:
+    try:
+        roots = subprocess.check_output(
+            ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=repo, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    # histories might have been merged, the smallest hash is as good as any other to identify the project
+    return min(roots.decode('utf-8').split(), default=None)
+
+
+def get_alternates(repo: str) -> List[str]:
+    try:
+        with open(os.path.join(repo, 'objects', 'info', 'alternates'), 'rt') as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def add_alternate(repo: str, objects: str) -> None:
+    alternates = get_alternates(repo)
+    if objects in alternates:
+        return
+    os.makedirs(os.path.join(repo, 'objects', 'info'), exist_ok=True)
+    with open(os.path.join(repo, 'objects', 'info', 'alternates'), 'at') as f:
+        f.write(objects + '\n')
+
+
+def create_pool(path: str, mirror: str) -> None:
+    """Create a pool from the packed objects of `mirror`, which then borrows the objects from the pool"""
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    # the objects in the pool are only referenced by the mirrors, never prune them
+    subprocess.check_call(['git', 'config', 'gc.auto', '0'], cwd=path)
+    subprocess.check_call(['git', 'config', 'gc.pruneExpire', 'never'], cwd=path)
+    source = os.path.join(mirror, 'objects', 'pack')
+    target = os.path.join(path, 'objects', 'pack')
+    packs = [name for name in os.listdir(source) if not name.startswith('tmp_')]
+    # link first, so that the objects are always reachable from the mirror
+    for name in packs:
+        os.link(os.path.join(source, name), os.path.join(target, name))
+    add_alternate(mirror, os.path.abspath(os.path.join(path, 'objects')))
+    for name in packs:
+        os.unlink(os.path.join(source, name))
+    # `git clone --reference` advertises the references of the pool to the server
+    # to avoid downloading the objects again, so the pool needs some of them
+    refs = subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(objectname) %(refname)'], cwd=mirror).decode('utf-8')
+    namespace = f'refs/mirrors/{os.path.basename(mirror)}/'
+    commands = ''.join(f'create {namespace}{ref[len("refs/"):]} {sha}\n'
+                       for sha, ref in (line.split(' ', 1) for line in refs.splitlines()))
+    subprocess.run(['git', 'update-ref', '--stdin'], cwd=path, input=commands.encode('utf-8'), check=True)
+
+
+def register_mirror(dump_dir: str, url: str, mirror: str) -> None:
+    """Share the objects of a freshly cloned mirror with the other mirrors of the same project"""
+    root = get_root_commit(mirror)
+    if not root:
+        return
+    path = pool_path(dump_dir, root)
+    try:
+        with pool_lock(dump_dir):
+            if not os.path.isdir(path):
+                logging.info(f'Creating a shared object pool for {repo_name(url)}...')
+                create_pool(path, mirror)
+            elif os.path.abspath(os.path.join(path, 'objects')) not in get_alternates(mirror):
+                logging.debug(f'{url} shares the history with {path}, but did not use it')
+            index_path = os.path.join(dump_dir, POOL_DIR, 'index.json')
+            index = load_json(index_path) or {}
+            index[repo_name(url)] = root
+            store_json(index_path, index)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        # the mirror is still usable on its own
+        logging.warning(f'Unable to share the objects of {url}: {ex}')
@@ -0,0 +1,232 @@
+'''
+Persistent index of the abbs tree, used to locate packages without walking the whole tree
+'''
+import hashlib
+import logging
+import os
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
+
+from acbs import bashvar
+from acbs.cache import load_cache, store_cache
+
+INDEX_VERSION = 1
+
+# a lookup result: (kind, path relative to the tree)
+# kind is one of `package` (cat/pkg), `group` (cat/group) or `sub` (cat/group/01-sub)
+index_entry = Tuple[str, str]
+
+
+def get_tree_head(search_path: str) -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=search_path, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def read_package_name(defines: str) -> Optional[str]:
+    try:
+        with open(defines, 'rt') as f:
+            return bashvar.eval_bashvar(f.read(), filename=defines).get('PKGNAME')
+    except Exception as ex:
+        logging.debug(f'Unable to read package name from {defines}: {ex}')
+        return None
+
+
+class TreeIndex(object):
+    def __init__(self, search_path: str) -> None:
+        self.search_path = search_path
+        self.head = ''
+        # category name -> [mtime, [package directories]]
+        self.categories: Dict[str, List[Any]] = {}
+        # cat/pkg -> {'mtime': int, 'flat': bool, 'group': bool, 'subs': [[directory, mtime, PKGNAME]]}
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # lookup tables (derived from the entries above)
+        self.packages: Dict[str, str] = {}
+        self.groups: Dict[str, Tuple[int, str]] = {}
+        self.subpackages: Dict[str, Tuple[int, str]] = {}
+        self.refreshed = False
+
+    def cache_key(self) -> str:
+        return hashlib.sha256(os.path.realpath(self.search_path).encode('utf-8')).hexdigest()
+
+    def load(self) -> None:
+        data = load_cache('tree-index', self.cache_key())
+        head = get_tree_head(self.search_path)
+        if data and data.get('version') == INDEX_VERSION:
+            self.categories = data['categories']
+            self.entries = data['entries']
+            self.build_lookup_tables()
+            # same commit: trust the index, stale entries are caught by `lookup`
+            if head and data.get('head') == head:
+                self.head = head
+                return
+        self.head = head
+        self.refresh()
+
+    def save(self) -> None:
+        store_cache('tree-index', self.cache_key(), {
+            'version': INDEX_VERSION, 'head': self.head,
+            'categories': self.categories, 'entries': self.entries})
+
+    def refresh(self) -> None:
+        logging.debug(f'Refreshing tree index for {self.search_path}...')
+        categories: Dict[str, List[Any]] = {}
+        entries: Dict[str, Dict[str, Any]] = {}
+        with os.scandir(self.search_path) as it:
+            for category in it:
+                if category.name.startswith('.') or not category.is_dir():
+                    continue
+                mtime = category.stat().st_mtime_ns
+                cached = self.categories.get(category.name)
+                if cached and cached[0] == mtime:
+                    children = cached[1]
+                else:
+                    with os.scandir(category.path) as inner:
+                        children = [e.name for e in inner if e.is_dir()]
+                categories[category.name] = [mtime, children]
+                for child in children:
+                    rel = os.path.join(category.name, child)
+                    entry = self.refresh_entry(rel, self.entries.get(rel))
+                    if entry:
+                        entries[rel] = entry
+        self.categories = categories
+        self.entries = entries
+        self.refreshed = True
+        self.build_lookup_tables()
+        self.save()
+
+    def refresh_entry(self, rel: str, old: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.search_path, rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if old and old['mtime'] == mtime:
+            # the directory listing did not change, but the sub-package defines might
+            if all(self.defines_mtime(os.path.join(rel, s[0])) == s[1] for s in old['subs']):
+                return old
+        old_subs = {s[0]: s for s in old['subs']} if old else {}
+        subs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                # condition: `defines` inside a folder but not named `autobuild`
+                if entry.name == 'autobuild':
+                    continue
+                defines_mtime = self.defines_mtime(os.path.join(rel, entry.name))
+                if defines_mtime is None:
+                    continue
+                cached = old_subs.get(entry.name)
+                if cached and cached[1] == defines_mtime:
+                    subs.append(cached)
+                    continue
+                subs.append([entry.name, defines_mtime,
+                             read_package_name(os.path.join(entry.path, 'defines'))])
+        return {
+            'mtime': mtime,
+            'flat': os.path.isdir(os.path.join(path, 'autobuild')),
+            'group': os.path.isfile(os.path.join(path, 'spec')),
+            'subs': subs
+        }
+
+    def defines_mtime(self, rel: str) -> Optional[int]:
+        try:
+            st = os.stat(os.path.join(self.search_path, rel, 'defines'))
+        except OSError:
+            return None
+        return st.st_mtime_ns
+
+    def build_lookup_tables(self) -> None:
+        self.packages = {}
+        self.groups = {}
+        self.subpackages = {}
+        order = 0
+        # follow the directory order, so that the first match wins like a tree walk would do
+        for category, (_, children) in self.categories.items():
+            for child in children:
+                rel = os.path.join(category, child)
+                entry = self.entries.get(rel)
+                if not entry:
+                    continue
+                order += 1
+                if entry['flat']:
+                    self.packages.setdefault(child, rel)
+                if entry['group']:
+                    self.groups.setdefault(child, (order, rel))
+                for sub, _, name in entry['subs']:
+                    if name:
+                        self.subpackages.setdefault(name, (order, os.path.join(rel, sub)))
+
+    def lookup_inner(self, name: str) -> Optional[index_entry]:
+        rel = self.packages.get(name)
+        if rel:
+            return 'package', rel
+        group = self.groups.get(os.path.basename(name))
+        sub = self.subpackages.get(name)
+        if group and (not sub or group[0] <= sub[0]):
+            return 'group', group[1]
+        if sub:
+            return 'sub', sub[1]
+        return None
+
+    def verify(self, result: index_entry) -> bool:
+        kind, rel = result
+        path = os.path.join(self.search_path, rel)
+        if kind == 'package':
+            return os.path.isdir(os.path.join(path, 'autobuild'))
+        if kind == 'group':
+            return os.path.isfile(os.path.join(path, 'spec'))
+        return self.defines_mtime(rel) == self.recorded_mtime(rel)
+
+    def recorded_mtime(self, rel: str) -> Optional[int]:
+        entry = self.entries.get(os.path.dirname(rel))
+        if not entry:
+            return None
+        for sub, mtime, _ in entry['subs']:
+            if sub == os.path.basename(rel):
+                return mtime
+        return None
+
+    def lookup(self, name: str) -> Optional[index_entry]:
+        result = self.lookup_inner(name)
+        if result and self.verify(result):
+            return result
+        if self.refreshed:
+            return None
+        # the index might be outdated (uncommitted changes to the tree), refresh and try again
+        self.refresh()
+        return self.lookup_inner(name)
+
+    def lookup_subpackage(self, name: str) -> Optional[index_entry]:
+        """Look up `name` among the sub-packages only, for when the group of the same name does not provide it"""
+        sub = self.subpackages.get(name)
+        if sub and self.verify(('sub', sub[1])):
+            return 'sub', sub[1]
+        if self.refreshed:
+            return None
+        self.refresh()
+        sub = self.subpackages.get(name)
+        return ('sub', sub[1]) if sub else None
+
+
+# loaded indices, keyed by the tree location
+indices: Dict[str, TreeIndex] = {}
+
+
+def get_tree_index(search_path: str) -> TreeIndex:
+    key = os.path.realpath(search_path)
+    index = indices.get(key)
+    if index is None:
+        index = TreeIndex(search_path)
+        index.load()
+        indices[key] = index
+    return index
+
+
+def lookup_package(name: str, search_path: str) -> Optional[index_entry]:
+    return get_tree_index(search_path).lookup(name)
+
+
+def lookup_subpackage(name: str, search_path: str) -> Optional[index_entry]:
+    return get_tree_index(search_path).lookup_subpackage(name)
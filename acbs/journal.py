@@ -0,0 +1,105 @@
+'''
+Append-only build journal, so that a build can be resumed even if acbs got killed
+
+The journal is a JSON-lines file: a header describing the queue (in the check-point format),
+then one record per built package, and the final state of dpkg when the build stops.
+Every line is flushed to the disk before the build continues.
+'''
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from acbs.base import ACBSPackageInfo, ACBSShrinkWrap
+from acbs.checkpoint import checkpoint_dpkg, checkpoint_specs, state_from_dict, state_to_dict
+
+JOURNAL_SUFFIX = '.acbs-journal'
+
+
+def append_line(f, data: Dict[str, Any]) -> None:
+    f.write(json.dumps(data, separators=(',', ':')) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def sync_directory(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BuildJournal(object):
+    def __init__(self, directory: str, packages: List[ACBSPackageInfo],
+                 timings: List[Tuple[str, float]], no_deps: bool) -> None:
+        self.path = os.path.join(directory, f'{int(time.time())}-{os.getpid()}{JOURNAL_SUFFIX}')
+        self.lock = threading.Lock()
+        # the packages are identified by their position in the queue
+        self.indices = {id(package): idx for idx, package in enumerate(packages)}
+        state = ACBSShrinkWrap(1, timings, packages, no_deps)
+        state.sps = self.sps = checkpoint_specs(packages)
+        state.dpkg_state = checkpoint_dpkg()
+        self.file = open(self.path, 'xt')
+        append_line(self.file, dict(state_to_dict(state), type='header'))
+        sync_directory(directory)
+
+    def record(self, package: ACBSPackageInfo, timing: Tuple[str, float]) -> None:
+        idx = self.indices[id(package)]
+        with self.lock:
+            append_line(self.file, {'type': 'built', 'index': idx, 'timing': timing, 'spec': self.sps[idx]})
+
+    def close(self, remove: bool = False) -> None:
+        if not remove and not self.file.closed:
+            # hashing the dpkg status after every package would be too slow, it's only recorded at the end
+            append_line(self.file, {'type': 'dpkg', 'dpkg_state': checkpoint_dpkg()})
+        self.file.close()
+        if remove:
+            os.unlink(self.path)
+
+
+def read_journal(path: str) -> Tuple[ACBSShrinkWrap, List[Dict[str, Any]]]:
+    with open(path, 'rt') as f:
+        lines = f.read().split('\n')
+    # the last line is incomplete if acbs got killed while writing it
+    complete = lines[:-1]
+    if not complete:
+        raise ValueError(f'{path} is empty or truncated.')
+    try:
+        entries = [json.loads(line) for line in complete]
+        if entries[0].get('type') != 'header':
+            raise ValueError('missing header')
+        header = state_from_dict(entries[0])
+    except (KeyError, TypeError, ValueError) as ex:
+        raise ValueError(f'{path} is not a valid build journal: {ex}')
+    return header, [entry for entry in entries[1:] if entry.get('type') in ('built', 'dpkg')]
+
+
+def load_journal(path: str) -> ACBSShrinkWrap:
+    """Rebuild the state of the build from the journal, the built packages are moved to the front of the queue"""
+    header, records = read_journal(path)
+    timings = header.timings
+    built: List[int] = []
+    dpkg_state = header.dpkg_state
+    seen = set()
+    for record in records:
+        if record['type'] == 'dpkg':
+            dpkg_state = record['dpkg_state']
+            continue
+        # unknown until the final record (if acbs got killed, the installed packages will be checked again)
+        dpkg_state = ''
+        if record['index'] in seen:
+            continue
+        seen.add(record['index'])
+        built.append(record['index'])
+        header.sps[record['index']] = record['spec']
+        timings.append((record['timing'][0], record['timing'][1]))
+    order = built + [idx for idx in range(len(header.packages)) if idx not in seen]
+    state = ACBSShrinkWrap(len(built) + 1, timings, [header.packages[idx] for idx in order], header.no_deps)
+    state.sps = [header.sps[idx] for idx in order]
+    state.dpkg_state = dpkg_state
+    state.version = header.version
+    # the specs of the built packages are known, no need to check them again
+    state.journaled = len(built)
+    return state
@@ -5,21 +5,28 @@ import sys
 import time
 import traceback
 import fcntl
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import acbs.fetch
 import acbs.parser
+import acbs.treecache
 from acbs import __version__
 from acbs.ab4cfg import is_in_stage2
 from acbs.base import ACBSPackageInfo
-from acbs.checkpoint import ACBSShrinkWrap, checkpoint_to_group, do_shrink_wrap
-from acbs.const import AUTOBUILD_CONF_DIR, CONF_DIR, DUMP_DIR, LOG_DIR, TMP_DIR
+from acbs.checkpoint import ACBSShrinkWrap, checkpoint_text, checkpoint_to_group, do_shrink_wrap
+from acbs.const import AUTOBUILD_CONF_DIR, CONF_DIR, DUMP_DIR, LOG_DIR, TMP_DIR, TREE_DIR
 from acbs.deps import prepare_for_reorder, tarjan_search
-from acbs.fetch import fetch_source, process_source
+from acbs.fetch import SourcePrefetcher, fetch_source, process_source
 from acbs.find import check_package_groups, find_package
+from acbs.journal import BuildJournal
 from acbs.parser import check_buildability, get_deps_graph, get_tree_by_name
 from acbs.pm import install_from_repo
+from acbs.rdeps import rebuild_set
+from acbs.scheduler import BuildScheduler
+from acbs.store import parse_size
 from acbs.utils import (
     ACBSLogFormatter,
     ACBSLogPlainFormatter,
@@ -98,8 +105,15 @@ class BuildCore(object):
         self.package_cursor = 0
         self.reorder = args.reorder
         self.save_list = args.save_list
+        # `rdeps` (the dependents of the packages) or `rebuild-set` (the packages and their dependents)
+        self.rdeps_mode = args.rdeps_mode
         self.force_use_apt = args.force_use_apt
         self.generate_pkg_metadata = args.generate_pkg_metadata
+        self.jobs = max(args.jobs, 1)
+        self.prefetch = max(args.prefetch, 0)
+        # serializes the accesses to the package manager and ciel
+        self.repo_lock = threading.Lock()
+        self.journal: Optional[BuildJournal] = None
 
         # static vars
         self.autobuild_conf_dir = AUTOBUILD_CONF_DIR
@@ -121,8 +135,18 @@ class BuildCore(object):
             self.tree = args.acbs_tree[0]
         if args.acbs_tree_dir is not None:
             self.tree_dir = args.acbs_tree_dir[0]
+        if args.tree_cache:
+            acbs.treecache.configure(TREE_DIR, parse_size(args.tree_cache))
+        self.check_jobs()
         self.init()
 
+    def check_jobs(self) -> None:
+        # autobuild installs the build dependencies and the built packages by itself (outside of `repo_lock`),
+        # so the builds sharing the same system (even inside ciel) would fight over dpkg
+        # and change each other's environment, only the downloads can run in parallel
+        if self.jobs > 1 and not self.dl_only:
+            raise ValueError('Parallel builds (-j) are only supported when only downloading sources (-g)')
+
     def init(self) -> None:
         sys.excepthook = self.acbs_except_hdr
         print(full_line_banner(
@@ -184,6 +208,9 @@ class BuildCore(object):
             logging.info("Life-cycle: currently running in stage2 mode.")
         # begin finding and resolving dependencies
         logging.info('Searching and resolving dependencies...')
+        if self.rdeps_mode:
+            # the installed packages of the query are rebuilt too, they must be ordered as well
+            self.reorder = True
         acbs.pm.reorder_mode = self.reorder
         for n, i in enumerate(self.build_queue):
             i, modifiers = self.strip_modifiers(i)
@@ -195,6 +222,11 @@ class BuildCore(object):
             if not package:
                 raise RuntimeError(f'Could not find package {i}')
             packages.extend(package)
+        if self.rdeps_mode:
+            packages = self.find_rebuild_set(packages)
+            if not packages:
+                logging.info('No package depends on the requested packages')
+                return
         self.resolve_deps(packages, self.stage2)
         if not packages:
             logging.info('Nothing to do after dependency resolution')
@@ -209,31 +241,61 @@ class BuildCore(object):
             logging.info(
                 f'ACBS has saved your build queue to groups/{filename}')
             return
+        if self.rdeps_mode:
+            # a query only, use -p to save the results as a group
+            print(checkpoint_text(packages))
+            return
         try:
-            self.build_sequential(build_timings, packages)
+            self.build_packages(build_timings, packages)
         except Exception as ex:
             logging.exception(ex)
             self.save_checkpoint(build_timings, packages)
         print_build_timings(build_timings, [])
 
+    def find_rebuild_set(self, packages: List[ACBSPackageInfo]) -> List[ACBSPackageInfo]:
+        roots = [p.name for p in packages]
+        modifiers = '+stage2' if self.stage2 else ''
+        names = rebuild_set(roots, self.tree_dir, modifiers, self.rdeps_mode == 'rebuild-set')
+        logging.info(f'Found {len(names)} packages to rebuild')
+        if self.rdeps_mode == 'rebuild-set':
+            results = list(packages)
+            excluded = set()
+        else:
+            results = []
+            excluded = set(roots)
+        seen = {p.name for p in results}
+        for name in names:
+            if name in seen:
+                continue
+            # looking up a sub-package finds the whole group
+            for package in find_package(name, self.tree_dir, modifiers, self.tmp_dir):
+                if package.name in seen or package.name in excluded:
+                    continue
+                seen.add(package.name)
+                results.append(package)
+        return results
+
     def save_checkpoint(self, build_timings, packages):
         logging.info('ACBS is trying to save your build status...')
         shrink_wrap = ACBSShrinkWrap(
             self.package_cursor, build_timings, packages, self.no_deps)
         filename = do_shrink_wrap(shrink_wrap, '/tmp')
         logging.info(f'... saved to {filename}')
+        if self.journal:
+            # the check-point supersedes the journal
+            self.journal.close(remove=True)
+            self.journal = None
         raise RuntimeError(
             f'Build error.\nUse `acbs-build --resume {filename}` to resume after you sorted out the situation.')
 
     def reorder_deps(self, packages, stage2: bool):
         logging.info('Re-ordering packages...')
-        new_packages = []
-        package_names = [p.name for p in packages]
+        # the packages come from the first resolution: they are all parsed, and `pm.reorder_mode`
+        # already kept their installed dependencies, so neither the tree nor the package manager is queried again
+        package_names = {p.name for p in packages}
         for pkg in packages:
-            # prepare for re-order if necessary
-            logging.debug(f'Prepare for re-ordering: {pkg.name}')
-            new_packages.append(prepare_for_reorder(pkg, package_names))
-        graph = get_deps_graph(new_packages)
+            prepare_for_reorder(pkg, package_names)
+        graph = get_deps_graph(packages)
         return tarjan_search(graph, self.tree_dir, stage2)
 
     def filter_unbuildable(self, packages: List[ACBSPackageInfo]) -> List[ACBSPackageInfo]:
@@ -295,64 +357,168 @@ class BuildCore(object):
             check_package_groups(packages)
         return resolved
 
+    def build_packages(self, build_timings, packages: List[ACBSPackageInfo]):
+        self.journal = self.open_journal(build_timings, packages)
+        try:
+            if self.jobs > 1:
+                self.build_parallel(build_timings, packages)
+            else:
+                self.build_sequential(build_timings, packages)
+        except BaseException:
+            # keep the journal around in case saving the check-point fails too
+            if self.journal:
+                self.journal.close()
+            raise
+        if self.journal:
+            self.journal.close(remove=True)
+
+    def open_journal(self, build_timings, packages: List[ACBSPackageInfo]) -> Optional[BuildJournal]:
+        if self.dl_only or self.generate_pkg_metadata:
+            return None
+        try:
+            journal = BuildJournal(self.log_dir, packages, build_timings, self.no_deps)
+        except OSError as ex:
+            logging.warning(f'Unable to create the build journal: {ex}')
+            return None
+        logging.info(f'Recording the build progress to {journal.path}')
+        return journal
+
     def build_sequential(self, build_timings, packages: List[ACBSPackageInfo]):
+        prefetcher = None
+        if self.prefetch and not self.generate_pkg_metadata:
+            prefetcher = SourcePrefetcher(self.dump_dir, self.prefetch)
         # build process
-        for idx, task in enumerate(packages):
-            self.package_cursor += 1
-            logging.info(
-                f'Building {task.name} ({self.package_cursor}/{len(packages)})...')
-            source_name = task.name
-            if task.base_slug:
-                source_name = os.path.basename(task.base_slug)
-            if not has_stamp(task.build_location) and not self.generate_pkg_metadata:
+        try:
+            for idx, task in enumerate(packages):
+                self.package_cursor += 1
+                if prefetcher:
+                    # download the sources of the next packages while this one builds
+                    for upcoming in packages[idx:idx + self.prefetch + 1]:
+                        if not has_stamp(upcoming.build_location):
+                            prefetcher.schedule(upcoming.source_uri, self.get_source_name(upcoming))
+                logging.info(
+                    f'Building {task.name} ({self.package_cursor}/{len(packages)})...')
+                self.build_package(task, build_timings, packages[idx:], prefetcher=prefetcher)
+        finally:
+            if prefetcher:
+                prefetcher.shutdown()
+
+    def build_parallel(self, build_timings, packages: List[ACBSPackageInfo]):
+        scheduler = BuildScheduler(packages)
+        running: Dict = {}
+        failures: List[BaseException] = []
+        started = 0
+        logging.info(f'Building {len(packages)} packages using {self.jobs} jobs...')
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                while True:
+                    # stop scheduling new builds after a failure, but let the running ones finish
+                    if not failures:
+                        for idx in scheduler.take_ready():
+                            task = packages[idx]
+                            started += 1
+                            logging.info(f'Building {task.name} ({started}/{len(packages)})...')
+                            future = executor.submit(self.build_package, task, build_timings, None, True)
+                            running[future] = idx
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        idx = running.pop(future)
+                        error = future.exception()
+                        if error:
+                            logging.error(f'Failed to build {packages[idx].name}: {error}')
+                            scheduler.fail(idx)
+                            failures.append(error)
+                        else:
+                            scheduler.complete(idx)
+                            # the completed packages are moved to the front of the queue, see `rearrange_queue`
+                            self.package_cursor = len(scheduler.completed) + 1
+        except BaseException:
+            # e.g. interrupted, the check-point resumes from the packages that were not completed
+            self.rearrange_queue(scheduler, packages)
+            raise
+        if not failures:
+            return
+        remaining = self.rearrange_queue(scheduler, packages)
+        print_build_timings(build_timings, remaining)
+        raise failures[0]
+
+    def rearrange_queue(self, scheduler: BuildScheduler, packages: List[ACBSPackageInfo]) -> List[ACBSPackageInfo]:
+        """Move the completed packages to the front of the queue, so that the check-point resumes after them"""
+        skipped = set(scheduler.failed + scheduler.completed)
+        remaining = [packages[idx] for idx in scheduler.failed]
+        remaining.extend(p for idx, p in enumerate(packages) if idx not in skipped)
+        packages[:] = [packages[idx] for idx in scheduler.completed] + remaining
+        self.package_cursor = len(scheduler.completed) + 1
+        return remaining
+
+    def get_source_name(self, task: ACBSPackageInfo) -> str:
+        if task.base_slug:
+            return os.path.basename(task.base_slug)
+        return task.name
+
+    def build_package(self, task: ACBSPackageInfo, build_timings, pending: Optional[List[ACBSPackageInfo]],
+                      parallel: bool = False, prefetcher: Optional[SourcePrefetcher] = None):
+        source_name = self.get_source_name(task)
+        if not has_stamp(task.build_location) and not self.generate_pkg_metadata:
+            if prefetcher:
+                prefetcher.fetch(task.source_uri, source_name)
+            else:
                 fetch_source(task.source_uri, self.dump_dir, source_name)
-            if self.dl_only:
-                if self.generate:
-                    spec_location = os.path.join(
-                        task.script_location, '..', 'spec')
-                    is_legacy = is_spec_legacy(spec_location)
-                    checksum = generate_checksums(task.source_uri, is_legacy)
-                    write_checksums(spec_location, checksum)
-                    logging.info(f'Updated checksum for {task.name}')
-                build_timings.append((task.name, -1))
-                continue
-            if not task.build_location:
-                build_dir = make_build_dir(self.tmp_dir)
-                task.build_location = build_dir
+        if self.dl_only:
+            if self.generate:
+                spec_location = os.path.join(
+                    task.script_location, '..', 'spec')
+                is_legacy = is_spec_legacy(spec_location)
+                checksum = generate_checksums(task.source_uri, is_legacy)
+                write_checksums(spec_location, checksum)
+                logging.info(f'Updated checksum for {task.name}')
+            build_timings.append((task.name, -1))
+            return
+        if not task.build_location:
+            build_dir = make_build_dir(self.tmp_dir)
+            task.build_location = build_dir
+            if not self.generate_pkg_metadata:
+                process_source(task, source_name)
+        else:
+            # First sub-package in a meta-package
+            if not has_stamp(task.build_location):
                 if not self.generate_pkg_metadata:
                     process_source(task, source_name)
-            else:
-                # First sub-package in a meta-package
-                if not has_stamp(task.build_location):
-                    if not self.generate_pkg_metadata:
-                        process_source(task, source_name)
-                    Path(os.path.join(task.build_location, '.acbs-stamp')).touch()
-                build_dir = task.build_location
-            if task.subdir:
-                build_dir = os.path.join(build_dir, task.subdir)
-            else:
-                subdir = guess_subdir(build_dir)
-                if not subdir:
-                    raise RuntimeError(
-                        'Could not determine sub-directory, please specify manually.')
-                build_dir = os.path.join(build_dir, subdir)
-            if task.installables and not self.generate_pkg_metadata:
-                logging.info('Installing dependencies from repository...')
-                install_from_repo(task.installables, self.force_use_apt)
-            start = time.monotonic()
-            task_name = f'{task.name} ({task.bin_arch} @ {task.epoch + ":" if task.epoch else ""}{task.version}-{task.rel})'
-            try:
-                scoped_stage2 = ACBSPackageInfo.is_in_stage2(task.modifiers) | self.stage2
-                invoke_autobuild(task, build_dir, scoped_stage2, self.generate_pkg_metadata)
-                if not self.generate_pkg_metadata:
-                    check_artifact(task.name, build_dir)
-            except Exception:
-                # early printing of build summary before exploding
-                print_build_timings(build_timings, packages[idx:], time.monotonic() - start)
+                Path(os.path.join(task.build_location, '.acbs-stamp')).touch()
+            build_dir = task.build_location
+        if task.subdir:
+            build_dir = os.path.join(build_dir, task.subdir)
+        else:
+            subdir = guess_subdir(build_dir)
+            if not subdir:
                 raise RuntimeError(
-                    f'Build directory of the failed package: {build_dir}')
+                    'Could not determine sub-directory, please specify manually.')
+            build_dir = os.path.join(build_dir, subdir)
+        if task.installables and not self.generate_pkg_metadata:
+            logging.info('Installing dependencies from repository...')
+            with self.repo_lock:
+                install_from_repo(task.installables, self.force_use_apt)
+        start = time.monotonic()
+        task_name = f'{task.name} ({task.bin_arch} @ {task.epoch + ":" if task.epoch else ""}{task.version}-{task.rel})'
+        try:
+            scoped_stage2 = ACBSPackageInfo.is_in_stage2(task.modifiers) | self.stage2
+            invoke_autobuild(task, build_dir, scoped_stage2, self.generate_pkg_metadata, parallel)
             if not self.generate_pkg_metadata:
-                build_timings.append((task_name, time.monotonic() - start))
+                check_artifact(task.name, build_dir)
+        except Exception:
+            # early printing of build summary before exploding
+            if pending is not None:
+                print_build_timings(build_timings, pending, time.monotonic() - start)
+            raise RuntimeError(
+                f'Build directory of the failed package: {build_dir}')
+        if not self.generate_pkg_metadata:
+            timing = (task_name, time.monotonic() - start)
+            build_timings.append(timing)
+            if self.journal:
+                self.journal.record(task, timing)
+            with self.repo_lock:
                 ciel_invalidate_cache()
                 ciel_wait_for_refresh()
 
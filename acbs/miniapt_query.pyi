@@ -1,2 +1,6 @@
+from typing import List
+
 def apt_init_system() -> bool: ...
+def apt_invalidate_cache() -> None: ...
 def check_if_available(name : str) -> int: ...
+def check_if_available_batch(names : List[str]) -> List[int]: ...
@@ -1,4 +1,5 @@
 import configparser
+import hashlib
 import logging
 import os
 import re
@@ -6,12 +7,14 @@ from collections import OrderedDict
 from typing import Dict, List, Optional
 from urllib.parse import urlparse
 
-from acbs import bashvar
-from acbs.base import ACBSPackageInfo, ACBSSourceInfo
+from acbs import __version__, bashvar
+from acbs.base import ACBSPackageInfo, ACBSSourceInfo, package_from_dict, package_to_dict
+from acbs.cache import load_cache, store_cache
 from acbs.pm import filter_dependencies
 from acbs.utils import fail_arch_regex, get_arch_name, tarball_pattern
 
 generate_mode = False
+PARSE_CACHE_VERSION = 2
 
 
 def get_defines_file_path(location: str, stage2: bool) -> str:
@@ -76,6 +79,12 @@ def parse_fetch_options(options: str, acbs_source_info: ACBSSourceInfo):
             acbs_source_info.revision = v.strip()
         elif k == 'copy-repo':
             acbs_source_info.copy_repo = v.strip() == 'true'
+        elif k == 'export':
+            acbs_source_info.export = v.strip() == 'true'
+        elif k == 'depth':
+            if not v.strip().isdigit() or int(v) < 1:
+                raise ValueError(f'Invalid depth directive: {v}')
+            acbs_source_info.depth = int(v)
         elif k == 'submodule':
             translated = {
                 'false': 0,
@@ -119,19 +128,51 @@ def parse_package_url(var: Dict[str, str], ignore_empty_srcs: bool) -> List[ACBS
     return acbs_source_info
 
 
+def parse_cache_key(location: str, modifiers: str, defines: str, spec: str) -> str:
+    hash_obj = hashlib.new('sha256')
+    for part in (str(PARSE_CACHE_VERSION), __version__, arch, modifiers, str(generate_mode),
+                 os.path.realpath(location)):
+        hash_obj.update(part.encode('utf-8') + b'\0')
+    hash_obj.update(hashlib.sha256(defines.encode('utf-8')).digest())
+    hash_obj.update(hashlib.sha256(spec.encode('utf-8')).digest())
+    return hash_obj.hexdigest()
+
+
 def parse_package(location: str, modifiers: str) -> ACBSPackageInfo:
-    # Ignore (seemingly) empty srcs on unbuildable archs, if the package
-    # uses different sources for each (supported) architectures.
-    ignore_empty_srcs: bool = False
+    # dependency filtering depends on the system state, hence it's not cached
+    return filter_dependencies(parse_package_raw(location, modifiers))
+
+
+def parse_package_raw(location: str, modifiers: str) -> ACBSPackageInfo:
+    """Parse the package without filtering its dependencies (the installed packages are not consulted)"""
     logging.debug('Parsing {}...'.format(location))
     stage2 = ACBSPackageInfo.is_in_stage2(modifiers)
     # Call a helper function to check if there's a stage2 defines automatically
     defines_location = get_defines_file_path(location, stage2)
     spec_location = os.path.join(location, '..', 'spec')
     with open(defines_location, 'rt') as f:
-        var = bashvar.eval_bashvar(f.read(), filename=defines_location)
+        defines = f.read()
     with open(spec_location, 'rt') as f:
-        spec_var = bashvar.eval_bashvar(f.read(), filename=spec_location)
+        spec = f.read()
+    # the parsed results only depend on the file contents, the architecture and the modifiers
+    key = parse_cache_key(location, modifiers, defines, spec)
+    cached = load_cache('parsed', key)
+    if cached:
+        result = package_from_dict(cached)
+        result.script_location = location
+    else:
+        result = parse_package_inner(location, modifiers, defines, spec, defines_location, spec_location)
+        store_cache('parsed', key, package_to_dict(result))
+    return result
+
+
+def parse_package_inner(location: str, modifiers: str, defines: str, spec: str,
+                        defines_location: str, spec_location: str) -> ACBSPackageInfo:
+    # Ignore (seemingly) empty srcs on unbuildable archs, if the package
+    # uses different sources for each (supported) architectures.
+    ignore_empty_srcs: bool = False
+    var = bashvar.eval_bashvar(defines, filename=defines_location)
+    spec_var = bashvar.eval_bashvar(spec, filename=spec_location)
     fail_arch = var.get('FAIL_ARCH')
     fail_arch_re: Optional[re.Pattern] = None
     if fail_arch:
@@ -183,7 +224,7 @@ def parse_package(location: str, modifiers: str) -> ACBSPackageInfo:
         if k.startswith('__'):
             result.exported[k] = v
 
-    return filter_dependencies(result)
+    return result
 
 
 def get_deps_graph(packages: List[ACBSPackageInfo]) -> 'OrderedDict[str, ACBSPackageInfo]':
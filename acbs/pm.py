@@ -1,7 +1,8 @@
 import logging
+import os
 import re
 import subprocess
-from typing import Dict, List
+from typing import Dict, List, Optional, Set
 
 from acbs.base import ACBSPackageInfo
 from acbs.utils import get_arch_name
@@ -10,10 +11,16 @@ installed_cache: Dict[str, bool] = {}
 available_cache: Dict[str, bool] = {}
 use_native_bindings: bool = True
 reorder_mode: bool = False
+dpkg_status_file: str = '/var/lib/dpkg/status'
+apt_lists_dir: str = '/var/lib/apt/lists/'
+# in-memory indices of dpkg/apt databases, used when native bindings are not available
+installed_index: Optional[Set[str]] = None
+available_index: Optional[Set[str]] = None
 
 try:
-    from acbs.miniapt_query import apt_init_system
+    from acbs.miniapt_query import apt_init_system, apt_invalidate_cache
     from acbs.miniapt_query import check_if_available as apt_check_if_available
+    from acbs.miniapt_query import check_if_available_batch as apt_check_if_available_batch
     if not apt_init_system():
         raise ImportError('Initialization failure.')
 except ImportError:
@@ -23,6 +30,8 @@ except ImportError:
 def filter_dependencies(package: ACBSPackageInfo) -> ACBSPackageInfo:
     installables = []
     deps = []
+    # classify all the dependencies in one go, the checks below will then hit the caches
+    check_packages(package.deps)
     for dep in package.deps:
         if check_if_installed(dep):
             if reorder_mode:
@@ -66,6 +75,153 @@ def fix_pm_states(escaped: List[str]):
     raise RuntimeError('Unable to correct package manager states...')
 
 
+def record_native_state(name: str, result: int) -> bool:
+    if result == 0:
+        installed_cache[name] = True
+    elif result == 1:
+        installed_cache[name] = False
+        available_cache[name] = True
+    elif result == 2:
+        installed_cache[name] = False
+        available_cache[name] = False
+    else:
+        return False
+    return True
+
+
+def check_packages(names: List[str]):
+    """Query the states of multiple packages at once and fill the caches"""
+    pending = [name for name in dict.fromkeys(names) if installed_cache.get(name) is None]
+    if not pending:
+        return
+    if not use_native_bindings:
+        return check_packages_fallback(pending)
+    logging.debug('Checking %s packages using libapt-pkg' % len(pending))
+    results = apt_check_if_available_batch(pending)
+    if -4 in results:
+        fix_pm_states([])
+        invalidate_cache()
+        results = apt_check_if_available_batch(pending)
+    for name, result in zip(pending, results):
+        if not record_native_state(name, result):
+            raise RuntimeError(f'libapt-pkg binding returned error: {result}')
+
+
+def read_control_stanzas(path: str):
+    fields: Dict[str, str] = {}
+    with open(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                if fields:
+                    yield fields
+                fields = {}
+                continue
+            if line[0] in ' \t':
+                # continuation lines are not interesting to us
+                continue
+            key, _, value = line.partition(':')
+            fields[key] = value.strip()
+    if fields:
+        yield fields
+
+
+def load_installed_index() -> Optional[Set[str]]:
+    global installed_index
+    if installed_index is not None:
+        return installed_index
+    index = set()
+    try:
+        for stanza in read_control_stanzas(dpkg_status_file):
+            name = stanza.get('Package')
+            # `want flag status`: held or deselected packages are still installed
+            status = stanza.get('Status', '').split()
+            if not name or len(status) != 3 or status[2] != 'installed':
+                continue
+            index.add(name)
+            if stanza.get('Architecture'):
+                index.add(f'{name}:{stanza["Architecture"]}')
+    except OSError as ex:
+        logging.debug(f'Unable to read dpkg status: {ex}')
+        return None
+    installed_index = index
+    return installed_index
+
+
+def load_available_index() -> Optional[Set[str]]:
+    global available_index
+    if available_index is not None:
+        return available_index
+    index = set()
+    try:
+        lists = [e.path for e in os.scandir(apt_lists_dir) if e.name.endswith('_Packages')]
+        for path in lists:
+            for stanza in read_control_stanzas(path):
+                if stanza.get('Package'):
+                    index.add(stanza['Package'])
+    except OSError as ex:
+        logging.debug(f'Unable to read apt lists: {ex}')
+        return None
+    if not lists:
+        # compressed lists or unusual setups, let apt handle it
+        return None
+    available_index = index
+    return available_index
+
+
+def simulate_install(names: List[str]) -> bool:
+    try:
+        subprocess.check_output(
+            ['apt-get', 'install', '-s'] + names, stderr=subprocess.STDOUT, env={'DEBIAN_FRONTEND': 'noninteractive'})
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+def mark_installable(names: List[str]):
+    if simulate_install(names):
+        for name in names:
+            available_cache[name] = True
+        return
+    if len(names) == 1:
+        available_cache[names[0]] = False
+        return
+    # find out the culprit(s) by bisection
+    middle = len(names) // 2
+    mark_installable(names[:middle])
+    mark_installable(names[middle:])
+
+
+def check_packages_fallback(names: List[str]):
+    installed = load_installed_index()
+    available = load_available_index()
+    if installed is None or available is None:
+        return
+    logging.debug('Checking %s packages using dpkg/apt indices' % len(names))
+    candidates = []
+    for name in names:
+        installed_cache[name] = name in installed
+        if installed_cache[name] or available_cache.get(name) is not None:
+            continue
+        if name in available:
+            candidates.append(name)
+        else:
+            available_cache[name] = False
+    if candidates:
+        logging.debug('Checking if %s can be installed' % candidates)
+        mark_installable(candidates)
+
+
+def invalidate_cache():
+    """Forget the package states, needs to be called after installing packages"""
+    global installed_index, available_index
+    installed_cache.clear()
+    available_cache.clear()
+    installed_index = None
+    available_index = None
+    if use_native_bindings:
+        apt_invalidate_cache()
+
+
 def check_if_installed(name: str) -> bool:
     logging.debug('Checking if %s is installed' % name)
     cached = installed_cache.get(name)
@@ -74,22 +230,18 @@ def check_if_installed(name: str) -> bool:
     if use_native_bindings:
         logging.debug('... using libapt-pkg')
         result = apt_check_if_available(name)
-        if result == 0:
-            installed_cache[name] = True
-            return True
-        elif result == 1:
-            installed_cache[name] = False
-            available_cache[name] = True
-            return False
-        elif result == 2:
-            installed_cache[name] = False
-            available_cache[name] = False
-            return False
+        if record_native_state(name, result):
+            return result == 0
         elif result == -4:
             fix_pm_states([])
+            invalidate_cache()
             return check_if_installed(name)
         else:
             raise RuntimeError(f'libapt-pkg binding returned error: {result}')
+    installed = load_installed_index()
+    if installed is not None:
+        installed_cache[name] = name in installed
+        return installed_cache[name]
     try:
         subprocess.check_output(['dpkg', '-s', name], stderr=subprocess.STDOUT)
         installed_cache[name] = True
@@ -108,6 +260,13 @@ def check_if_available(name: str) -> bool:
         logging.debug('... using libapt-pkg')
         if apt_check_if_available(name) != 1:
             return False
+    available = None if use_native_bindings else load_available_index()
+    if available is not None:
+        if name in available:
+            mark_installable([name])
+        else:
+            available_cache[name] = False
+        return available_cache[name]
     try:
         subprocess.check_output(
             ['apt-cache', 'show', escape_package_name(name)], stderr=subprocess.STDOUT)
@@ -125,13 +284,11 @@ def install_from_repo(packages: List[str], force_use_apt=False):
     # FIXME: RISC-V build hosts is unreliable when using oma: random lock-ups
     # during `oma refresh'. Disabling oma to workaround potential lock-ups.
     if get_arch_name() == "riscv64" or force_use_apt:
-        return install_from_repo_apt(packages)
-
-    oma_is_success = install_from_repo_oma(packages)
-
-    if not oma_is_success:
         install_from_repo_apt(packages)
-
+    elif not install_from_repo_oma(packages):
+        install_from_repo_apt(packages)
+    # the package states are changed
+    invalidate_cache()
     return
 
 def install_from_repo_apt(packages: List[str]):
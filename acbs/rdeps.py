@@ -0,0 +1,134 @@
+'''
+Persistent reverse-dependency index of the abbs tree, used to find the packages to rebuild
+
+The index records the (unfiltered) dependencies of every package in the tree,
+and is refreshed incrementally using the modification times of the spec files.
+'''
+import hashlib
+import logging
+import os
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+import acbs.parser
+from acbs.base import ACBSPackageInfo
+from acbs.cache import load_cache, store_cache
+from acbs.index import get_tree_index
+from acbs.parser import get_defines_file_path, parse_package_raw
+
+RDEPS_VERSION = 1
+
+
+def spec_mtimes(location: str, stage2: bool) -> Optional[List[Any]]:
+    try:
+        return [os.stat(get_defines_file_path(location, stage2)).st_mtime_ns,
+                os.stat(os.path.join(location, '..', 'spec')).st_mtime_ns]
+    except OSError:
+        return None
+
+
+class ReverseDependencyIndex(object):
+    def __init__(self, search_path: str, modifiers: str) -> None:
+        self.search_path = search_path
+        self.modifiers = modifiers
+        # cat/pkg/autobuild or cat/group/01-sub -> [defines mtime, spec mtime, PKGNAME, [dependencies]]
+        self.entries: Dict[str, List[Any]] = {}
+        # package name -> names of the packages depending on it (derived from the entries above)
+        self.rdeps: Dict[str, List[str]] = {}
+
+    def cache_key(self) -> str:
+        # the dependencies depend on the architecture, and on the modifiers (stage2 defines)
+        hash_obj = hashlib.new('sha256')
+        for part in (os.path.realpath(self.search_path), acbs.parser.arch, self.modifiers):
+            hash_obj.update(part.encode('utf-8') + b'\0')
+        return hash_obj.hexdigest()
+
+    def locations(self) -> List[str]:
+        index = get_tree_index(self.search_path)
+        if not index.refreshed:
+            # every package of the tree is needed, including the uncommitted ones
+            index.refresh()
+        results = []
+        for rel, entry in index.entries.items():
+            if entry['flat']:
+                results.append(os.path.join(rel, 'autobuild'))
+            results.extend(os.path.join(rel, sub[0]) for sub in entry['subs'])
+        return results
+
+    def load(self) -> None:
+        data = load_cache('rdeps-index', self.cache_key())
+        old: Dict[str, List[Any]] = {}
+        if data and data.get('version') == RDEPS_VERSION:
+            old = data['entries']
+        stage2 = ACBSPackageInfo.is_in_stage2(self.modifiers)
+        locations = self.locations()
+        entries: Dict[str, List[Any]] = {}
+        parsed = 0
+        for n, rel in enumerate(locations):
+            location = os.path.join(self.search_path, rel)
+            mtimes = spec_mtimes(location, stage2)
+            if mtimes is None:
+                continue
+            cached = old.get(rel)
+            if cached and cached[:2] == mtimes:
+                entries[rel] = cached
+                continue
+            print(f'[{n + 1}/{len(locations)}] {rel:30}\r', end='', flush=True)
+            parsed += 1
+            try:
+                package = parse_package_raw(location, self.modifiers)
+                entries[rel] = mtimes + [package.name, package.deps]
+            except Exception as ex:
+                # broken packages are remembered as well, so that they are not parsed again until fixed
+                logging.debug(f'Unable to parse {rel}: {ex}')
+                entries[rel] = mtimes + [None, []]
+        if parsed:
+            print()
+            logging.debug(f'Parsed {parsed} packages to refresh the reverse dependency index')
+        self.entries = entries
+        if parsed or len(entries) != len(old):
+            store_cache('rdeps-index', self.cache_key(), {'version': RDEPS_VERSION, 'entries': entries})
+        self.build_reverse_map()
+
+    def build_reverse_map(self) -> None:
+        self.rdeps = {}
+        for _, _, name, deps in self.entries.values():
+            if not name:
+                continue
+            # a package might list the same dependency twice (e.g. in PKGDEP and BUILDDEP)
+            for dep in dict.fromkeys(deps):
+                if dep != name:
+                    self.rdeps.setdefault(dep, []).append(name)
+
+    def dependents(self, roots: Iterable[str]) -> List[str]:
+        """Names of the packages depending on the `roots`, directly or not (breadth-first order)"""
+        roots = list(roots)
+        seen = set(roots)
+        queue = deque(roots)
+        results = []
+        while queue:
+            for name in self.rdeps.get(queue.popleft(), ()):
+                if name in seen:
+                    continue
+                seen.add(name)
+                results.append(name)
+                queue.append(name)
+        return results
+
+
+def get_rdeps_index(search_path: str, modifiers: str) -> ReverseDependencyIndex:
+    index = ReverseDependencyIndex(search_path, modifiers)
+    index.load()
+    return index
+
+
+def rebuild_set(roots: List[str], search_path: str, modifiers: str, include_roots: bool) -> List[str]:
+    """
+    Find the packages to rebuild after the `roots` changed
+
+    :returns: the names of the dependents (after the roots if `include_roots` is set), not ordered yet
+    """
+    dependents = get_rdeps_index(search_path, modifiers).dependents(roots)
+    if include_roots:
+        return list(dict.fromkeys(roots)) + dependents
+    return dependents
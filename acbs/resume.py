@@ -1,14 +1,18 @@
+import json
 import logging
+import os
 import pickle
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple
 
 from acbs import __version__
 from acbs.base import ACBSPackageInfo, ACBSShrinkWrap
-from acbs.checkpoint import checkpoint_dpkg, checkpoint_spec, checkpoint_to_group
+from acbs.checkpoint import checkpoint_dpkg, checkpoint_specs, checkpoint_to_group, state_from_dict
 from acbs.const import TMP_DIR
 from acbs.find import find_package
+from acbs.journal import JOURNAL_SUFFIX, load_journal
 from acbs.main import BuildCore
-from acbs.pm import check_if_installed
+from acbs.parser import parse_package
+from acbs.pm import check_if_installed, check_packages
 from acbs.utils import make_build_dir, print_build_timings, print_package_names
 
 
@@ -30,15 +34,93 @@ def check_dpkg_state(state: ACBSShrinkWrap, packages: List[ACBSPackageInfo]) ->
     if checkpoint_dpkg() == state.dpkg_state:
         return True
     logging.warning('DPKG state change detected. Re-checking dependencies...')
-    for package in packages:
-        if not check_if_installed(package.name):
-            return False
+    names = [package.name for package in packages]
+    check_packages(names)
+    missing = [name for name in names if not check_if_installed(name)]
+    if missing:
+        logging.warning(f'Built packages not installed anymore: {", ".join(missing[:5])}')
+        return False
     return True
 
 
+def find_changed_packages(names: List[str], tree_dir: str, modifiers: str) -> Dict[str, List[ACBSPackageInfo]]:
+    results: Dict[str, List[ACBSPackageInfo]] = {}
+    for name in names:
+        if name in results:
+            continue
+        found = find_package(name, tree_dir, modifiers)
+        # looking up a sub-package finds the whole group
+        for package in found:
+            results.setdefault(package.name, found)
+        results[name] = found
+    return results
+
+
+def revalidate_packages(state: ACBSShrinkWrap, tree_dir: str, modifiers: str) -> Tuple[List[ACBSPackageInfo], int]:
+    """
+    Compare the spec states with the saved ones, the changed packages are looked up again
+
+    :returns: the new queue, and the position in the queue to resume from
+    """
+    # the packages recorded in a journal were built from the recorded specs
+    specs = state.sps[:state.journaled] + checkpoint_specs(state.packages[state.journaled:])
+    changed = [idx for idx, (saved, current) in enumerate(zip(state.sps, specs)) if saved != current]
+    new_cursor = min([state.cursor - 1] + changed[:1])
+    if not changed:
+        return list(state.packages), new_cursor
+    logging.info(f'{len(changed)} packages changed since the check-point')
+    found = find_changed_packages([state.packages[idx].name for idx in changed], tree_dir, modifiers)
+    packages: List[ACBSPackageInfo] = []
+    added: Set[int] = set()
+    changed_set = set(changed)
+    for idx, package in enumerate(state.packages):
+        if idx not in changed_set:
+            packages.append(package)
+            continue
+        replacement = found[package.name]
+        # the sub-packages of the same group share the same lookup result
+        if id(replacement) in added:
+            continue
+        added.add(id(replacement))
+        packages.extend(replacement)
+    return packages, new_cursor
+
+
 def do_load_checkpoint(name: str) -> ACBSShrinkWrap:
     with open(name, 'rb') as f:
-        return pickle.load(f)
+        content = f.read()
+    if content.startswith(b'\x80'):
+        # pickled by older versions of acbs
+        logging.warning('Loading a legacy check-point, the changes to the specs since then will not be detected!')
+        state = pickle.loads(content)
+        # the spec states were computed differently back then, and cannot be compared with the current ones:
+        # trust the cursor, as if all the packages had been recorded in a build journal
+        state.journaled = len(state.sps)
+        return state
+    try:
+        return state_from_dict(json.loads(content))
+    except (KeyError, TypeError, ValueError) as ex:
+        raise ValueError(f'{name} is not a valid check-point: {ex}')
+
+
+def rehydrate_package(stub: ACBSPackageInfo) -> ACBSPackageInfo:
+    # cheap if the package did not change, thanks to the parse cache
+    package = parse_package(stub.script_location, stub.modifiers)
+    package.base_slug = stub.base_slug
+    package.group_seq = stub.group_seq
+    return package
+
+
+def rehydrate_packages(packages: List[ACBSPackageInfo], stubs: Set[int]) -> List[ACBSPackageInfo]:
+    return [rehydrate_package(p) if id(p) in stubs else p for p in packages]
+
+
+def remove_checkpoint(filename: str):
+    # the build went through, the saved state is of no use anymore
+    try:
+        os.unlink(filename)
+    except OSError as ex:
+        logging.warning(f'Unable to remove {filename}: {ex}')
 
 
 def do_resume_checkpoint(filename: str, args):
@@ -48,50 +130,40 @@ def do_resume_checkpoint(filename: str, args):
             print_package_names(resumed_packages, 5)))
         build_timings = state.timings.copy()
         try:
-            builder.build_sequential(build_timings, resumed_packages)
+            builder.build_packages(build_timings, resumed_packages)
         except Exception as ex:
             # failed again?
             logging.exception(ex)
             builder.save_checkpoint(build_timings, resumed_packages)
-        print_build_timings(build_timings)
+        remove_checkpoint(filename)
+        print_build_timings(build_timings, [])
 
-    state = do_load_checkpoint(filename)
+    state = load_journal(filename) if filename.endswith(JOURNAL_SUFFIX) else do_load_checkpoint(filename)
     builder = BuildCore(args)
     stage2 = builder.stage2
     logging.info('Resuming from {}'.format(filename))
     if state.version != __version__:
-        logging.warning(
-            'The state was check-pointed with a different version of acbs!')
-        logging.warning('Undefined behavior might occur!')
+        logging.info(f'The state was check-pointed with acbs {state.version}')
+    # only the packages to be built are parsed again
+    stubs = {id(p) for p in state.packages}
     if state.no_deps:
-        leftover = state.packages[state.cursor-1:]
+        leftover = rehydrate_packages(state.packages[state.cursor-1:], stubs)
         logging.warning('Resuming without dependency resolution.')
         logging.info('Resumed. {} packages to go.'.format(len(leftover)))
-        builder.build_sequential(state.timings, leftover)
+        builder.build_packages(state.timings, leftover)
+        remove_checkpoint(filename)
         return
     logging.info('Validating status...')
     if len(state.packages) != len(state.sps):
         raise ValueError(
             'Inconsistencies detected in the saved state! The file might be corrupted.')
-    resumed_packages = []
-    new_cursor = state.cursor - 1
-    index = 0
-    for p, v in zip(state.packages, state.sps):
-        if checkpoint_spec(p) == v:
-            resumed_packages.append(p)
-            index += 1
-            continue
-        # the spec files changed
-        if index < new_cursor:
-            new_cursor = index
-        resumed_packages.extend(find_package(p.name, builder.tree_dir, '+stage2' if stage2 else ''))
-        # index doesn't matter now, since changes have been detected
+    resumed_packages, new_cursor = revalidate_packages(state, builder.tree_dir, '+stage2' if stage2 else '')
     if not check_dpkg_state(state, resumed_packages[:new_cursor]):
         name = checkpoint_to_group(
             resumed_packages[new_cursor:], builder.tree_dir)
         raise RuntimeError(
             'DPKG state mismatch. Unable to resume.\nACBS has created a new temporary group {} for you to continue.'.format(name))
-    resumed_packages = resumed_packages[new_cursor:]
+    resumed_packages = rehydrate_packages(resumed_packages[new_cursor:], stubs)
     # clear the build directory of the first package
     reassign_build_dir(resumed_packages)
     if new_cursor != (state.cursor - 1):
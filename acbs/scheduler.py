@@ -0,0 +1,58 @@
+'''
+Scheduling of the build queue over the dependency DAG, used by parallel builds
+'''
+from typing import Dict, List, Set
+
+from acbs.base import ACBSPackageInfo
+
+
+class BuildScheduler(object):
+    def __init__(self, packages: List[ACBSPackageInfo]) -> None:
+        self.packages = packages
+        # unfinished prerequisites of each package (by queue index)
+        self.waiting: List[Set[int]] = [set() for _ in packages]
+        self.dependents: List[List[int]] = [[] for _ in packages]
+        self.started: Set[int] = set()
+        self.completed: List[int] = []
+        self.failed: List[int] = []
+        self.build_edges()
+        self.ready: List[int] = [idx for idx, waiting in enumerate(self.waiting) if not waiting]
+
+    def build_edges(self) -> None:
+        positions: Dict[str, int] = {}
+        last_in_group: Dict[str, int] = {}
+        for idx, package in enumerate(self.packages):
+            # the queue is topologically sorted, so only earlier packages can be prerequisites
+            for dep in package.deps + package.installables:
+                pos = positions.get(dep)
+                if pos is not None:
+                    self.add_edge(pos, idx)
+            # sub-packages of a group share the build directory, build them one by one
+            if package.base_slug:
+                pos = last_in_group.get(package.base_slug)
+                if pos is not None:
+                    self.add_edge(pos, idx)
+                last_in_group[package.base_slug] = idx
+            positions.setdefault(package.name, idx)
+
+    def add_edge(self, prerequisite: int, dependent: int) -> None:
+        if prerequisite not in self.waiting[dependent]:
+            self.waiting[dependent].add(prerequisite)
+            self.dependents[prerequisite].append(dependent)
+
+    def take_ready(self) -> List[int]:
+        """Return the packages that can be started now (in queue order) and mark them as started"""
+        ready = sorted(self.ready)
+        self.ready = []
+        self.started.update(ready)
+        return ready
+
+    def complete(self, idx: int) -> None:
+        self.completed.append(idx)
+        for dependent in self.dependents[idx]:
+            self.waiting[dependent].discard(idx)
+            if not self.waiting[dependent]:
+                self.ready.append(dependent)
+
+    def fail(self, idx: int) -> None:
+        self.failed.append(idx)
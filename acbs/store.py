@@ -0,0 +1,250 @@
+'''
+Content-addressed storage of source files and garbage collection of the source cache (DUMP_DIR)
+
+Layout of the source cache:
+    objects/<algorithm>/<digest>  verified source files, keyed by their checksum
+    <url hash>                    downloaded files (hard links to the objects) and VCS mirrors
+    git-pool/                     objects shared by the git mirrors, see `acbs.gitpool`
+    .acbs-access.log              accesses to the entries, one `<time> <name>` record per line
+'''
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from acbs.crypto import HASH_SIDECAR_SUFFIX
+from acbs.gitpool import POOL_DIR, get_alternates
+
+OBJECTS_DIR = 'objects'
+ACCESS_LOG = '.acbs-access.log'
+ACCESS_LOCK = '.acbs-access.lock'
+# files attached to an entry, removed together with it
+ATTACHED_SUFFIXES = ('.dl', HASH_SIDECAR_SUFFIX)
+
+
+def object_path(dump_dir: str, chksum: Tuple[str, str]) -> Optional[str]:
+    hash_type, digest = chksum[0].lower(), chksum[1].lower()
+    if not digest or hash_type not in hashlib.algorithms_available or not re.fullmatch(r'[0-9a-f]+', digest):
+        return None
+    return os.path.join(dump_dir, OBJECTS_DIR, hash_type, digest)
+
+
+def link_object(obj: str, alias: str) -> bool:
+    """Make `alias` a hard link to the stored object `obj`"""
+    try:
+        if os.path.exists(alias):
+            if os.path.samefile(obj, alias) and not os.path.exists(alias + '.dl'):
+                return True
+            os.unlink(alias)
+        os.link(obj, alias)
+        if os.path.exists(alias + '.dl'):
+            os.unlink(alias + '.dl')
+        return True
+    except OSError as ex:
+        logging.debug(f'Unable to link {obj} to {alias}: {ex}')
+        return False
+
+
+def store_object(path: str, obj: str) -> None:
+    """Add a verified file to the store"""
+    if os.path.exists(obj):
+        return
+    try:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        os.link(path, obj)
+    except FileExistsError:
+        pass
+    except OSError as ex:
+        logging.debug(f'Unable to store {path} as {obj}: {ex}')
+
+
+@contextmanager
+def access_lock(dump_dir: str, exclusive: bool) -> Iterator[None]:
+    # held by the fetches (shared) while they write to the store and append to the log,
+    # the garbage collection (exclusive) waits for them before evicting entries and rewriting the log
+    with open(os.path.join(dump_dir, ACCESS_LOCK), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def touch_entries(dump_dir: str, paths: List[str]) -> None:
+    now = time.time()
+    records = ''.join(f'{now:.3f} {os.path.relpath(path, dump_dir)}\n' for path in paths)
+    try:
+        with access_lock(dump_dir, False):
+            # appending is cheap whatever the size of the store, the log is compacted by `collect_garbage`
+            with open(os.path.join(dump_dir, ACCESS_LOG), 'a') as f:
+                f.write(records)
+    except OSError as ex:
+        logging.debug(f'Unable to record access times: {ex}')
+
+
+def read_access_log(dump_dir: str) -> Dict[str, float]:
+    access: Dict[str, float] = {}
+    try:
+        with open(os.path.join(dump_dir, ACCESS_LOG), 'rt') as f:
+            for line in f:
+                timestamp, _, name = line.rstrip('\n').partition(' ')
+                try:
+                    access[name] = max(access.get(name, 0.0), float(timestamp))
+                except ValueError:
+                    # interrupted while appending
+                    continue
+    except OSError:
+        pass
+    return access
+
+
+def write_access_log(dump_dir: str, access: Dict[str, float]) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=dump_dir, prefix='.acbs-')
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            f.write(''.join(f'{timestamp:.3f} {name}\n' for name, timestamp in access.items()))
+        os.replace(tmp_path, os.path.join(dump_dir, ACCESS_LOG))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class StoreEntry(object):
+    def __init__(self) -> None:
+        # paths relative to the source cache
+        self.names: List[str] = []
+        self.size = 0
+        self.last_access = 0.0
+
+
+def tree_size(path: str, seen: set) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+def is_attached(dump_dir: str, name: str) -> bool:
+    basename = os.path.basename(name)
+    # book-keeping files of the store (and temporary files of `store_json`)
+    if basename.startswith('.acbs-'):
+        return True
+    # flags and checksum sidecars go with their files
+    return name.endswith(ATTACHED_SUFFIXES) and os.path.lexists(os.path.join(dump_dir, os.path.splitext(name)[0]))
+
+
+def scan_entries(dump_dir: str, access: Dict[str, float]) -> List[StoreEntry]:
+    # hard links (objects and their aliases) are accounted as one entry
+    by_inode: Dict[Tuple[int, int], StoreEntry] = {}
+    entries: List[StoreEntry] = []
+    seen: set = set()
+    candidates: List[str] = []
+    objects = os.path.join(dump_dir, OBJECTS_DIR)
+    if os.path.isdir(objects):
+        for algorithm in os.listdir(objects):
+            candidates.extend(os.path.join(OBJECTS_DIR, algorithm, digest)
+                              for digest in os.listdir(os.path.join(objects, algorithm)))
+    candidates.extend(name for name in os.listdir(dump_dir) if name not in (OBJECTS_DIR, POOL_DIR))
+    candidates = [name for name in candidates if not is_attached(dump_dir, name)]
+    for name in candidates:
+        path = os.path.join(dump_dir, name)
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino)
+        entry = by_inode.get(key)
+        if entry is None:
+            entry = StoreEntry()
+            entry.size = tree_size(path, seen) if os.path.isdir(path) else st.st_blocks * 512
+            by_inode[key] = entry
+            entries.append(entry)
+        entry.names.append(name)
+        entry.last_access = max(entry.last_access, access.get(name, st.st_mtime))
+        for suffix in ATTACHED_SUFFIXES:
+            if os.path.exists(path + suffix):
+                entry.names.append(name + suffix)
+                entry.size += os.lstat(path + suffix).st_blocks * 512
+    return merge_pools(dump_dir, entries, seen)
+
+
+def merge_pools(dump_dir: str, entries: List[StoreEntry], seen: set) -> List[StoreEntry]:
+    """The mirrors borrowing the objects of a shared pool are accounted (and evicted) together with the pool"""
+    pools = os.path.join(dump_dir, POOL_DIR)
+    if not os.path.isdir(pools):
+        return entries
+    by_objects: Dict[str, StoreEntry] = {}
+    results: List[StoreEntry] = []
+    for name in os.listdir(pools):
+        path = os.path.join(pools, name)
+        if not name.endswith('.git') or not os.path.isdir(path):
+            continue
+        entry = StoreEntry()
+        entry.names.append(os.path.join(POOL_DIR, name))
+        entry.size = tree_size(path, seen)
+        entry.last_access = os.stat(path).st_mtime
+        by_objects[os.path.realpath(os.path.join(path, 'objects'))] = entry
+        results.append(entry)
+    for entry in entries:
+        path = os.path.join(dump_dir, entry.names[0])
+        pool = None
+        if os.path.isdir(path) and not os.path.islink(path):
+            pool = next((by_objects[p] for p in map(os.path.realpath, get_alternates(path)) if p in by_objects), None)
+        if pool is None:
+            results.append(entry)
+            continue
+        pool.names.extend(entry.names)
+        pool.size += entry.size
+        pool.last_access = max(pool.last_access, entry.last_access)
+    return results
+
+
+def remove_entry(dump_dir: str, entry: StoreEntry) -> None:
+    for name in entry.names:
+        path = os.path.join(dump_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+
+def collect_garbage(dump_dir: str, max_size: int) -> Tuple[int, int]:
+    """
+    Evict the least recently used sources until the cache is not larger than `max_size` bytes
+
+    :returns: number of evicted entries and the size of the cache afterwards
+    """
+    with access_lock(dump_dir, True):
+        access = read_access_log(dump_dir)
+        entries = scan_entries(dump_dir, access)
+        total = sum(e.size for e in entries)
+        logging.info(f'Source cache: {len(entries)} entries, {total} bytes')
+        evicted = 0
+        kept: Dict[str, float] = {}
+        for entry in sorted(entries, key=lambda e: e.last_access):
+            if total > max_size:
+                logging.debug(f'Evicting {entry.names}...')
+                remove_entry(dump_dir, entry)
+                total -= entry.size
+                evicted += 1
+                continue
+            kept.update((name, access[name]) for name in entry.names if name in access)
+        # compact the log: one record per remaining entry
+        write_access_log(dump_dir, kept)
+    return evicted, total
+
+
+def parse_size(size: str) -> int:
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid size: {size}')
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    return int(float(match.group(1)) * units[match.group(2).upper()])
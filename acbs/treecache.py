@@ -0,0 +1,138 @@
+'''
+Cache of pristine extracted source trees, reused by the following builds of the same sources
+
+Layout of the cache directory:
+    <key>/  files extracted from one archive, keyed by its checksum and its name in the build directory
+    .lock   serializes the insertions and evictions (shared while copying the trees out)
+'''
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+from acbs.crypto import hash_url
+from acbs.store import tree_size
+from acbs.utils import clone_file, copy_tree
+
+# the cache is disabled unless a directory is set
+cache_dir: Optional[str] = None
+max_size = 0
+
+
+def configure(directory: str, size: int) -> None:
+    global cache_dir, max_size
+    cache_dir = directory
+    max_size = size
+
+
+def tree_key(chksum: Tuple[str, str], facade_name: str) -> Optional[str]:
+    hash_type, digest = chksum[0].lower(), chksum[1].lower()
+    # only verified sources can be identified by their checksum
+    if not digest or hash_type == 'none':
+        return None
+    return hash_url(f'{hash_type}:{digest}:{facade_name}')
+
+
+@contextmanager
+def cache_lock(directory: str, exclusive: bool) -> Iterator[None]:
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def merge_tree(src: str, dst: str) -> None:
+    """Copy the entries of `src` into `dst`, merging the directories present in both (like extracting an archive)"""
+    for name in os.listdir(src):
+        source = os.path.join(src, name)
+        target = os.path.join(dst, name)
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(os.readlink(source), target)
+        elif os.path.isdir(source):
+            if os.path.isdir(target) and not os.path.islink(target):
+                merge_tree(source, target)
+            else:
+                # the build scripts modify the files in place, so they must never be hard links to the cache
+                copy_tree(source, target)
+        else:
+            if os.path.lexists(target):
+                os.unlink(target)
+            clone_file(source, target)
+
+
+def restore_tree(entry: str, build_location: str) -> bool:
+    if not os.path.isdir(entry):
+        return False
+    merge_tree(entry, build_location)
+    # the modification time of the entry is its last access time
+    os.utime(entry)
+    return True
+
+
+def extract_cached(chksum: Tuple[str, str], facade_name: str, build_location: str,
+                   extract: Callable[[str, str], None]) -> bool:
+    """
+    Populate the build directory with the cached tree of the archive `facade_name`,
+    extracting the archive (with `extract(archive, cwd)`) into the cache first if needed
+
+    :returns: False if the cache is not usable for this archive
+    """
+    key = tree_key(chksum, facade_name)
+    if not cache_dir or not key:
+        return False
+    entry = os.path.join(cache_dir, key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with cache_lock(cache_dir, False):
+            if restore_tree(entry, build_location):
+                logging.info(f'Copied the extracted tree of {facade_name} from the cache')
+                return True
+        # extract on the same filesystem, so that the tree can be renamed into place
+        staging = tempfile.mkdtemp(dir=cache_dir, prefix='.acbs-')
+    except OSError as ex:
+        logging.warning(f'Unable to use the source tree cache: {ex}')
+        return False
+    try:
+        os.symlink(os.path.join(os.path.abspath(build_location), facade_name), os.path.join(staging, facade_name))
+        extract(facade_name, staging)
+        os.unlink(os.path.join(staging, facade_name))
+        with cache_lock(cache_dir, True):
+            if not os.path.isdir(entry):
+                os.rename(staging, entry)
+            restore_tree(entry, build_location)
+            evict_trees(cache_dir, max_size, entry)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return True
+
+
+def evict_trees(directory: str, size: int, keep: Optional[str] = None) -> int:
+    """Remove the least recently used trees until the cache is not larger than `size` bytes"""
+    entries = []
+    total = 0
+    seen: set = set()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        entry_size = tree_size(path, seen)
+        entries.append((os.stat(path).st_mtime, entry_size, path))
+        total += entry_size
+    evicted = 0
+    for _, entry_size, path in sorted(entries):
+        if total <= size:
+            break
+        if path == keep:
+            continue
+        logging.debug(f'Evicting the extracted tree {path}...')
+        shutil.rmtree(path)
+        total -= entry_size
+        evicted += 1
+    return evicted
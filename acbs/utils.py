@@ -1,4 +1,5 @@
 import datetime
+import fcntl
 import logging
 import os
 import re
@@ -7,7 +8,7 @@ import signal
 import subprocess
 import tempfile
 import time
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 from acbs import __version__
 from acbs.base import ACBSPackageInfo, ACBSSourceInfo
@@ -31,6 +32,8 @@ except ImportError:
 
 chksum_pattern = r"CHKSUM(?:S)?=['\"].*?['\"]"
 tarball_pattern = r'\.(tar\..+|cpio\..+)'
+# ioctl to share the data blocks of two files (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
 SIGNAMES = dict((k, v) for v, k in reversed(sorted(signal.__dict__.items()))
                 if v.startswith('SIG') and not v.startswith('SIG_'))
 
@@ -139,6 +142,37 @@ def guess_subdir(path: str) -> Optional[str]:
     return name
 
 
+def clone_file(src: str, dst: str) -> str:
+    """Copy a file, sharing the data blocks with the original when the filesystem supports reflinks"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+    if not cloned:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copy_tree(src: str, dst: str, can_link: Optional[Callable[[str], bool]] = None) -> None:
+    """
+    Copy a directory tree cheaply: files for which `can_link` (called with the path relative to `src`)
+    returns True are hard linked, the other ones are reflinked or copied
+    """
+    def copy_function(fsrc: str, fdst: str) -> str:
+        if can_link and can_link(os.path.relpath(fsrc, src)):
+            try:
+                os.link(fsrc, fdst)
+                return fdst
+            except OSError:
+                pass
+        return clone_file(fsrc, fdst)
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=copy_function)
+
+
 def has_stamp(path: str) -> bool:
     return os.path.exists(os.path.join(path, '.acbs-stamp'))
 
@@ -167,9 +201,27 @@ def start_build_capture(env: Dict[str, str], build_dir: str):
         if signal_status or exit_status:
             raise RuntimeError('autobuild4 did not exit successfully.')
         
+def start_build_batch(env: Dict[str, str], build_dir: str):
+    # non-interactive variant of `start_build_capture`, used when multiple builds run at the same time
+    with tempfile.NamedTemporaryFile(prefix='acbs-build_', suffix='.log', dir=build_dir, delete=False) as f:
+        logging.info(f'Build log: {f.name}')
+        header = f'!!ACBS Build Log\n!!Build start: {time.ctime()}\n'
+        f.write(header.encode())
+        f.flush()
+        process = subprocess.run(['autobuild'], env=env, cwd=build_dir,
+                                 stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT)
+        if process.returncode < 0:
+            footer = f'\n!!Build killed with {SIGNAMES[-process.returncode]}'
+        else:
+            footer = f'\n!!Build exited with {process.returncode}'
+        f.write(footer.encode())
+        if process.returncode:
+            raise RuntimeError('autobuild4 did not exit successfully.')
+
+
 def start_general_autobuild_metadata(env: Dict[str, str], script_location: str, package_name: str, build_dir: str):
     env["AB_WRITE_METADATA"] = "1"
-    process = pexpect.spawn('autobuild', args=["-p"], env=env, encoding='utf-8')
+    process = pexpect.spawn('autobuild', args=["-p"], env=env, encoding='utf-8', cwd=build_dir)
     process.expect(pexpect.EOF)
 
     path = ''
@@ -241,7 +293,8 @@ def check_artifact(name: str, build_dir: str):
         'STOP! Autobuild3 malfunction detected! Returned zero status with no artifact.')
 
 
-def invoke_autobuild(task: ACBSPackageInfo, build_dir: str, stage2: bool, generate_pkg_metadata: bool):
+def invoke_autobuild(task: ACBSPackageInfo, build_dir: str, stage2: bool, generate_pkg_metadata: bool,
+                     parallel: bool = False):
     dst_dir = os.path.join(build_dir, 'autobuild')
     if os.path.exists(dst_dir) and task.group_seq > 1:
         shutil.rmtree(dst_dir)
@@ -265,6 +318,15 @@ def invoke_autobuild(task: ACBSPackageInfo, build_dir: str, stage2: bool, genera
             f.write(f'PKGEPOCH=\'{task.epoch}\'')
     with open(os.path.join(build_dir, 'autobuild', 'extra-dpkg-control'), 'wt') as f:
         f.write(generate_metadata(task))
+    if parallel:
+        # the working directory is shared by all the threads, do not change it
+        if generate_pkg_metadata and build_logging:
+            start_general_autobuild_metadata(env_dict, task.script_location, task.name, build_dir)
+        elif generate_pkg_metadata:
+            subprocess.check_call(['autobuild'], env=env_dict, cwd=build_dir)
+        else:
+            start_build_batch(env_dict, build_dir)
+        return
     os.chdir(build_dir)
     if build_logging:
         if not generate_pkg_metadata:
@@ -32,6 +32,13 @@ complete -c acbs-build -s k -l skip-deps -d 'Skip dependency resolution'
 complete -c acbs-build -s g -l get -d 'Only download source packages without building'
 complete -c acbs-build -s e -l reorder -d 'Reorder the input build list so that it follows the dependency order'
 complete -c acbs-build -s p -l print-tasks -d 'Save the resolved build order to the group folder and exit (dry-run)'
+complete -x -c acbs-build -s j -l jobs -d 'Download the sources of up to N independent packages at the same time (with -g)'
+complete -x -c acbs-build -l prefetch -d 'Download the sources of the next N packages in the background'
+complete -c acbs-build -l gc -d 'Evict the least recently used sources from the cache directory'
+complete -x -c acbs-build -l max-size -d 'Target size of the cache directory for --gc'
+complete -x -c acbs-build -l tree-cache -d 'Reuse the extracted source trees, keeping up to SIZE of them'
+complete -c acbs-build -l rdeps -d 'List the packages depending on the given packages in build order'
+complete -c acbs-build -l rebuild-set -d 'List the given packages and their dependents in build order'
 complete -c acbs-build -n "__fish_contains_opt -s g get" -s w -l write -d 'Write spec changes back'
 complete -c acbs-build -s r -l resume -d 'Resume a previous build attempt' -a "(__fish_complete_suffix acbs-ckpt)"
 complete -c acbs-build -a "(__acbs_complete_package)"
@@ -6,11 +6,12 @@
 #include <apt-pkg/policy.h>
 #include <apt-pkg/cachefile.h>
 #include <apt-pkg/cacheset.h>
+#include <apt-pkg/depcache.h>
 
 #include "miniapt-query.h"
 
-static pkgPolicy *policy;
-static pkgCache *cache;
+// the cache is opened once and reused by all the queries until it's invalidated
+static pkgCacheFile *cachefile = NULL;
 static bool initialized = false;
 
 bool apt_init_system()
@@ -19,37 +20,111 @@ bool apt_init_system()
     return initialized;
 }
 
-int check_available(const char *name)
+void apt_invalidate_cache()
+{
+    if (cachefile) {
+        delete cachefile;
+        cachefile = NULL;
+    }
+}
+
+static int open_cache()
 {
     if (!initialized)
         return -1;
-    pkgCacheFile cachefile;
-    pkgDepCache *depCache = cachefile.GetDepCache();
-    if (!depCache)
-        return -1;
-    cache = cachefile.GetPkgCache();
-    if (!cache)
-        return -2;
-    policy = cachefile.GetPolicy();
-    if (!policy)
-        return -3;
-    if (cachefile->BrokenCount() > 0)
+    if (cachefile)
+        return 0;
+    cachefile = new pkgCacheFile();
+    int result = 0;
+    if (!cachefile->GetDepCache())
+        result = -1;
+    else if (!cachefile->GetPkgCache())
+        result = -2;
+    else if (!cachefile->GetPolicy())
+        result = -3;
+    if (result)
+        apt_invalidate_cache();
+    return result;
+}
+
+// roll back a simulated installation: only the package and the dependencies it pulled in are marked
+static void unmark_install(pkgDepCache *depCache, const pkgCache::PkgIterator &Pkg)
+{
+    std::vector<pkgCache::PkgIterator> todo(1, Pkg);
+    while (!todo.empty())
+    {
+        pkgCache::PkgIterator P = todo.back();
+        todo.pop_back();
+        if (!(*depCache)[P].Install())
+            continue;
+        pkgCache::VerIterator Ver = (*depCache)[P].InstVerIter(*depCache);
+        // un-marking first also stops the walk on dependency loops
+        depCache->MarkKeep(P, false, false);
+        for (pkgCache::DepIterator D = Ver.DependsList(); !D.end(); ++D)
+        {
+            pkgCache::PkgIterator Target = D.TargetPkg();
+            todo.push_back(Target);
+            for (pkgCache::PrvIterator Prv = Target.ProvidesList(); !Prv.end(); ++Prv)
+                todo.push_back(Prv.OwnerPkg());
+        }
+    }
+}
+
+static int check_available_inner(const char *name)
+{
+    pkgDepCache *depCache = cachefile->GetDepCache();
+    if ((*cachefile)->BrokenCount() > 0)
         return -4;
 
     APT::CacheSetHelper helper(true, GlobalError::NOTICE);
     const char *list[2] = {name, NULL};
-    APT::PackageList pkgset = APT::PackageList::FromCommandLine(cachefile, list, helper);
+    APT::PackageList pkgset = APT::PackageList::FromCommandLine(*cachefile, list, helper);
     // returns 0: installed; 1: not installed, available; 2: not installed, not available
+    int result = 2;
     for (APT::PackageList::const_iterator Pkg = pkgset.begin(); Pkg != pkgset.end(); ++Pkg)
     {
         if (Pkg->CurrentVer != 0) {
-            return 0;
+            result = 0;
+            break;
         }
         if (depCache->GetCandidateVersion(Pkg)) {
-            if (depCache->MarkInstall(Pkg, true, 0, true)) {
-                return 1;
+            bool installable = depCache->MarkInstall(Pkg, true, 0, true);
+            unmark_install(depCache, Pkg);
+            if (installable) {
+                result = 1;
+                break;
             }
         }
     }
-    return 2;
+    // should never happen, but rebuilding the whole state is always correct
+    if (depCache->InstCount() || depCache->DelCount() || depCache->BrokenCount())
+        depCache->Init(NULL);
+    return result;
+}
+
+int check_available(const char *name)
+{
+    int result = open_cache();
+    if (result)
+        return result;
+    pkgDepCache::ActionGroup group(*cachefile->GetDepCache());
+    return check_available_inner(name);
+}
+
+std::vector<int> check_available_batch(const std::vector<std::string> &names)
+{
+    std::vector<int> results;
+    results.reserve(names.size());
+    int status = open_cache();
+    if (status) {
+        results.assign(names.size(), status);
+        return results;
+    }
+    // the automatically installed packages are only swept once, after the whole batch
+    pkgDepCache::ActionGroup group(*cachefile->GetDepCache());
+    for (std::vector<std::string>::const_iterator name = names.begin(); name != names.end(); ++name)
+    {
+        results.push_back(check_available_inner(name->c_str()));
+    }
+    return results;
 }
@@ -1,10 +1,18 @@
+#include <string>
+#include <vector>
+
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 
 int check_available(const char *name);
+std::vector<int> check_available_batch(const std::vector<std::string> &names);
+void apt_invalidate_cache();
 bool apt_init_system();
 
 PYBIND11_MODULE(miniapt_query, m) {
     m.doc() = "Query if a package exists in the repository";
     m.def("apt_init_system", &apt_init_system, "Initialize system cache");
+    m.def("apt_invalidate_cache", &apt_invalidate_cache, "Drop the cached package database (e.g. after installing packages)");
     m.def("check_if_available", &check_available, "Check if a package exists in the repository");
+    m.def("check_if_available_batch", &check_available_batch, "Check if the packages exist in the repository");
 }
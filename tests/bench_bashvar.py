@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+Compare the fast path and the pyparsing path of acbs.bashvar
+
+Usage: python3 tests/bench_bashvar.py [number of synthetic files]
+'''
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from acbs.bashvar import FastEvaluator, eval_bashvar_pyparsing  # noqa: E402
+
+DEFINES_TEMPLATE = '''PKGNAME=pkg-{n}
+PKGSEC=libs
+PKGDES="Synthetic package number {n}"
+PKGDEP="glibc pkg-{dep} python-3"
+BUILDDEP="cmake ninja"
+PKGDEP__AMD64="${{PKGDEP}} nasm"
+# comments should be skipped
+ABSHADOW=0
+AUTOTOOLS_AFTER="--enable-foo \\
+                 --disable-bar"
+'''
+
+SPEC_TEMPLATE = '''VER=1.{n}.0
+REL=1
+SRCS="tbl::https://example.com/pkg-{n}/pkg-${{VER}}.tar.xz \\
+      git::commit=tags/v${{VER//./_}}::https://example.com/pkg-{n}.git"
+CHKSUMS="sha256::{checksum} SKIP"
+CHKUPDATE="anitya::id={n}"
+__SHORTVER=${{VER%.0}}
+'''
+
+
+def make_synthetic_tree(path: str, count: int):
+    files = []
+    for n in range(count):
+        template = DEFINES_TEMPLATE if n % 2 else SPEC_TEMPLATE
+        name = os.path.join(path, f'{n}.sh')
+        with open(name, 'wt') as f:
+            f.write(template.format(n=n, dep=n // 2, checksum=f'{n:064x}'))
+        files.append(name)
+    return files
+
+
+def read_corpus(files):
+    corpus = []
+    for name in files:
+        with open(name, 'rt') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def bench(label: str, corpus):
+    results = {}
+    for name, func in (('fast path', lambda s: FastEvaluator(s).evaluate()),
+                       ('pyparsing', eval_bashvar_pyparsing)):
+        start = time.perf_counter()
+        outputs = [func(source) for source in corpus]
+        results[name] = (time.perf_counter() - start, outputs)
+    if results['fast path'][1] != results['pyparsing'][1]:
+        raise RuntimeError(f'{label}: results differ between the two paths!')
+    fast = results['fast path'][0]
+    slow = results['pyparsing'][0]
+    print(f'{label:>24}: {len(corpus):6} files, fast path {fast:8.3f}s, pyparsing {slow:8.3f}s, speed-up {slow / fast:6.1f}x')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    fixtures = os.path.join(os.path.dirname(__file__), 'fixtures')
+    fixture_files = [os.path.join(root, name) for root, _, names in os.walk(fixtures) for name in names]
+    warnings.simplefilter('ignore')
+    # build the pyparsing grammar outside of the measurements
+    eval_bashvar_pyparsing('')
+    bench('tests/fixtures', read_corpus(fixture_files))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bench('synthetic tree', read_corpus(make_synthetic_tree(tmpdir, count)))
+
+
+if __name__ == '__main__':
+    main()
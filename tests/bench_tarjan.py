@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''
+Compare the iterative Tarjan's algorithm in acbs.deps with the previous recursive implementation
+
+Usage: python3 tests/bench_tarjan.py [number of synthetic packages]
+'''
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('ARCH', 'amd64')
+
+import acbs.deps  # noqa: E402
+from acbs.base import ACBSPackageInfo  # noqa: E402
+from acbs.parser import check_buildability  # noqa: E402
+
+
+def make_synthetic_graph(count: int) -> 'OrderedDict[str, ACBSPackageInfo]':
+    rng = random.Random(count)
+    packages: 'OrderedDict[str, ACBSPackageInfo]' = OrderedDict()
+    for n in range(count):
+        # mostly depend on "older" packages, with a long chain through the whole tree and a few loops
+        deps = [f'pkg-{rng.randrange(n)}' for _ in range(rng.randrange(6))] if n else []
+        if n:
+            deps.append(f'pkg-{n - 1}')
+        if n % 500 == 499:
+            deps.append(f'pkg-{n - rng.randrange(1, 50)}')
+        if n % 1000 == 0:
+            deps.append(f'pkg-{min(count - 1, n + 1)}')
+        packages[f'pkg-{n}'] = ACBSPackageInfo(f'pkg-{n}', deps, '', [])
+    # build the newest packages first, like a world rebuild listing the tree in reverse
+    return OrderedDict(reversed(packages.items()))
+
+
+def reference_tarjan(packages):
+    # the previous recursive implementation (without the package discovery)
+    lowlink = defaultdict(lambda: -1)
+    index = defaultdict(lambda: -1)
+    stackstate = defaultdict(bool)
+    stack = deque()
+    results = []
+
+    def visit(vert, depth):
+        index[vert] = lowlink[vert] = depth
+        depth += 1
+        stackstate[vert] = True
+        stack.append(vert)
+        print(f'[{len(results) + 1}/{len(packages)}] {vert:30}\r', end='', flush=True)
+        check_buildability(packages[vert], stack[-2] if len(stack) > 1 else '<unknown>')
+        for p in packages[vert].deps:
+            if index[p] == -1:
+                visit(p, depth)
+                lowlink[vert] = min(lowlink[p], lowlink[vert])
+            elif stackstate[p] is True:
+                lowlink[vert] = min(lowlink[p], index[vert])
+        if lowlink[vert] == index[vert]:
+            result, w = [], ''
+            while w != vert:
+                w = stack.pop()
+                result.append(packages[w])
+                stackstate[w] = False
+            results.append(result)
+
+    for name in packages:
+        if index[name] == -1:
+            visit(name, 0)
+    return results
+
+
+def run_deep(func):
+    # the recursive implementation needs a large stack for the long chains
+    result = []
+    sys.setrecursionlimit(1 << 20)
+    threading.stack_size(512 * 1024 * 1024)
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    packages = make_synthetic_graph(count)
+    start = time.perf_counter()
+    expected = run_deep(lambda: reference_tarjan(packages))
+    recursive = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = acbs.deps.tarjan_search(packages, '.', stage2=False)
+    iterative = time.perf_counter() - start
+    print()
+    if [[p.name for p in scc] for scc in actual] != [[p.name for p in scc] for scc in expected]:
+        raise RuntimeError('results differ between the two implementations!')
+    edges = sum(len(p.deps) for p in packages.values())
+    print(f'{count} packages, {edges} dependencies, {len(actual)} SCCs')
+    print(f'recursive {recursive:8.3f}s, iterative {iterative:8.3f}s, speed-up {recursive / iterative:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
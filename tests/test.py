@@ -1,14 +1,48 @@
+import hashlib
+import http.server
+import os
+import pickle
+import random
+import shutil
+import sys
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock
+from collections import OrderedDict
+import warnings
 
+import acbs.bashvar
+import acbs.cache
+import acbs.checkpoint
+import acbs.crypto
+import acbs.deps
+import acbs.download
+import acbs.fetch
+import acbs.gitpool
+import acbs.journal
+import acbs.main
 import acbs.find
+import acbs.index
 import acbs.parser
+import acbs.store
+import acbs.treecache
 import acbs.pm
+import acbs.rdeps
+import acbs.resume
+from acbs.base import ACBSPackageInfo, ACBSShrinkWrap, ACBSSourceInfo, package_to_dict
 from acbs.const import TMP_DIR
 from acbs.deps import tarjan_search
+from acbs.main import BuildCore
 from acbs.parser import get_deps_graph, parse_url_schema
+from acbs.scheduler import BuildScheduler
 from acbs.utils import fail_arch_regex, guess_extension_name, make_build_dir
 
+# do not touch the system-wide caches during testing
+acbs.cache.cache_dir = tempfile.mkdtemp(prefix='acbs-test-')
+
 
 def fake_pm(package):
     return package
@@ -106,6 +140,25 @@ class TestParser(unittest.TestCase):
         info = parse_url_schema('tbl::use-url-name=true::https://example.com/test.tar.gz;p=123?test=ok#fragment', 'sha256::123')
         self.assertEqual(info.type, 'tarball')
         self.assertEqual(info.source_name, 'test.tar.gz')
+        info = parse_url_schema('git::commit=tags/v1;depth=1::https://github.com/AOSC-Dev/acbs', 'SKIP')
+        self.assertEqual(info.revision, 'tags/v1')
+        self.assertEqual(info.depth, 1)
+        with self.assertRaises(ValueError):
+            parse_url_schema('git::depth=none::https://github.com/AOSC-Dev/acbs', 'SKIP')
+        self.assertFalse(parse_url_schema('svn::https://example.com/svn', 'SKIP').export)
+        self.assertTrue(parse_url_schema('hg::export=true;commit=abcdef::https://example.com/hg', 'SKIP').export)
+
+    def test_parse_cache(self):
+        acbs.parser.arch = 'arch'
+        acbs.parser.filter_dependencies = fake_pm
+        package = acbs.parser.parse_package(
+            './tests/fixtures/test-4/autobuild', modifiers='+stage2')
+        with unittest.mock.patch('acbs.bashvar.eval_bashvar') as eval_mock:
+            cached = acbs.parser.parse_package(
+                './tests/fixtures/test-4/autobuild', modifiers='+stage2')
+            eval_mock.assert_not_called()
+        self.assertEqual(package_to_dict(package), package_to_dict(cached))
+        self.assertEqual(cached.source_uri[1].url, 'https://github.com/AOSC-Dev/acbs')
 
     def test_parse_new_spec(self):
         acbs.parser.arch = 'none'
@@ -118,6 +171,45 @@ class TestParser(unittest.TestCase):
         self.assertEqual(package.source_uri[1].type, 'git')
 
 
+class TestBashvar(unittest.TestCase):
+    samples = [
+        'A=1\nB="${A}2"\nB+=\'3\'\n',
+        '  # comment\nVER=1.2.3\nSRCS="tbl::https://example.com/a-$VER.tar.xz"  # trailing\n',
+        'V=abcdef\nA=${V:1:3}${V: -2}${V:2:-1}\nB=${V/cd/x}${V//c}${V/#ab/z}${V/%ef/y}\nC=${V#ab}${V%%ef}\n',
+        'A="multi \\\n line \\$ \\" \\\\"\nB=\'a\tb\'\nC=$UNDEF\n',
+    ]
+
+    def test_fast_path(self):
+        sources = list(self.samples)
+        for root, _, files in os.walk('./tests/fixtures'):
+            for name in files:
+                with open(os.path.join(root, name), 'rt') as f:
+                    sources.append(f.read())
+        for source in sources:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.assertEqual(
+                    acbs.bashvar.FastEvaluator(source).evaluate(),
+                    acbs.bashvar.eval_bashvar_pyparsing(source))
+
+    def test_fast_path_fallback(self):
+        for source in ['A=1 B=2\n', '#\n', 'A="${B:-1}"\n', 'A=`echo`\n', 'export A=1\n']:
+            with self.assertRaises(acbs.bashvar.ParseError):
+                acbs.bashvar.FastEvaluator(source).evaluate()
+        self.assertEqual(acbs.bashvar.eval_bashvar('A="${B:-1}"\n'), {'A': '1'})
+
+    def test_bash_evaluator(self):
+        evaluator = acbs.bashvar.get_bash_evaluator()
+        self.assertEqual(acbs.bashvar.eval_bashvar_ext('A=$(echo 1)\nB="a\nb"\n'), {'A': '1', 'B': 'a\nb'})
+        # files are evaluated in separate subshells of the same co-process
+        self.assertEqual(acbs.bashvar.eval_bashvar_ext('C=${A:-2}\nprintf x\n'), {'C': 'x2'})
+        self.assertIs(acbs.bashvar.get_bash_evaluator(), evaluator)
+        with warnings.catch_warnings(record=True) as wns:
+            warnings.simplefilter('always')
+            self.assertEqual(acbs.bashvar.eval_bashvar_ext('A=1\nif then\n'), {})
+        self.assertTrue(any(issubclass(w.category, acbs.bashvar.BashErrorWarning) for w in wns))
+
+
 class TestSearching(unittest.TestCase):
     def test_basic_find(self):
         result, _ = find_package_generic('test-1')
@@ -143,6 +235,1006 @@ class TestSearching(unittest.TestCase):
         self.assertEqual(len(result), 2)
 
 
+class TestTreeIndex(unittest.TestCase):
+    def setUp(self):
+        self.tree = tempfile.mkdtemp(prefix='acbs-tree-')
+        shutil.copytree('./tests/fixtures', os.path.join(self.tree, 'fixtures'))
+        acbs.index.indices.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tree)
+        acbs.index.indices.clear()
+
+    def test_lookup(self):
+        self.assertEqual(acbs.index.lookup_package('test-1', self.tree), ('package', 'fixtures/test-1'))
+        self.assertEqual(acbs.index.lookup_package('test-2', self.tree), ('group', 'fixtures/test-2'))
+        self.assertEqual(acbs.index.lookup_package('sub-2', self.tree), ('sub', 'fixtures/test-2/02-sub-2'))
+        self.assertIsNone(acbs.index.lookup_package('test-9', self.tree))
+
+    def test_persisted_index_refresh(self):
+        acbs.index.lookup_package('sub-1', self.tree)
+        acbs.index.indices.clear()
+        # rename the sub-package behind the back of the (persisted) index
+        defines = os.path.join(self.tree, 'fixtures/test-2/01-sub-1/defines')
+        with open(defines, 'wt') as f:
+            f.write('PKGNAME=sub-3\n')
+        os.utime(defines, ns=(0, 0))
+        self.assertIsNone(acbs.index.lookup_package('sub-1', self.tree))
+        self.assertEqual(acbs.index.lookup_package('sub-3', self.tree), ('sub', 'fixtures/test-2/01-sub-1'))
+
+    def test_empty_group_shadowing_subpackage(self):
+        # an (empty) group named like a sub-package of another group
+        os.makedirs(os.path.join(self.tree, 'extra/sub-1'))
+        with open(os.path.join(self.tree, 'extra/sub-1/spec'), 'wt') as f:
+            f.write('VER=1\n')
+        index = acbs.index.get_tree_index(self.tree)
+        # make sure the group comes first, whatever the directory order is
+        index.groups['sub-1'] = (0, index.groups['sub-1'][1])
+        self.assertEqual(acbs.index.lookup_package('sub-1', self.tree), ('group', 'extra/sub-1'))
+        acbs.parser.arch = 'none'
+        acbs.parser.filter_dependencies = fake_pm
+        with unittest.mock.patch('acbs.find.make_build_dir', return_value='/tmp/'):
+            result = acbs.find.find_package('sub-1', self.tree, '')
+        self.assertEqual([p.name for p in result], ['sub-1', 'sub-2'])
+
+
+class TestPackageManager(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-pm-')
+        with open(os.path.join(self.root, 'status'), 'wt') as f:
+            f.write('Package: bash\nStatus: install ok installed\nArchitecture: amd64\n'
+                    'Description: shell\n long description\n\n'
+                    'Package: removed\nStatus: deinstall ok config-files\n\n'
+                    'Package: held\nStatus: hold ok installed\n\n'
+                    'Package: deselected\nStatus: deinstall ok installed\n')
+        lists = os.path.join(self.root, 'lists')
+        os.mkdir(lists)
+        with open(os.path.join(lists, 'repo_dists_stable_main_binary-amd64_Packages'), 'wt') as f:
+            f.write('Package: bash\n\nPackage: zlib\n\nPackage: broken\n\nPackage: removed\n')
+        self.saved = (acbs.pm.use_native_bindings, acbs.pm.dpkg_status_file, acbs.pm.apt_lists_dir)
+        acbs.pm.use_native_bindings = False
+        acbs.pm.dpkg_status_file = os.path.join(self.root, 'status')
+        acbs.pm.apt_lists_dir = lists
+        acbs.pm.invalidate_cache()
+
+    def tearDown(self):
+        acbs.pm.use_native_bindings, acbs.pm.dpkg_status_file, acbs.pm.apt_lists_dir = self.saved
+        acbs.pm.invalidate_cache()
+        shutil.rmtree(self.root)
+
+    def test_batched_fallback(self):
+        def simulate(names):
+            return 'broken' not in names
+        with unittest.mock.patch('acbs.pm.simulate_install', side_effect=simulate) as simulate_mock:
+            acbs.pm.check_packages(['bash', 'zlib', 'removed', 'broken', 'missing'])
+            self.assertTrue(acbs.pm.check_if_installed('bash'))
+            self.assertFalse(acbs.pm.check_if_installed('removed'))
+            self.assertTrue(acbs.pm.check_if_installed('held'))
+            self.assertTrue(acbs.pm.check_if_installed('deselected'))
+            self.assertTrue(acbs.pm.check_if_available('zlib'))
+            self.assertTrue(acbs.pm.check_if_available('removed'))
+            self.assertFalse(acbs.pm.check_if_available('broken'))
+            self.assertFalse(acbs.pm.check_if_available('missing'))
+            # one call for all the candidates, then bisection to find the broken one
+            self.assertEqual(simulate_mock.call_args_list[0][0][0], ['zlib', 'removed', 'broken'])
+
+
+class TestMiniapt(unittest.TestCase):
+    def setUp(self):
+        try:
+            import acbs.miniapt_query
+        except ImportError:
+            self.skipTest('the native bindings are not built')
+        if not acbs.miniapt_query.apt_init_system():
+            self.skipTest('apt is not usable on this system')
+        self.miniapt = acbs.miniapt_query
+
+    def test_batch(self):
+        names = ['dpkg', 'acbs-no-such-package', 'apt-doc', 'dpkg']
+        expected = [self.miniapt.check_if_available(name) for name in names]
+        self.assertEqual(expected[0], 0)
+        self.assertEqual(expected[1], 2)
+        # the simulated installations are rolled back, so the results never depend on the previous queries
+        self.assertEqual(self.miniapt.check_if_available_batch(names), expected)
+        self.assertEqual(self.miniapt.check_if_available_batch(list(reversed(names))), list(reversed(expected)))
+
+
+def make_queue(*specs):
+    packages = []
+    for name, deps, base_slug in specs:
+        package = ACBSPackageInfo(name, deps, '', [])
+        package.base_slug = base_slug
+        packages.append(package)
+    return packages
+
+
+def reference_tarjan(packages):
+    # the previous recursive implementation (without the package discovery)
+    index, lowlink, stackstate, stack, results = {}, {}, {}, [], []
+
+    def visit(vert, depth):
+        index[vert] = lowlink[vert] = depth
+        depth += 1
+        stackstate[vert] = True
+        stack.append(vert)
+        for p in packages[vert].deps:
+            if index.get(p, -1) == -1:
+                visit(p, depth)
+                lowlink[vert] = min(lowlink[p], lowlink[vert])
+            elif stackstate.get(p):
+                lowlink[vert] = min(lowlink[p], index[vert])
+        if lowlink[vert] == index[vert]:
+            result, w = [], ''
+            while w != vert:
+                w = stack.pop()
+                result.append(packages[w])
+                stackstate[w] = False
+            results.append(result)
+
+    for name in packages:
+        if index.get(name, -1) == -1:
+            visit(name, 0)
+    return results
+
+
+class TestTarjan(unittest.TestCase):
+    def setUp(self):
+        acbs.parser.arch = 'none'
+        acbs.deps.pool.clear()
+
+    def tearDown(self):
+        acbs.deps.pool.clear()
+
+    def make_graph(self, rng, count, degree):
+        packages = OrderedDict()
+        for n in range(count):
+            deps = [f'p{rng.randrange(count)}' for _ in range(rng.randrange(degree + 1))]
+            packages[f'p{n}'] = ACBSPackageInfo(f'p{n}', deps, '', [])
+        return packages
+
+    def test_same_order(self):
+        rng = random.Random(42)
+        for count, degree in ((1, 1), (10, 2), (50, 3), (200, 1), (200, 4)):
+            packages = self.make_graph(rng, count, degree)
+            expected = [[p.name for p in scc] for scc in reference_tarjan(packages)]
+            actual = [[p.name for p in scc] for scc in tarjan_search(packages, './tests', stage2=False)]
+            self.assertEqual(actual, expected)
+
+    def test_deep_chain(self):
+        count = sys.getrecursionlimit() * 2
+        packages = OrderedDict((f'p{n}', ACBSPackageInfo(f'p{n}', [f'p{n + 1}'] if n + 1 < count else ['p0'], '', []))
+                               for n in range(count))
+        results = tarjan_search(packages, './tests', stage2=False)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0]), count)
+
+    def test_discovery(self):
+        # sub-1 is found in the tree, and its sibling is searched as well
+        packages = OrderedDict(root=ACBSPackageInfo('root', ['sub-1'], '', []))
+        for name in ('test-12', 'test-4', 'test-11', 'test-7'):
+            packages[name] = ACBSPackageInfo(name, [], '', [])
+        acbs.parser.filter_dependencies = fake_pm
+        acbs.find.make_build_dir = unittest.mock.Mock(spec=make_build_dir, return_value='/tmp/')
+        results = tarjan_search(packages, './tests', stage2=False)
+        self.assertEqual([[p.name for p in scc] for scc in results],
+                         [['test-12'], ['test-4'], ['sub-1'], ['root'], ['test-11'], ['test-7'], ['sub-2']])
+
+
+class TestReorder(unittest.TestCase):
+    def setUp(self):
+        acbs.parser.arch = 'none'
+        acbs.deps.pool.clear()
+
+    def tearDown(self):
+        acbs.deps.pool.clear()
+
+    def test_reorder(self):
+        # `a` would be built before `b` since `b` is installed, unless the build list is reordered
+        packages = [ACBSPackageInfo('a', [], '', []), ACBSPackageInfo('b', [], '', [])]
+        packages[0].installables = ['b', 'c', 'a']
+        builder = BuildCore.__new__(BuildCore)
+        builder.tree_dir = './tests'
+        with unittest.mock.patch('acbs.pm.check_packages', side_effect=AssertionError), \
+                unittest.mock.patch('acbs.deps.find_package', side_effect=AssertionError):
+            resolved = builder.reorder_deps(packages, False)
+        self.assertEqual([[p.name for p in scc] for scc in resolved], [['b'], ['a']])
+        self.assertEqual(packages[0].deps, ['b'])
+        self.assertEqual(packages[0].installables, ['c', 'a'])
+
+
+class TestRdeps(unittest.TestCase):
+    def setUp(self):
+        acbs.parser.arch = 'none'
+        acbs.parser.filter_dependencies = fake_pm
+        self.tree = tempfile.mkdtemp(prefix='acbs-tree-')
+        shutil.copytree('./tests/fixtures', os.path.join(self.tree, 'fixtures'))
+        acbs.index.indices.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tree)
+        acbs.index.indices.clear()
+
+    def test_dependents(self):
+        index = acbs.rdeps.get_rdeps_index(self.tree, '')
+        # sub-2 depends on test-4 through sub-1, the self-dependency of test-4 is ignored
+        self.assertCountEqual(index.dependents(['test-4']), ['test-1', 'sub-1', 'sub-2'])
+        self.assertEqual(index.dependents(['sub-2']), [])
+        self.assertEqual(acbs.rdeps.rebuild_set(['sub-1', 'test-5'], self.tree, '', True), ['sub-1', 'test-5', 'sub-2', 'test-6'])
+
+    def test_persisted_index_refresh(self):
+        acbs.rdeps.get_rdeps_index(self.tree, '')
+        # nothing changed, the packages are not parsed again
+        with unittest.mock.patch('acbs.rdeps.parse_package_raw', side_effect=AssertionError):
+            self.assertEqual(acbs.rdeps.get_rdeps_index(self.tree, '').dependents(['sub-1']), ['sub-2'])
+        defines = os.path.join(self.tree, 'fixtures/test-2/02-sub-2/defines')
+        with open(defines, 'wt') as f:
+            f.write('PKGNAME=sub-2\nPKGDEP="test-11"\n')
+        os.utime(defines, ns=(0, 0))
+        self.assertEqual(acbs.rdeps.get_rdeps_index(self.tree, '').dependents(['sub-1']), [])
+
+    def test_rebuild_set(self):
+        builder = BuildCore.__new__(BuildCore)
+        builder.tree_dir = self.tree
+        builder.tmp_dir = TMP_DIR
+        builder.stage2 = False
+        with unittest.mock.patch('acbs.find.make_build_dir', return_value='/tmp/'):
+            roots = acbs.find.find_package('test-4', self.tree, '')
+            builder.rdeps_mode = 'rdeps'
+            # looking up sub-1 finds the whole group
+            self.assertCountEqual([p.name for p in builder.find_rebuild_set(roots)], ['test-1', 'sub-1', 'sub-2'])
+            builder.rdeps_mode = 'rebuild-set'
+            results = builder.find_rebuild_set(roots)
+        self.assertEqual(results[0].name, 'test-4')
+        self.assertCountEqual([p.name for p in results], ['test-4', 'test-1', 'sub-1', 'sub-2'])
+
+
+class TestScheduler(unittest.TestCase):
+    def test_ready_order(self):
+        packages = make_queue(('a', [], ''), ('b', [], ''), ('c', ['a'], ''),
+                              ('sub-1', [], 'cat/grp'), ('sub-2', [], 'cat/grp'))
+        scheduler = BuildScheduler(packages)
+        self.assertEqual(scheduler.take_ready(), [0, 1, 3])
+        self.assertEqual(scheduler.take_ready(), [])
+        scheduler.complete(3)
+        self.assertEqual(scheduler.take_ready(), [4])
+        scheduler.complete(1)
+        self.assertEqual(scheduler.take_ready(), [])
+        scheduler.complete(0)
+        self.assertEqual(scheduler.take_ready(), [2])
+
+    def test_parallel_failure(self):
+        packages = make_queue(('a', [], ''), ('b', [], ''), ('c', ['a'], ''), ('d', ['b'], ''))
+        builder = BuildCore.__new__(BuildCore)
+        builder.jobs = 2
+        builder.package_cursor = 0
+
+        built = threading.Event()
+
+        def build_package(task, build_timings, pending, parallel):
+            if task.name == 'a':
+                built.wait(10)
+                raise RuntimeError('failed')
+            build_timings.append((task.name, 0))
+            built.set()
+        builder.build_package = build_package
+        with unittest.mock.patch('acbs.main.print_build_timings'):
+            with self.assertRaises(RuntimeError):
+                builder.build_parallel([], packages)
+        # completed packages first, then resume from the failed package
+        names = [p.name for p in packages]
+        cursor = builder.package_cursor
+        self.assertIn('b', names[:cursor - 1])
+        self.assertEqual(names[cursor - 1:cursor + 1], ['a', 'c'])
+        self.assertEqual(sorted(names), ['a', 'b', 'c', 'd'])
+
+    def test_parallel_interrupted(self):
+        packages = make_queue(('b', [], ''), ('a', [], ''), ('c', ['a'], ''))
+        builder = BuildCore.__new__(BuildCore)
+        builder.jobs = 2
+        builder.package_cursor = 0
+        release = threading.Event()
+        real_wait = acbs.main.wait
+
+        def build_package(task, build_timings, pending, parallel):
+            if task.name == 'b':
+                release.wait(10)
+            build_timings.append((task.name, 0))
+
+        def wait(*args, **kwargs):
+            if release.is_set():
+                raise KeyboardInterrupt()
+            # `a` completes while `b` is still running, then the user interrupts the build
+            result = real_wait(*args, **kwargs)
+            release.set()
+            return result
+        builder.build_package = build_package
+        with unittest.mock.patch('acbs.main.wait', side_effect=wait):
+            with self.assertRaises(KeyboardInterrupt):
+                builder.build_parallel([], packages)
+        self.assertEqual(builder.package_cursor, 2)
+        self.assertEqual([p.name for p in packages], ['a', 'b', 'c'])
+
+    def test_parallel_builds_refused(self):
+        builder = BuildCore.__new__(BuildCore)
+        builder.jobs = 2
+        builder.dl_only = False
+        # even inside ciel, the builds would share the same dpkg database
+        with tempfile.NamedTemporaryFile() as lock, unittest.mock.patch('acbs.main.CIEL_LOCK_PATH', lock.name):
+            with self.assertRaises(ValueError):
+                builder.check_jobs()
+        builder.dl_only = True
+        builder.check_jobs()
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_deferred_failure(self):
+        def fetch_source(info, source_location, source_name):
+            if source_name == 'bad':
+                raise RuntimeError('Unable to fetch source files, failed 5 times in a row.')
+            return None
+        with unittest.mock.patch('acbs.fetch.fetch_source', side_effect=fetch_source) as fetch_mock:
+            prefetcher = acbs.fetch.SourcePrefetcher('/tmp', 2)
+            prefetcher.schedule([], 'good')
+            prefetcher.schedule([], 'bad')
+            prefetcher.schedule([], 'good')
+            self.assertIsNone(prefetcher.fetch([], 'good'))
+            with self.assertRaises(RuntimeError):
+                prefetcher.fetch([], 'bad')
+            prefetcher.shutdown()
+            self.assertEqual(fetch_mock.call_count, 2)
+
+    def test_concurrent_sources(self):
+        sources = [ACBSSourceInfo('tarball', f'https://example.com/{n}.tar.gz') for n in range(3)]
+        sources.append(ACBSSourceInfo('tarball', 'https://example.com/0.tar.gz'))
+        barrier = threading.Barrier(3, timeout=10)
+        fetched = []
+
+        def fetch_source_inner(info, source_location, name):
+            # all the distinct URLs need to be in flight at the same time to pass the barrier
+            if info is not sources[3]:
+                barrier.wait()
+            fetched.append(info)
+        with unittest.mock.patch('acbs.fetch.fetch_source_inner', side_effect=fetch_source_inner):
+            acbs.fetch.fetch_source(sources, '/tmp', 'test')
+        self.assertEqual(len(fetched), 4)
+        # sources with the same URL are fetched in order
+        self.assertLess(fetched.index(sources[0]), fetched.index(sources[3]))
+
+    def test_worker_connections_closed(self):
+        sources = [ACBSSourceInfo('tarball', f'https://example.com/{n}.tar.gz') for n in range(2)]
+        with unittest.mock.patch('acbs.fetch.fetch_source_inner'), \
+                unittest.mock.patch('acbs.fetch.close_connections') as close_mock:
+            acbs.fetch.fetch_source(sources, '/tmp', 'test')
+        self.assertEqual(close_mock.call_count, 2)
+
+    def test_same_url_across_packages(self):
+        source = ACBSSourceInfo('tarball', 'https://example.com/shared.tar.gz')
+        active = []
+        overlaps = []
+
+        def tarball_fetch(info, source_location, name):
+            active.append(name)
+            overlaps.append(len(active))
+            time.sleep(0.05)
+            active.remove(name)
+        handlers = dict(acbs.fetch.handlers, TARBALL=(tarball_fetch, None))
+        with unittest.mock.patch('acbs.fetch.handlers', handlers):
+            prefetcher = acbs.fetch.SourcePrefetcher('/tmp', 2)
+            # two different packages using the same tarball
+            prefetcher.schedule([source], 'pkg-1')
+            prefetcher.schedule([source], 'pkg-2')
+            prefetcher.fetch([source], 'pkg-1')
+            prefetcher.fetch([source], 'pkg-2')
+            prefetcher.shutdown()
+        self.assertEqual(overlaps, [1, 1])
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    payload = bytes(range(256)) * 4096
+    connections = 0
+    ranges = []
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        offset = 0
+        header = self.headers.get('Range')
+        type(self).ranges.append(header)
+        if header:
+            offset = int(header[len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{len(self.payload) - 1}/{len(self.payload)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.payload) - offset))
+        self.end_headers()
+        self.wfile.write(self.payload[offset:])
+
+
+class TestDownload(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        cls.digest = hashlib.sha256(RangeRequestHandler.payload).hexdigest()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-dl-')
+        acbs.download.close_connections()
+        RangeRequestHandler.connections = 0
+        RangeRequestHandler.ranges = []
+        # talk to the local server directly even if a proxy is configured
+        self.proxy_patch = unittest.mock.patch('acbs.download.get_proxy', return_value=None)
+        self.proxy_patch.start()
+
+    def tearDown(self):
+        self.proxy_patch.stop()
+        shutil.rmtree(self.root)
+
+    def test_download_and_reuse(self):
+        for n in range(3):
+            target = os.path.join(self.root, str(n))
+            self.assertEqual(acbs.download.http_download(f'{self.base}/redirect', target), self.digest)
+            self.assertFalse(os.path.exists(target + '.dl'))
+            with open(target, 'rb') as f:
+                self.assertEqual(f.read(), RangeRequestHandler.payload)
+            # the digest is known, no need to read the file again
+            with unittest.mock.patch('builtins.open', side_effect=AssertionError):
+                self.assertEqual(acbs.crypto.check_hash_hashlib_inner('sha256', target), self.digest)
+        self.assertEqual(RangeRequestHandler.connections, 1)
+
+    def test_resume(self):
+        target = os.path.join(self.root, 'partial')
+        with open(target, 'wb') as f:
+            f.write(RangeRequestHandler.payload[:12345])
+        open(target + '.dl', 'wb').close()
+        self.assertEqual(acbs.download.http_download(f'{self.base}/file', target), self.digest)
+        self.assertEqual(RangeRequestHandler.ranges, ['bytes=12345-'])
+        # completed downloads are left untouched
+        self.assertIsNone(acbs.download.http_download(f'{self.base}/file', target))
+        self.assertEqual(len(RangeRequestHandler.ranges), 1)
+
+    def test_content_addressed_store(self):
+        sources = [ACBSSourceInfo('tarball', f'{self.base}/file'), ACBSSourceInfo('tarball', f'{self.base}/redirect')]
+        for source in sources:
+            source.chksum = ('sha256', self.digest)
+            acbs.fetch.fetch_source_inner(source, self.root, '')
+        # the second URL is served from the store
+        self.assertEqual(len(RangeRequestHandler.ranges), 1)
+        self.assertTrue(os.path.samefile(sources[0].source_location, sources[1].source_location))
+        self.assertTrue(os.path.samefile(sources[0].source_location,
+                                         os.path.join(self.root, 'objects', 'sha256', self.digest)))
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-hash-')
+        self.target = os.path.join(self.root, 'source.tar')
+        with open(self.target, 'wb') as f:
+            f.write(b'acbs' * 1000)
+
+    def tearDown(self):
+        acbs.crypto.known_hashes.clear()
+        shutil.rmtree(self.root)
+
+    def test_sidecar(self):
+        digest = hashlib.sha256(b'acbs' * 1000).hexdigest()
+        self.assertEqual(acbs.crypto.check_hash_hashlib_inner('sha256', self.target), digest)
+        self.assertTrue(os.path.exists(self.target + acbs.crypto.HASH_SIDECAR_SUFFIX))
+        # a new session trusts the sidecar as long as the file is untouched
+        acbs.crypto.known_hashes.clear()
+        with unittest.mock.patch('hashlib.new', side_effect=AssertionError):
+            self.assertEqual(acbs.crypto.check_hash_hashlib_inner('SHA256', self.target), digest)
+        with open(self.target, 'ab') as f:
+            f.write(b'!')
+        self.assertEqual(acbs.crypto.check_hash_hashlib_inner('sha256', self.target),
+                         hashlib.sha256(b'acbs' * 1000 + b'!').hexdigest())
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-store-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_garbage_collection(self):
+        for name in ('old', 'new'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+        os.makedirs(os.path.join(self.root, 'objects', 'sha256'))
+        os.link(os.path.join(self.root, 'old'), os.path.join(self.root, 'objects', 'sha256', 'abcd'))
+        open(os.path.join(self.root, 'old.acbs-hash'), 'w').close()
+        os.makedirs(os.path.join(self.root, 'mirror'))
+        acbs.store.touch_entries(self.root, [os.path.join(self.root, 'old')])
+        acbs.store.touch_entries(self.root, [os.path.join(self.root, n) for n in ('mirror', 'new')])
+        # hard links are only counted once
+        evicted, size = acbs.store.collect_garbage(self.root, 100 * 1024)
+        self.assertEqual(evicted, 1)
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['.acbs-access.lock', '.acbs-access.log', 'mirror', 'new', 'objects'])
+        self.assertEqual(os.listdir(os.path.join(self.root, 'objects', 'sha256')), [])
+        # the log is compacted, and only records the remaining entries
+        with open(os.path.join(self.root, '.acbs-access.log'), 'rt') as f:
+            self.assertEqual(sorted(line.split()[1] for line in f), ['mirror', 'new'])
+
+    def test_fetch_in_progress(self):
+        collector = threading.Thread(target=acbs.store.collect_garbage, args=(self.root, 0))
+
+        def fetch(info, source_location, package_name):
+            path = os.path.join(source_location, 'partial')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+            open(path + '.dl', 'w').close()
+            collector.start()
+            collector.join(0.5)
+            # the garbage collection waits for the fetch to finish
+            self.assertTrue(collector.is_alive())
+            self.assertTrue(os.path.exists(path))
+            os.unlink(path + '.dl')
+            info.source_location = path
+            return info
+
+        info = ACBSSourceInfo('test', 'https://example.com/partial.tar.gz', '1')
+        with unittest.mock.patch.dict(acbs.fetch.handlers, {'TEST': (fetch, None)}):
+            acbs.fetch.fetch_source_inner(info, self.root, 'test')
+        collector.join()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'partial')))
+
+    def test_git_pools(self):
+        pool = os.path.join(self.root, 'git-pool', 'root.git')
+        os.makedirs(os.path.join(pool, 'objects', 'pack'))
+        with open(os.path.join(pool, 'objects', 'pack', 'pack-1.pack'), 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+        for name in ('mirror', 'fork'):
+            os.makedirs(os.path.join(self.root, name, 'objects'))
+            acbs.gitpool.add_alternate(os.path.join(self.root, name), os.path.join(pool, 'objects'))
+        with open(os.path.join(self.root, 'new'), 'wb') as f:
+            f.write(os.urandom(16 * 1024))
+        acbs.store.touch_entries(self.root, [os.path.join(self.root, n) for n in ('mirror', 'fork')])
+        acbs.store.touch_entries(self.root, [os.path.join(self.root, 'new')])
+        # the pool is counted, and evicted together with the mirrors using it
+        evicted, size = acbs.store.collect_garbage(self.root, 48 * 1024)
+        self.assertEqual(evicted, 1)
+        self.assertLess(size, 48 * 1024)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'git-pool')), [])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'mirror')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'fork')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'new')))
+
+    def test_parse_size(self):
+        self.assertEqual(acbs.store.parse_size('50G'), 50 << 30)
+        self.assertEqual(acbs.store.parse_size('1.5MiB'), 3 << 19)
+        self.assertEqual(acbs.store.parse_size('1024'), 1024)
+        with self.assertRaises(ValueError):
+            acbs.store.parse_size('lots')
+
+
+class TestVcsFetch(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-vcs-')
+        self.upstream = os.path.join(self.root, 'upstream')
+        self.env = dict(os.environ, GIT_AUTHOR_NAME='acbs', GIT_AUTHOR_EMAIL='acbs@localhost',
+                        GIT_COMMITTER_NAME='acbs', GIT_COMMITTER_EMAIL='acbs@localhost')
+        subprocess.check_call(['git', 'init', '-q', self.upstream])
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'init'], cwd=self.upstream, env=self.env)
+        subprocess.check_call(['git', 'tag', 'v1'], cwd=self.upstream)
+        self.commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.upstream).decode().strip()
+        acbs.fetch.updated_repos.clear()
+
+    def tearDown(self):
+        acbs.fetch.updated_repos.clear()
+        shutil.rmtree(self.root)
+
+    def fetch(self, revision):
+        info = ACBSSourceInfo('git', f'file://{self.upstream}', revision=revision)
+        acbs.fetch.git_fetch(info, self.root, 'mirror')
+        return info
+
+    def test_git_skip_update(self):
+        self.fetch(self.commit)
+        with unittest.mock.patch('subprocess.check_call') as call_mock:
+            # updated in this session already
+            self.fetch('master')
+            acbs.fetch.updated_repos.clear()
+            # available locally
+            self.fetch(self.commit)
+            self.fetch('tags/v1')
+            call_mock.assert_not_called()
+            self.fetch('master')
+            call_mock.assert_called_once()
+
+    def test_git_shallow(self):
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'second'], cwd=self.upstream, env=self.env)
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.upstream).decode().strip()
+        for revision in (head, 'tags/v1'):
+            info = ACBSSourceInfo('git', f'file://{self.upstream}', revision=revision, depth=1)
+            acbs.fetch.git_fetch(info, self.root, 'mirror')
+            self.assertEqual(info.source_location, os.path.join(self.root, 'mirror.shallow'))
+            self.assertTrue(acbs.fetch.git_has_revision(info.source_location, revision))
+        shallow = subprocess.check_output(['git', 'rev-parse', '--is-shallow-repository'], cwd=info.source_location)
+        self.assertEqual(shallow.strip(), b'true')
+        # abbreviated hashes fall back to the full mirror
+        info = ACBSSourceInfo('git', f'file://{self.upstream}', revision=head[:8], depth=1)
+        acbs.fetch.git_fetch(info, self.root, 'mirror')
+        self.assertEqual(info.source_location, os.path.join(self.root, 'mirror'))
+
+    def test_vcs_metadata(self):
+        info = ACBSSourceInfo('svn', 'https://example.com/svn')
+        info.source_location = os.path.join(self.root, 'mirror')
+        package = ACBSPackageInfo('test', [], '', [info])
+        package.build_location = os.path.join(self.root, 'build')
+        with unittest.mock.patch('acbs.fetch.copy_tree') as copy_mock, \
+                unittest.mock.patch('subprocess.check_call') as call_mock:
+            # the working copy (with the metadata) is copied by default
+            acbs.fetch.svn_processor(package, 0, 'src')
+            copy_mock.assert_called_once_with(info.source_location, os.path.join(package.build_location, 'src'))
+            call_mock.assert_not_called()
+            info.export = True
+            acbs.fetch.svn_processor(package, 0, 'src')
+            self.assertEqual(call_mock.call_args[0][0][:2], ['svn', 'export'])
+
+    def test_git_copy_repo(self):
+        with open(os.path.join(self.upstream, 'README'), 'wt') as f:
+            f.write('acbs\n')
+        subprocess.check_call(['git', 'add', 'README'], cwd=self.upstream)
+        subprocess.check_call(['git', 'commit', '-q', '-m', 'readme'], cwd=self.upstream, env=self.env)
+        subprocess.check_call(['git', 'gc', '-q'], cwd=self.upstream)
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.upstream).decode().strip()
+        info = self.fetch(head)
+        info.copy_repo = True
+        package = ACBSPackageInfo('test', [], '', [info])
+        package.build_location = os.path.join(self.root, 'build')
+        os.mkdir(package.build_location)
+        acbs.fetch.git_processor(package, 0, 'src')
+        checkout = os.path.join(package.build_location, 'src')
+        with open(os.path.join(checkout, 'README'), 'rt') as f:
+            self.assertEqual(f.read(), 'acbs\n')
+        status = subprocess.check_output(['git', 'status', '--porcelain'], cwd=checkout)
+        self.assertEqual(status, b'')
+        # the packs are shared with the mirror, the rest is copied
+        packs = os.path.join(info.source_location, 'objects', 'pack')
+        for name in os.listdir(packs):
+            self.assertTrue(os.path.samefile(os.path.join(packs, name), os.path.join(checkout, '.git', 'objects', 'pack', name)))
+        self.assertFalse(os.path.samefile(os.path.join(info.source_location, 'config'), os.path.join(checkout, '.git', 'config')))
+
+
+class TestGitPool(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-pool-')
+        env = dict(os.environ, GIT_AUTHOR_NAME='acbs', GIT_AUTHOR_EMAIL='acbs@localhost',
+                   GIT_COMMITTER_NAME='acbs', GIT_COMMITTER_EMAIL='acbs@localhost')
+        self.upstream = os.path.join(self.root, 'upstream', 'project.git')
+        self.fork = os.path.join(self.root, 'fork', 'project.git')
+        subprocess.check_call(['git', 'init', '-q', self.upstream])
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'init'], cwd=self.upstream, env=env)
+        subprocess.check_call(['git', 'clone', '-q', self.upstream, self.fork])
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'fork'], cwd=self.fork, env=env)
+        self.dump_dir = os.path.join(self.root, 'dump')
+        os.mkdir(self.dump_dir)
+        acbs.fetch.updated_repos.clear()
+
+    def tearDown(self):
+        acbs.fetch.updated_repos.clear()
+        shutil.rmtree(self.root)
+
+    def test_shared_objects(self):
+        mirrors = []
+        for n, url in enumerate((self.upstream, self.fork)):
+            info = ACBSSourceInfo('git', f'file://{url}', revision='HEAD')
+            acbs.fetch.git_fetch(info, self.dump_dir, f'mirror-{n}')
+            mirrors.append(info.source_location)
+        root = acbs.gitpool.get_root_commit(mirrors[0])
+        pool_objects = os.path.abspath(os.path.join(acbs.gitpool.pool_path(self.dump_dir, root), 'objects'))
+        for mirror in mirrors:
+            self.assertEqual(acbs.gitpool.get_alternates(mirror), [pool_objects])
+            subprocess.check_call(['git', 'fsck', '--connectivity-only'], cwd=mirror)
+        # the history of the fork is complete, but only its own commit is stored locally
+        count = subprocess.check_output(['git', 'count-objects', '-v'], cwd=mirrors[1]).decode()
+        self.assertIn('in-pack: 1\n', count)
+        self.assertEqual(acbs.gitpool.guess_pool(self.dump_dir, 'https://example.com/project/'),
+                         acbs.gitpool.pool_path(self.dump_dir, root))
+
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-extract-')
+        os.mkdir(os.path.join(self.root, 'src'))
+        with open(os.path.join(self.root, 'src', 'README'), 'wt') as f:
+            f.write('acbs\n')
+        subprocess.check_call(['bsdtar', '-cf', 'src.tar', 'src'], cwd=self.root)
+        acbs.fetch.extract_timings.clear()
+
+    def tearDown(self):
+        acbs.fetch.extract_timings.clear()
+        shutil.rmtree(self.root)
+
+    def extract(self, archive):
+        target = tempfile.mkdtemp(dir=self.root)
+        os.rename(os.path.join(self.root, archive), os.path.join(target, archive))
+        acbs.fetch.extract_archive(archive, target)
+        with open(os.path.join(target, 'src', 'README'), 'rt') as f:
+            self.assertEqual(f.read(), 'acbs\n')
+
+    def test_formats(self):
+        for compressor, extension, compression in (('xz', '.xz', 'xz'), ('zstd', '.zst', 'zstd'), ('gzip', '.gz', 'gzip')):
+            if not shutil.which(compressor):
+                continue
+            subprocess.check_call([compressor, '-k', '-q', 'src.tar'], cwd=self.root)
+            self.assertEqual(acbs.fetch.detect_compression(os.path.join(self.root, 'src.tar' + extension)), compression)
+            self.extract('src.tar' + extension)
+        self.assertIsNone(acbs.fetch.detect_compression(os.path.join(self.root, 'src.tar')))
+        self.extract('src.tar')
+
+    def test_corrupted(self):
+        if not shutil.which('xz'):
+            self.skipTest('xz is not available')
+        subprocess.check_call(['xz', 'src.tar'], cwd=self.root)
+        with open(os.path.join(self.root, 'src.tar.xz'), 'r+b') as f:
+            f.seek(-32, os.SEEK_END)
+            f.write(b'\0' * 32)
+        with self.assertRaises(subprocess.CalledProcessError):
+            acbs.fetch.extract_archive('src.tar.xz', self.root)
+
+    def test_timings(self):
+        info = ACBSSourceInfo('tarball', 'https://example.com/src.tar')
+        info.source_location = os.path.join(self.root, 'src.tar')
+        info.chksum = ('sha256', acbs.crypto.check_hash_hashlib_inner('sha256', info.source_location))
+        package = ACBSPackageInfo('test', [], '', [info])
+        package.version = '1.0'
+        package.build_location = tempfile.mkdtemp(dir=self.root)
+        acbs.fetch.tarball_processor(package, 0, 'test')
+        self.assertTrue(os.path.isfile(os.path.join(package.build_location, 'src', 'README')))
+        self.assertIn('test', acbs.fetch.extract_timings)
+
+    def test_tree_cache(self):
+        cache = os.path.join(self.root, 'trees')
+        acbs.treecache.configure(cache, 1 << 30)
+        self.addCleanup(acbs.treecache.configure, None, 0)
+        chksum = ('sha256', acbs.crypto.check_hash_hashlib_inner('sha256', os.path.join(self.root, 'src.tar')))
+        extract = unittest.mock.Mock(side_effect=acbs.fetch.extract_archive)
+        builds = []
+        for _ in range(2):
+            build = tempfile.mkdtemp(dir=self.root)
+            os.symlink(os.path.join(self.root, 'src.tar'), os.path.join(build, 'test-1.0.tar'))
+            self.assertTrue(acbs.treecache.extract_cached(chksum, 'test-1.0.tar', build, extract))
+            builds.append(os.path.join(build, 'src', 'README'))
+        extract.assert_called_once()
+        # the build directories never share the files with the cache
+        with open(builds[1], 'at') as f:
+            f.write('modified\n')
+        with open(builds[0], 'rt') as f:
+            self.assertEqual(f.read(), 'acbs\n')
+        self.assertFalse(acbs.treecache.extract_cached(('none', ''), 'test-1.0.tar', build, extract))
+        self.assertEqual(acbs.treecache.evict_trees(cache, 0), 1)
+        self.assertEqual(os.listdir(cache), ['.lock'])
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-ckpt-')
+        self.cache_dir = acbs.cache.cache_dir
+        acbs.cache.cache_dir = os.path.join(self.root, 'cache')
+        self.packages = []
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.root, name, 'autobuild'))
+            for path in ('spec', 'autobuild/defines'):
+                self.write(os.path.join(name, path), f'{name}\n')
+            self.packages.append(ACBSPackageInfo(name, [], os.path.join(self.root, name, 'autobuild'), []))
+
+    def tearDown(self):
+        acbs.cache.cache_dir = self.cache_dir
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        st = os.stat(path) if os.path.exists(path) else None
+        with open(path, 'wt') as f:
+            f.write(content)
+        # pretend the file was written a while ago (or not modified at all)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns) if st else (0, 0))
+
+    def test_incremental(self):
+        specs = acbs.checkpoint.checkpoint_specs(self.packages)
+        self.assertNotEqual(specs[0], specs[1])
+        self.assertEqual(specs[0], acbs.checkpoint.checkpoint_spec(self.packages[0]))
+        # the digests are persisted, and reused if the size, the modification time and the inode are the same
+        self.write('a/spec', 'c\n')
+        self.assertEqual(acbs.checkpoint.checkpoint_specs(self.packages), specs)
+        os.utime(os.path.join(self.root, 'a', 'spec'))
+        self.assertNotEqual(acbs.checkpoint.checkpoint_spec(self.packages[0]), specs[0])
+        os.chmod(os.path.join(self.root, 'b', 'autobuild', 'defines'), 0o755)
+        self.assertNotEqual(acbs.checkpoint.checkpoint_spec(self.packages[1]), specs[1])
+
+    def test_pruned(self):
+        self.write('a/extra', 'x\n')
+        acbs.checkpoint.checkpoint_spec(self.packages[0])
+        os.unlink(os.path.join(self.root, 'a', 'extra'))
+        acbs.checkpoint.checkpoint_spec(self.packages[0])
+        # the digests are kept per package directory, without the deleted files
+        key = hashlib.sha256(os.path.realpath(os.path.join(self.root, 'a')).encode('utf-8')).hexdigest()
+        cached = acbs.cache.load_cache('spec-digests', key)
+        self.assertEqual(sorted(os.path.basename(path) for path in cached), ['defines', 'spec'])
+        self.assertEqual(len(os.listdir(os.path.join(acbs.cache.cache_dir, 'spec-digests'))), 1)
+
+    def test_round_trip(self):
+        acbs.parser.arch = 'none'
+        acbs.parser.filter_dependencies = fake_pm
+        package = acbs.parser.parse_package('./tests/fixtures/test-1/autobuild', modifiers='')
+        package.base_slug = 'tests/fixtures'
+        package.group_seq = 2
+        state = ACBSShrinkWrap(2, [('a', 1.0)], self.packages[:1] + [package], False)
+        with unittest.mock.patch('acbs.checkpoint.checkpoint_dpkg', return_value='dpkg'):
+            filename = acbs.checkpoint.do_shrink_wrap(state, self.root)
+        loaded = acbs.resume.do_load_checkpoint(filename)
+        self.assertEqual((loaded.cursor, loaded.timings, loaded.dpkg_state, loaded.no_deps), (2, [('a', 1.0)], 'dpkg', False))
+        self.assertEqual(loaded.sps, state.sps)
+        # only the identities of the packages are saved
+        stub = loaded.packages[1]
+        self.assertEqual((stub.name, stub.script_location, stub.base_slug, stub.group_seq),
+                         (package.name, package.script_location, 'tests/fixtures', 2))
+        self.assertEqual(stub.source_uri, [])
+        rehydrated = acbs.resume.rehydrate_package(stub)
+        self.assertEqual((rehydrated.version, rehydrated.deps, rehydrated.group_seq), ('1', package.deps, 2))
+        with open(filename, 'wt') as f:
+            f.write('{"schema": 0}')
+        with self.assertRaises(ValueError):
+            acbs.resume.do_load_checkpoint(filename)
+
+    def test_legacy_pickle(self):
+        state = ACBSShrinkWrap(1, [], self.packages, False)
+        # pickled by a version of acbs without the journal
+        del state.journaled
+        state.sps = ['tar-digest'] * len(self.packages)
+        filename = os.path.join(self.root, 'legacy.acbs-ckpt')
+        with open(filename, 'wb') as f:
+            pickle.dump(state, f)
+        self.assertEqual(acbs.resume.do_load_checkpoint(filename).journaled, len(self.packages))
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        group = find_package_generic('test-2')[0]
+        self.packages = group + [find_package_generic(name)[0][0] for name in ('test-1', 'test-3')]
+
+    def test_revalidate(self):
+        state = ACBSShrinkWrap(4, [], self.packages, False)
+        state.sps = acbs.checkpoint.checkpoint_specs(self.packages)
+        packages, cursor = acbs.resume.revalidate_packages(state, './tests/', '')
+        self.assertEqual((packages, cursor), (self.packages, 3))
+        # pretend test-1 changed after it was built
+        state.sps[2] = 'changed'
+        packages, cursor = acbs.resume.revalidate_packages(state, './tests/', '')
+        self.assertEqual([p.name for p in packages], ['sub-1', 'sub-2', 'test-1', 'test-3'])
+        self.assertIsNot(packages[2], self.packages[2])
+        self.assertEqual(cursor, 2)
+        # the whole group is looked up again, but only once
+        state.sps[:3] = ['changed'] * 3
+        packages, cursor = acbs.resume.revalidate_packages(state, './tests/', '')
+        self.assertEqual([p.name for p in packages], ['sub-1', 'sub-2', 'test-1', 'test-3'])
+        self.assertEqual(cursor, 0)
+
+    def test_legacy_checkpoint(self):
+        root = tempfile.mkdtemp(prefix='acbs-resume-')
+        self.addCleanup(shutil.rmtree, root)
+        packages = [find_package_generic(name)[0][0] for name in ('test-1', 'test-3', 'test-4')]
+        state = ACBSShrinkWrap(2, [('test-1', 1.0)], packages, False)
+        # pickled by an older acbs: the spec states were digests of tar streams
+        del state.journaled
+        state.sps = ['tar-digest'] * 3
+        state.dpkg_state = 'dpkg'
+        filename = os.path.join(root, 'legacy.acbs-ckpt')
+        with open(filename, 'wb') as f:
+            pickle.dump(state, f)
+        builder = unittest.mock.Mock(tree_dir='./tests/', stage2=False)
+        with unittest.mock.patch('acbs.resume.BuildCore', return_value=builder), \
+                unittest.mock.patch('acbs.resume.checkpoint_dpkg', return_value='dpkg'), \
+                unittest.mock.patch('acbs.resume.print_build_timings'):
+            acbs.resume.do_resume_checkpoint(filename, None)
+        # the built package is not built again
+        self.assertEqual([p.name for p in builder.build_packages.call_args[0][1]], ['test-3', 'test-4'])
+        builder.resolve_deps.assert_not_called()
+        self.assertFalse(os.path.exists(filename))
+
+    def test_dpkg_state(self):
+        state = ACBSShrinkWrap(4, [], self.packages, False)
+        state.dpkg_state = 'old'
+        installed = {'sub-1': True, 'sub-2': False}
+        with unittest.mock.patch('acbs.resume.checkpoint_dpkg', return_value='new'), \
+                unittest.mock.patch('acbs.resume.check_packages') as check_mock, \
+                unittest.mock.patch('acbs.resume.check_if_installed', side_effect=installed.get):
+            self.assertTrue(acbs.resume.check_dpkg_state(state, self.packages[:1]))
+            self.assertFalse(acbs.resume.check_dpkg_state(state, self.packages[:2]))
+            # one query for all the packages
+            check_mock.assert_called_with(['sub-1', 'sub-2'])
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='acbs-journal-')
+        self.cache_dir = acbs.cache.cache_dir
+        acbs.cache.cache_dir = os.path.join(self.root, 'cache')
+        self.packages = []
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.root, name, 'autobuild'))
+            with open(os.path.join(self.root, name, 'spec'), 'wt') as f:
+                f.write(f'VER={name}\n')
+            self.packages.append(ACBSPackageInfo(name, [], os.path.join(self.root, name, 'autobuild'), []))
+        patcher = unittest.mock.patch('acbs.journal.checkpoint_dpkg', side_effect=['start', 'final'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        acbs.cache.cache_dir = self.cache_dir
+        shutil.rmtree(self.root)
+
+    def test_resume_state(self):
+        journal = acbs.journal.BuildJournal(self.root, self.packages, [('x', 1.0)], False)
+        journal.record(self.packages[2], ('c', 2.0))
+        journal.record(self.packages[0], ('a', 3.0))
+        sps = journal.sps
+        journal.close()
+        # killed while writing a record
+        with open(journal.path, 'at') as f:
+            f.write('{"type":"built","ind')
+        state = acbs.journal.load_journal(journal.path)
+        self.assertEqual([p.name for p in state.packages], ['c', 'a', 'b'])
+        self.assertEqual(state.cursor, 3)
+        self.assertEqual(state.journaled, 2)
+        self.assertEqual(state.sps, [sps[2], sps[0], sps[1]])
+        self.assertEqual(state.timings, [('x', 1.0), ('c', 2.0), ('a', 3.0)])
+        self.assertEqual(state.dpkg_state, 'final')
+        self.assertEqual(state.packages[2].script_location, self.packages[1].script_location)
+
+    def test_killed(self):
+        journal = acbs.journal.BuildJournal(self.root, self.packages, [], False)
+        journal.record(self.packages[1], ('b', 2.0))
+        # no final record, the state of dpkg after the build is unknown
+        journal.file.close()
+        state = acbs.journal.load_journal(journal.path)
+        self.assertEqual([p.name for p in state.packages], ['b', 'a', 'c'])
+        self.assertEqual(state.dpkg_state, '')
+
+    def test_corrupted(self):
+        journal = acbs.journal.BuildJournal(self.root, self.packages, [], False)
+        journal.close()
+        with open(journal.path, 'at') as f:
+            f.write('garbage\n')
+        with self.assertRaises(ValueError):
+            acbs.journal.load_journal(journal.path)
+        journal.close(remove=True)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_superseded_by_checkpoint(self):
+        builder = BuildCore.__new__(BuildCore)
+        builder.package_cursor = 2
+        builder.no_deps = False
+        journal = builder.journal = acbs.journal.BuildJournal(self.root, self.packages, [], False)
+        journal.close()
+        with unittest.mock.patch('acbs.main.do_shrink_wrap', return_value='/tmp/test.acbs-ckpt'):
+            with self.assertRaises(RuntimeError):
+                builder.save_checkpoint([], self.packages)
+        self.assertFalse(os.path.exists(journal.path))
+
+
 class TestMisc(unittest.TestCase):
     def test_apt_name_escaping(self):
         self.assertEqual(acbs.pm.escape_package_name('test++'), 'test\\+\\+')